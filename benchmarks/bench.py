@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# coding: utf-8
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+from datetime import datetime, timezone
+
+import jieba
+
+from telegram import Update
+
+from benchmarks.corpus import Corpus
+from whaleyeah import init_storage, mob, trim_tokens, tokenizer
+from whaleyeah.ingest import history_writer
+from whaleyeah.iwaku import _history_doc, _iwaku_history_callback, HISTORY_PROJECTION, SEARCH_PAGE_SIZE, COUNT_LIMIT
+from whaleyeah.tokenstats import QueryPlan
+
+
+POPULATE_BATCH_SIZE = 1000
+
+logger = logging.getLogger("bench")
+
+
+def percentiles(samples: list[float]) -> dict:
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered)-1, int(q*len(ordered)))]
+    return {
+        "count": len(ordered),
+        "mean_ms": 1000*statistics.fmean(ordered),
+        "p50_ms": 1000*pick(0.50),
+        "p95_ms": 1000*pick(0.95),
+        "p99_ms": 1000*pick(0.99),
+        "max_ms": 1000*ordered[-1],
+    }
+
+def as_update(msg: dict, update_id: int) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": msg["mid"],
+            "date": int(msg["date"].timestamp()),
+            "chat": {"id": msg["chat"], "type": "supergroup"},
+            "from": {"id": msg["from"], "is_bot": False, "first_name": msg["name"]},
+            "text": msg["text"],
+        },
+    }, None)
+
+
+class Bench:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args    = args
+        self.corpus  = Corpus(seed=args.seed)
+        self.results = []
+
+    def record(self, name: str, **fields) -> None:
+        result = {"name": name, **fields}
+        logger.info(json.dumps(result, ensure_ascii=False))
+        self.results.append(result)
+
+
+    def bench_cpu(self) -> None:
+        """Size independent hot paths: tokenization and history document construction."""
+        texts = self.corpus.texts(self.args.cpu_samples)
+        chars = sum(len(v) for v in texts)
+
+        start_time = time.perf_counter()
+        segs = [jieba.lcut_for_search(v) for v in texts]
+        elapsed = time.perf_counter() - start_time
+        self.record("jieba.lcut_for_search", messages=len(texts), seconds=elapsed, messages_per_s=len(texts)/elapsed, chars_per_s=chars/elapsed)
+
+        if tokenizer.workers>0:
+            # one text per worker spawns the pool and loads the dictionary in each process
+            start_time = time.perf_counter()
+            tokenizer.map(texts[:tokenizer.workers], chunksize=1)
+            elapsed = time.perf_counter() - start_time
+            self.record("tokenizer.startup", workers=tokenizer.workers, seconds=elapsed)
+
+            start_time = time.perf_counter()
+            tokenizer.map(texts)
+            elapsed = time.perf_counter() - start_time
+            self.record("tokenizer.map", workers=tokenizer.workers, messages=len(texts), seconds=elapsed, messages_per_s=len(texts)/elapsed, chars_per_s=chars/elapsed)
+
+        start_time = time.perf_counter()
+        for seg in segs: trim_tokens(seg)
+        elapsed = time.perf_counter() - start_time
+        self.record("trim_tokens", calls=len(segs), seconds=elapsed, calls_per_s=len(segs)/elapsed)
+
+        messages = self.corpus.messages(self.args.cpu_samples)
+        updates  = [as_update(msg, k) for (k, msg) in enumerate(messages)]
+
+        start_time = time.perf_counter()
+        for (update, msg, seg) in zip(updates, messages, segs): _history_doc(update, msg["text"], seg)
+        elapsed = time.perf_counter() - start_time
+        self.record("history_doc", keep_raw_update=mob.keep_raw_update, calls=len(updates), seconds=elapsed, calls_per_s=len(updates)/elapsed)
+
+
+    async def stored(self, size: int) -> int:
+        """Number of corpus messages already stored, they are inserted in mid order so the first gap is found by bisection."""
+        lo, hi = 0, size
+        while lo<hi:
+            mid = (lo+hi+1)//2
+            if await mob.backend.existing(self.corpus.chat_id, [mid]): lo = mid
+            else: hi = mid-1
+        return lo
+
+    async def populate(self, size: int) -> None:
+        """Grows the corpus to `size` messages through the bulk write path."""
+        stored = await self.stored(size)
+        if stored>=size: return
+
+        start_time = time.perf_counter()
+        for start in range(stored, size, POPULATE_BATCH_SIZE):
+            messages = self.corpus.messages(min(POPULATE_BATCH_SIZE, size-start), start=start)
+            segs     = await tokenizer.lcut_for_search_many([msg["text"] for msg in messages])
+            docs     = [_history_doc(as_update(msg, k), msg["text"], seg) for (k, (msg, seg)) in enumerate(zip(messages, segs))]
+            await mob.backend.insert(docs)
+
+            if (start//POPULATE_BATCH_SIZE) % 100==0:
+                logger.info(f"populated {start+len(docs):9d} of {size} messages...")
+
+        elapsed = time.perf_counter() - start_time
+        self.record("populate", size=size, messages=size-stored, seconds=elapsed, messages_per_s=(size-stored)/elapsed)
+
+    async def bench_ingest(self, size: int) -> None:
+        """End to end ingestion through the history handler and the write-behind buffer."""
+        count    = self.args.ingest_samples
+        messages = self.corpus.messages(count, start=size)
+        for msg in messages: msg["chat"] = self.args.ingest_chat
+        updates  = [as_update(msg, k) for (k, msg) in enumerate(messages)]
+
+        history_writer.start()
+        start_time = time.perf_counter()
+        samples = []
+        for update in updates:
+            t0 = time.perf_counter()
+            await _iwaku_history_callback(update, None)
+            samples.append(time.perf_counter()-t0)
+        await history_writer.stop()
+        elapsed = time.perf_counter() - start_time
+
+        self.record("iwaku_history_callback", size=size, messages=count, seconds=elapsed, messages_per_s=count/elapsed, **percentiles(samples))
+
+    async def bench_queries(self, size: int) -> None:
+        """First page latency of inline queries, tokenization, fetch and count included."""
+        for mode in self.args.modes:
+            for rare in [True, False]:
+                rng = random.Random(self.args.seed)
+                samples = []
+
+                for _ in range(self.args.queries):
+                    query = " ".join(self.corpus.query_words(rng, rare))
+
+                    t0 = time.perf_counter()
+                    query_tokens = trim_tokens(await tokenizer.lcut_for_search(query))
+                    plan = QueryPlan(mode, query_tokens, [])
+                    await asyncio.gather(
+                        mob.backend.search(plan, limit=SEARCH_PAGE_SIZE, projection=HISTORY_PROJECTION),
+                        mob.backend.count(plan, limit=COUNT_LIMIT),
+                    )
+                    samples.append(time.perf_counter()-t0)
+
+                self.record("inline_query", backend=mob.backend.name, size=size, mode=mode, tokens="rare" if rare else "common", **percentiles(samples))
+
+
+    async def run(self) -> None:
+        if not self.args.keep:
+            if mob.backend.name=="mongo":
+                await mob.database.client.drop_database(mob.database.name)
+            else:
+                for path in [mob.backend.path, f"{mob.backend.path}-wal", f"{mob.backend.path}-shm"]:
+                    if os.path.exists(path): os.remove(path)
+
+        await mob.backend.start()
+        await mob.backend.reconcile()
+
+        tokenizer.start()
+        try:
+            self.bench_cpu()
+            for size in sorted(self.args.sizes):
+                await self.populate(size)
+                if self.args.ingest_samples>0: await self.bench_ingest(size)
+                if self.args.queries>0: await self.bench_queries(size)
+        finally:
+            await mob.backend.stop()
+            await tokenizer.stop()
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.bench",
+        description="Benchmark iwaku hot paths against a local mongod with a synthetic chat corpus.",
+        epilog="_(:з」∠)_",
+    )
+
+    parser.add_argument("--backend", type=str, choices=["mongo", "sqlite"], help="history storage backend", default="mongo")
+    parser.add_argument("--uri", type=str, help="mongodb uri", default="mongodb://localhost:27017")
+    parser.add_argument("--db", type=str, help="scratch database, dropped unless --keep", default="whaleyeah_bench")
+    parser.add_argument("--sqlite-path", type=str, help="scratch sqlite database, removed unless --keep", default="whaleyeah_bench.sqlite3")
+    parser.add_argument("--keep", action="store_true", help="reuse the corpus already stored in the scratch database")
+    parser.add_argument("--sizes", type=int, nargs="+", help="corpus sizes, ascending runs grow the same corpus", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--modes", type=str, nargs="+", choices=["tokens", "text"], help="query modes", default=["tokens", "text"])
+    parser.add_argument("--queries", type=int, help="inline queries per mode and token class", default=200)
+    parser.add_argument("--ingest-samples", type=int, help="messages sent through the history handler per size", default=5000)
+    parser.add_argument("--ingest-chat", type=int, help="chat id of the ingestion samples, kept apart from the corpus", default=-1009999999999)
+    parser.add_argument("--cpu-samples", type=int, help="messages used by the cpu benchmarks", default=20000)
+    parser.add_argument("--workers", type=int, help="tokenizer worker processes", default=2)
+    parser.add_argument("--partition-by", type=str, choices=["month", "quarter"], help="partition the history collection")
+    parser.add_argument("--keep-raw-update", action="store_true", help="store the raw update json as well")
+    parser.add_argument("--seed", type=int, help="corpus seed", default=20261018)
+    parser.add_argument("-o", "--output", type=str, help="json result file, stdout if omitted")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="[%(levelname)s] %(asctime)s - %(name)s - %(message)s", level=logging.INFO,
+        datefmt="%Y-%m-%d %H:%M:%S", stream=sys.stderr,
+    )
+    jieba.setLogLevel(logging.WARNING)
+    jieba.initialize()
+
+    if args.backend=="sqlite" and "text" in args.modes:
+        # fts5 already is the text index
+        args.modes.remove("text")
+
+    init_storage({
+        "backend": args.backend,
+        "sqlite": {"path": args.sqlite_path},
+        "uri": args.uri,
+        "db_name": args.db,
+        "IWAKU_GROUP_ID": args.ingest_chat,
+        "use_text_search": "text" in args.modes,
+        "keep_raw_update": args.keep_raw_update,
+        "partitions": {"by": args.partition_by},
+    })
+    tokenizer.configure({"workers": args.workers})
+
+    bench = Bench(args)
+    asyncio.get_event_loop().run_until_complete(bench.run())
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "args": vars(args),
+        "results": bench.results,
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
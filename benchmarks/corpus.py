@@ -0,0 +1,106 @@
+# coding: utf-8
+import random
+
+from datetime import datetime, timedelta, timezone
+
+
+# word frequencies in chat follow a zipf-like distribution, the head is very common
+ZIPF_EXPONENT = 1.1
+
+CHINESE_WORDS = """
+    的 了 是 我 你 他 她 我们 你们 他们 这个 那个 什么 怎么 为什么 没有 不是 可以 就是 还是
+    已经 现在 今天 明天 昨天 晚上 早上 时候 东西 事情 问题 感觉 觉得 知道 喜欢 应该 可能 真的 其实 然后
+    但是 因为 所以 如果 虽然 一起 一下 一个 大家 自己 朋友 老师 学生 同学 公司 工作 上班 下班 加班 老板
+    吃饭 睡觉 游戏 电影 音乐 视频 图片 手机 电脑 键盘 显卡 系统 软件 服务器 数据库 代码 编译 部署 测试 文档
+    天气 下雨 好热 好冷 周末 假期 旅游 火车 飞机 地铁 外卖 奶茶 咖啡 火锅 烧烤 水果 蛋糕 面条 米饭 饺子
+    哈哈 哈哈哈 笑死 离谱 牛逼 厉害 好家伙 绝了 无语 卧槽 确实 有道理 不行 可以的 好的 收到 谢谢 辛苦 晚安 早安
+    鲸鱼 群主 管理员 机器人 消息 搜索 历史 记录 频道 群组 表情包 贴纸 语音 直播 投票 置顶 转发 回复 撤回 禁言
+    北京 上海 广州 深圳 杭州 成都 武汉 南京 西安 重庆 东京 大阪 香港 台北 新加坡 伦敦 纽约 巴黎 柏林 悉尼
+    学习 考试 论文 项目 需求 设计 产品 运营 市场 价格 便宜 太贵 打折 快递 包邮 下单 退款 客服 售后 发票
+    猫猫 狗狗 可爱 好看 难看 漂亮 帅气 开心 难过 生气 害怕 紧张 放心 担心 希望 记得 忘了 等等 马上 刚才
+""".split()
+
+ENGLISH_WORDS = """
+    the a is to and of in it you that for on with this lol ok yes no maybe
+    python rust golang docker kubernetes linux windows macos android ios github gitlab api bot telegram mongodb redis nginx
+    bug fix release update build deploy test merge commit branch issue review cpu gpu ram ssd cache latency
+    game steam switch ps5 xbox anime manga vtuber stream live chat meme emoji sticker thanks please sorry
+""".split()
+
+EMOJI = ["😂", "🤣", "👍", "🙏", "🐳", "😭", "🤔", "🎉", "❤️", "😅"]
+PUNCTUATION = ["，", "。", "！", "？", "～", "……", ",", ".", "!", "?"]
+
+NAMES = ["鲸鱼", "Alice", "小明", "Bob", "阿强", "Carol", "某人", "Dave", "咕咕", "Eve"]
+
+
+class Corpus:
+    """
+    Reproducible generator of mixed Chinese/English group chat messages.
+
+    Messages are built from a fixed vocabulary sampled with zipf-like
+    weights, mixed with english words, numbers, links and emoji, and have
+    a long-tailed length. The same seed always yields the same messages.
+    """
+
+    def __init__(self, seed: int=20261018, chat_id: int=-1001145141919810, english_ratio: float=0.15) -> None:
+        self.seed    = seed
+        self.chat_id = chat_id
+        self.english_ratio = english_ratio
+
+        # 10M messages span about ten years
+        self.start_date = datetime(2016, 10, 1, tzinfo=timezone.utc)
+        self.interval   = timedelta(seconds=30)
+
+        self.weights = [1/(k+1)**ZIPF_EXPONENT for k in range(len(CHINESE_WORDS))]
+        self.english_weights = [1/(k+1)**ZIPF_EXPONENT for k in range(len(ENGLISH_WORDS))]
+
+    def text(self, rng: random.Random) -> str:
+        length = max(1, min(80, int(rng.lognormvariate(1.6, 0.7))))
+        parts  = []
+
+        for _ in range(length):
+            dice = rng.random()
+            if dice<self.english_ratio:
+                parts.append(f" {rng.choices(ENGLISH_WORDS, self.english_weights)[0]} ")
+            elif dice<self.english_ratio+0.02:
+                parts.append(str(rng.randint(0, 2026)))
+            elif dice<self.english_ratio+0.03:
+                parts.append(rng.choice(EMOJI))
+            elif dice<self.english_ratio+0.08:
+                parts.append(rng.choice(PUNCTUATION))
+            else:
+                parts.append(rng.choices(CHINESE_WORDS, self.weights)[0])
+
+        if rng.random()<0.01:
+            parts.append(f" https://example.com/{rng.randint(0, 1<<20):x}")
+
+        return "".join(parts).strip()
+
+    def texts(self, count: int, start: int=0) -> list[str]:
+        return [self.text(random.Random(self.seed+k)) for k in range(start, start+count)]
+
+    def messages(self, count: int, start: int=0) -> list[dict]:
+        """
+        History fields of messages `start` to `start+count`, ids and dates count up.
+
+        Each message is generated from its own seeded rng, so any range can be
+        produced independently of the others.
+        """
+        results = []
+        for k in range(start, start+count):
+            rng = random.Random(self.seed+k)
+            results.append({
+                "from": 10000 + rng.randrange(len(NAMES)),
+                "chat": self.chat_id,
+                "mid": k+1,
+                "name": rng.choice(NAMES),
+                "text": self.text(rng),
+                "date": self.start_date + k*self.interval,
+            })
+        return results
+
+    def query_words(self, rng: random.Random, rare: bool) -> list[str]:
+        """One or two words of the vocabulary, drawn from the rare tail or the common head."""
+        pool = CHINESE_WORDS[len(CHINESE_WORDS)//2:] if rare else CHINESE_WORDS[10:40]
+        return rng.sample(pool, rng.choice([1, 2]))
+
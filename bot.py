@@ -2,7 +2,7 @@
 # coding: utf-8
 import argparse
 
-from whaleyeah import serve_config
+from whaleyeah import serve_config, run_maintenance
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser(
@@ -11,6 +11,25 @@ if __name__=="__main__":
         epilog="_(:з」∠)_",
     )
     parser.add_argument("-c", "--config", type=str, help="configuration json file", default="config.json")
+    parser.add_argument("--migrate-compact", action="store_true", help="convert legacy history documents into the compact schema and exit")
+    parser.add_argument("--dedupe-history", action="store_true", help="remove duplicated history documents and exit")
+    parser.add_argument("--ensure-indexes", action="store_true", help="create missing database indexes and exit")
+    parser.add_argument("--drop-unused-indexes", action="store_true", help="create missing and drop unlisted database indexes and exit")
+    parser.add_argument("--rebuild-postings", action="store_true", help="rebuild token posting lists from history and exit")
+    parser.add_argument("--rebuild-token-stats", action="store_true", help="recount token document frequencies from history and exit")
+    parser.add_argument("--apply-partition-policy", action="store_true", help="compress, archive or expire old history partitions and exit")
     args = parser.parse_args()
 
-    serve_config(args.config)
\ No newline at end of file
+    tasks = []
+    if args.migrate_compact: tasks.append("migrate_compact")
+    if args.dedupe_history: tasks.append("dedupe_history")
+    if args.ensure_indexes: tasks.append("ensure_indexes")
+    if args.drop_unused_indexes: tasks.append("drop_unused_indexes")
+    if args.rebuild_postings: tasks.append("rebuild_postings")
+    if args.rebuild_token_stats: tasks.append("rebuild_token_stats")
+    if args.apply_partition_policy: tasks.append("apply_partition_policy")
+
+    if tasks:
+        run_maintenance(args.config, tasks)
+    else:
+        serve_config(args.config)
\ No newline at end of file
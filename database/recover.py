@@ -2,112 +2,338 @@
 # coding: utf-8
 import argparse
 import asyncio
+import collections
 import ijson
+import itertools
 import json
 import logging
+import os
 import time
 
-import jieba
+from datetime import datetime, timezone
 
-from datetime import datetime
-
-from whaleyeah import init_database, mob, trim_tokens
-from telegram.ext import Application
+from whaleyeah import init_storage, mob, count_tokens, tokenizer, load_config
+from whaleyeah.database import history_partitions
 from telegram import Message, Update, Chat, User
 
-if __name__=="__main__":
-    parser = argparse.ArgumentParser(
-        prog="recover.py",
-        description="Recovery history from telegram dumped json.",
-        epilog="_(:з」∠)_",
-    )
 
-    parser.add_argument("-c", "--config", type=str, help="configuration json file", default="config.json")
-    parser.add_argument("-f", "--dump", type=str, help="telegram json dump file", default="result.json")
-    args = parser.parse_args()
+PARSE_CHUNK_SIZE = 2000  # messages handed to the tokenizer at once
+WRITE_BATCH_SIZE = 1000  # documents per insert_many
+QUEUE_SIZE       = 4     # chunks buffered between stages, bounds memory usage
 
-    with open(args.config, "r", encoding="utf-8") as f:
-        config = json.load(f)
+logger = logging.getLogger(__name__)
 
 
-    if "log_level" not in config: config["log_level"] = "info"
+def plain_text(text: str | list) -> str:
+    # rich messages are exported as a list of plain strings and entity dicts
+    if isinstance(text, str): return text
+    return "".join(v if isinstance(v, str) else v.get("text", "") for v in text)
 
-    logging.basicConfig(
-        format="[%(levelname)s] %(asctime)s - %(name)s - %(message)s", level=logging.getLevelName(config["log_level"].upper()),
-        datefmt="%Y-%m-%d %H:%M:%S",
-    )
-    logging.getLogger("httpx").setLevel(logging.WARNING)
-    logger = logging.getLogger(__name__)
-    jieba.setLogLevel(logger.getEffectiveLevel())
+def sender_id(from_id: str) -> int:
+    if from_id.startswith("user"): return int(from_id[4:])
+    if from_id.startswith("channel"): return int(f"-100{from_id[7:]}")
+    return int(from_id)
 
+def message_date(msg: dict) -> datetime:
+    return datetime.fromtimestamp(float(msg["date_unixtime"]), tz=timezone.utc)
 
-    init_database(config["database"])
-    bot = Application.builder().token(config["token"]).build().bot
+def parse_date(value: str) -> datetime:
+    date = datetime.fromisoformat(value)
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
 
 
-    confirm = (input("WARNING: Do you want to DROP ALL the history in the database! [Y/N]")).strip().upper()
-    if confirm=="Y":
-        asyncio.run(mob.history.drop())
+class Checkpoint:
+    """
+    Position in a dump up to which every message has been written.
 
+    Chunks are written out of order by concurrent writers, the position only
+    moves past a chunk once all of its batches are stored. It is kept in a
+    small json file next to the dump, and is discarded when the dump file or
+    the imported date range changes.
+    """
 
-    with open(args.dump, "r", encoding="utf-8") as f:
-        chat_id  = next(ijson.items(f, "id"))
+    def __init__(self, path: str, key: dict) -> None:
+        self.path     = path
+        self.key      = key
+        self.position = 0
+        self.finished = False
 
-    f = open(args.dump, "r", encoding="utf-8")
-    messages = ijson.items(f, "messages.item")
-    
-    count = 0
-    lastt = 0
+        self._chunks: dict[int, list[int]] = {} # start -> [end, unwritten batches]
 
-    for msg in messages:
+    def load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
 
-        count += 1
-        currt = time.time()
-        if currt-lastt>1:
-            logger.info(f"parsed {count:8d} records...")
-            lastt = currt
+        if saved.get("key")==self.key:
+            self.position = saved["position"]
+            self.finished = saved["finished"]
 
-        if "forwarded_from" in msg: continue
-        try:
-            obj = Update(
+    def save(self) -> None:
+        with open(f"{self.path}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"key": self.key, "position": self.position, "finished": self.finished}, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def begin(self, start: int, end: int, batches: int) -> None:
+        self._chunks[start] = [end, batches]
+        if batches==0: self._advance()
+
+    def written(self, start: int) -> None:
+        self._chunks[start][1] -= 1
+        self._advance()
+
+    def finish(self) -> None:
+        self.finished = True
+        self.save()
+
+    def _advance(self) -> None:
+        position = self.position
+        while self.position in self._chunks and self._chunks[self.position][1]==0:
+            self.position = self._chunks.pop(self.position)[0]
+        if self.position!=position: self.save()
+
+
+class Importer:
+    def __init__(self, dump: str, chat_id: int, writers: int=2, since: datetime | None=None, until: datetime | None=None, rejects: str | None=None) -> None:
+        self.dump    = dump
+        self.chat_id = chat_id
+        self.writers = writers
+        self.since   = since
+        self.until   = until
+        self.rejects = rejects
+
+        stat = os.stat(dump)
+        self.checkpoint = Checkpoint(f"{dump}.checkpoint", {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "since": since and since.isoformat(),
+            "until": until and until.isoformat(),
+        })
+
+        self.parsed   = 0
+        self.written  = 0
+        self.existing = 0
+        self.skipped  = 0
+        self.rejected = 0
+        self.start_time = time.monotonic()
+
+    def history_doc(self, msg: dict, text: str, seg: list[str]) -> dict:
+        date = message_date(msg)
+        tokens, tf = count_tokens(seg)
+
+        mob_doc = {
+            "from": sender_id(msg["from_id"]),
+            "chat": self.chat_id,
+            "mid": msg["id"],
+            "name": msg.get("from") or "",
+            "text": text,
+            "date": date,
+            "tokens": tokens,
+            "tf": tf,
+            "len": sum(tf),
+        }
+
+        if mob.keep_raw_update:
+            mob_doc["json"] = Update(
                 msg["id"],
                 Message(
                     message_id=msg["id"],
-                    date=datetime.fromtimestamp(float(msg["date_unixtime"])),
-                    chat=Chat(
-                        chat_id,
-                        msg["type"],
-                    ),
-                    from_user=User(id=int(msg["from_id"][4:]), first_name=msg["from"], is_bot=False),
-                    reply_to_message=None if "reply_to_message_id" not in msg else Message(
-                        message_id=msg["reply_to_message_id"],
-                        date=datetime.fromtimestamp(float(msg["date_unixtime"])),
-                        chat=Chat(
-                            chat_id,
-                            msg["type"],
-                        ),
-                    ),
-                    text=msg["text"],
+                    date=date,
+                    chat=Chat(self.chat_id, msg["type"]),
+                    from_user=User(id=mob_doc["from"], first_name=mob_doc["name"], is_bot=False),
+                    text=text,
                 ),
-            )
-            # logger.info(obj)
-
-            seg = jieba.cut_for_search(msg["text"])
-            seg = [v for v in seg]
-
-            mob_doc = {
-                "from": obj.message.from_user.id,
-                "chat": chat_id,
-                "mid": msg["id"],
-                "text": msg["text"],
-                "date": obj.message.date,
-                "json": obj.to_json(),
-                "tokens": trim_tokens(seg),
-            }
-            asyncio.run(mob.history.insert_one(mob_doc))
-        except:
-            pass
-
-
-    # asyncio.run(mob.database.)
-    f.close()
\ No newline at end of file
+            ).to_json()
+
+        return mob_doc
+
+
+    def reject(self, mid: int | None, reason: str, record: dict) -> None:
+        """Appends a record which could not be imported to the rejects file."""
+        self.rejected += 1
+        logger.debug(f"rejected message {mid}: {reason}")
+        if not self.rejects: return
+
+        with open(self.rejects, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"dump": self.dump, "mid": mid, "reason": reason, "record": record}, ensure_ascii=False, default=str) + "\n")
+
+    def in_range(self, msg: dict) -> bool:
+        date = message_date(msg)
+        return (self.since is None or date>=self.since) and (self.until is None or date<self.until)
+
+
+    async def read(self, parsed: asyncio.Queue) -> None:
+        with open(self.dump, "rb") as f:
+            messages = ijson.items(f, "messages.item")
+
+            # messages before the checkpoint are parsed but not looked at again
+            position = self.checkpoint.position
+            await asyncio.to_thread(collections.deque, itertools.islice(messages, position), 0)
+
+            while chunk := await asyncio.to_thread(list, itertools.islice(messages, PARSE_CHUNK_SIZE)):
+                self.parsed += len(chunk)
+                await parsed.put((position, chunk))
+                position += len(chunk)
+
+    async def select(self, messages: list[dict]) -> list[tuple[dict, str]]:
+        """Plain text of the messages in the date range which are not stored yet."""
+        chunk = []
+        for msg in messages:
+            try:
+                text = plain_text(msg.get("text", ""))
+                if msg.get("type")=="message" and "forwarded_from" not in msg and text and self.in_range(msg):
+                    chunk.append((msg, text))
+                else:
+                    self.skipped += 1
+            except Exception as e:
+                self.reject(msg.get("id"), f"malformed message: {e}", msg)
+
+        # re-runs skip stored messages before paying for tokenization
+        mids = [msg.get("id") for (msg, _) in chunk]
+        existing = await mob.backend.existing(self.chat_id, mids) if mids else set()
+        self.existing += len(existing)
+
+        return [(msg, text) for (msg, text) in chunk if msg.get("id") not in existing]
+
+    async def tokenize(self, parsed: asyncio.Queue, ready: asyncio.Queue) -> None:
+        while (item := await parsed.get()) is not None:
+            (start, messages) = item
+
+            chunk = await self.select(messages)
+            segs = await tokenizer.lcut_for_search_many([text for (_, text) in chunk])
+
+            docs = []
+            for ((msg, text), seg) in zip(chunk, segs):
+                try:
+                    docs.append(self.history_doc(msg, text, seg))
+                except Exception as e:
+                    self.reject(msg.get("id"), f"malformed message: {e}", msg)
+
+            batches = [docs[k:k+WRITE_BATCH_SIZE] for k in range(0, len(docs), WRITE_BATCH_SIZE)]
+            self.checkpoint.begin(start, start+len(messages), len(batches))
+            for batch in batches:
+                await ready.put((start, batch))
+
+    async def write(self, ready: asyncio.Queue) -> None:
+        while (item := await ready.get()) is not None:
+            (start, docs) = item
+
+            inserted, duplicates, errors = await mob.backend.insert(docs)
+            self.written  += len(inserted)
+            self.existing += len(duplicates)
+            for (doc, errmsg) in errors:
+                self.reject(doc["mid"], errmsg, {k: v for (k, v) in doc.items() if k not in ("tokens", "tf", "json")})
+
+            self.checkpoint.written(start)
+
+    async def drive(self, parsed: asyncio.Queue, ready: asyncio.Queue, tokenizers: list[asyncio.Task], writers: list[asyncio.Task]) -> None:
+        """Reads the dump, then stops the tokenizers and the writers once their queues are drained."""
+        await self.read(parsed)
+
+        for _ in tokenizers: await parsed.put(None)
+        await asyncio.gather(*tokenizers)
+
+        for _ in writers: await ready.put(None)
+
+    async def report(self) -> None:
+        while True:
+            await asyncio.sleep(1)
+            self.log_progress()
+
+    def log_progress(self) -> None:
+        elapsed = time.monotonic() - self.start_time
+        logger.info(
+            f"parsed {self.parsed:8d}, written {self.written:8d}, existing {self.existing:8d}, "
+            f"skipped {self.skipped:8d}, rejected {self.rejected:8d} records ({self.written/elapsed:.0f} msg/s)"
+        )
+
+
+    async def run(self) -> None:
+        self.checkpoint.load()
+        if self.checkpoint.finished:
+            logger.info(f"{self.dump} is already imported, skipped")
+            return
+        if self.checkpoint.position>0:
+            logger.info(f"resuming {self.dump} after {self.checkpoint.position} records")
+
+        parsed = asyncio.Queue(maxsize=QUEUE_SIZE)
+        ready  = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+        reporter = asyncio.create_task(self.report())
+        try:
+            # a failing stage cancels the others, which would otherwise wait on the queues forever
+            async with asyncio.TaskGroup() as stages:
+                tokenizers = [stages.create_task(self.tokenize(parsed, ready)) for _ in range(max(1, tokenizer.workers))]
+                writers    = [stages.create_task(self.write(ready)) for _ in range(self.writers)]
+                stages.create_task(self.drive(parsed, ready, tokenizers, writers))
+        except ExceptionGroup as e:
+            raise e.exceptions[0]
+        finally:
+            reporter.cancel()
+
+        self.checkpoint.finish()
+        self.log_progress()
+
+
+async def main(args: argparse.Namespace, config: dict) -> None:
+    tokenizer.configure(config.get("tokenizer", {}))
+    tokenizer.start()
+
+    await mob.backend.start()
+    # the unique (chat, mid) index keeps re-imported messages out
+    await mob.backend.reconcile()
+
+    try:
+        for dump in args.dump:
+            with open(dump, "rb") as f:
+                chat_id = next(ijson.items(f, "id"))
+
+            # supergroup exports omit the -100 prefix of the bot api id
+            if str(mob.GROUP_ID).endswith(str(chat_id)):
+                chat_id = mob.GROUP_ID
+
+            rejects = args.rejects or f"{dump}.rejects.jsonl"
+            await Importer(dump, chat_id, args.writers, args.since, args.until, rejects).run()
+    finally:
+        await mob.backend.stop()
+        await tokenizer.stop()
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(
+        prog="recover.py",
+        description="Recovery history from telegram dumped json.",
+        epilog="_(:з」∠)_",
+    )
+
+    parser.add_argument("-c", "--config", type=str, help="configuration json file", default="config.json")
+    parser.add_argument("-f", "--dump", type=str, nargs="+", help="telegram json dump files", default=["result.json"])
+    parser.add_argument("-w", "--writers", type=int, help="concurrent write batches", default=2)
+    parser.add_argument("--since", type=parse_date, help="only import messages from this date on (ISO 8601, UTC unless given)")
+    parser.add_argument("--until", type=parse_date, help="only import messages before this date (ISO 8601, UTC unless given)")
+    parser.add_argument("--rejects", type=str, help="jsonl file for records which could not be imported, defaults to <dump>.rejects.jsonl")
+    parser.add_argument("--drop", action="store_true", help="drop all the history before importing")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    init_storage(config["database"])
+    loop = asyncio.get_event_loop()
+
+
+    if args.drop:
+        confirm = (input("WARNING: Do you want to DROP ALL the history in the database! [Y/N]")).strip().upper()
+        if confirm!="Y": exit(1)
+
+        if mob.backend.name=="mongo":
+            for collection in loop.run_until_complete(history_partitions()) + [mob.history_raw, mob.tokens, mob.token_stats]:
+                loop.run_until_complete(collection.drop())
+        else:
+            for path in [mob.backend.path, f"{mob.backend.path}-wal", f"{mob.backend.path}-shm"]:
+                if os.path.exists(path): os.remove(path)
+        # checkpoints refer to the dropped history
+        for dump in args.dump:
+            if os.path.exists(f"{dump}.checkpoint"): os.remove(f"{dump}.checkpoint")
+
+    loop.run_until_complete(main(args, config))
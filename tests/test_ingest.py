@@ -0,0 +1,33 @@
+import asyncio
+
+from whaleyeah.database import mob
+from whaleyeah.ingest import HistoryWriter
+
+
+class SlowBackend:
+    """Stores inserted documents after a delay, long enough to stop the writer meanwhile."""
+
+    def __init__(self) -> None:
+        self.stored = []
+
+    async def insert(self, docs: list[dict]):
+        await asyncio.sleep(0.2)
+        self.stored += docs
+        return docs, [], []
+
+
+def test_stop_during_flush_keeps_the_batch():
+    async def run():
+        mob.backend = SlowBackend()
+        writer = HistoryWriter(max_batch=2, max_delay=0.05)
+        writer.start()
+
+        for mid in range(3): await writer.put({"chat": 1, "mid": mid})
+        # the first two documents are being flushed in the background
+        await asyncio.sleep(0.05)
+        await writer.stop()
+
+        assert sorted(v["mid"] for v in mob.backend.stored) == [0, 1, 2]
+        assert (writer.depth, writer.stats()["flushed"]) == (0, 3)
+
+    asyncio.run(run())
@@ -0,0 +1,58 @@
+import asyncio
+
+from datetime import datetime
+
+from telegram import Chat, Message, MessageEntity, PhotoSize, Update, User
+from telegram.ext import ApplicationBuilder, CallbackContext, CommandHandler
+
+from whaleyeah.router import Router
+
+
+BOT_USER = User(1, "whaleyeah", True, username="whaleyeah_bot")
+
+
+def dispatch(router: Router, **message) -> None:
+    async def run():
+        app = ApplicationBuilder().token("1:test").build()
+        app.bot._bot_user = BOT_USER
+
+        msg = Message(1, datetime.now(), Chat(-1001, "supergroup"), from_user=User(2, "tester", False), **message)
+        msg.set_bot(app.bot)
+        update = Update(1, message=msg)
+        update.set_bot(app.bot)
+
+        await router.dispatch(update, CallbackContext.from_update(update, app))
+
+    asyncio.run(run())
+
+def recording_router() -> tuple[Router, list]:
+    seen = []
+
+    async def command(update, context): seen.append(("openai", context.args))
+    async def history(update, context): seen.append(("history", None))
+
+    router = Router()
+    router.add_command(CommandHandler("openai", command))
+    router.history = history
+    return router, seen
+
+
+def test_text_command():
+    router, seen = recording_router()
+    dispatch(router, text="/openai@whaleyeah_bot hello there", entities=[MessageEntity("bot_command", 0, 21)])
+    assert seen == [("openai", ["hello", "there"])]
+
+def test_command_of_another_bot_is_ignored():
+    router, seen = recording_router()
+    dispatch(router, text="/openai@other_bot hello", entities=[MessageEntity("bot_command", 0, 17)])
+    assert seen == []
+
+def test_caption_command():
+    router, seen = recording_router()
+    dispatch(
+        router,
+        photo=[PhotoSize("file", "unique", 1, 1)],
+        caption="/openai what is this",
+        caption_entities=[MessageEntity("bot_command", 0, 7)],
+    )
+    assert seen == [("openai", ["what", "is", "this"])]
@@ -0,0 +1,102 @@
+import asyncio
+import os
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+from whaleyeah.database import mob
+from whaleyeah.storage import HistoryBackend, init_storage
+from whaleyeah.tokenstats import QueryPlan
+
+
+MONGO_URI = os.environ.get("WHALEYEAH_TEST_MONGO_URI", "mongodb://localhost:27017")
+MONGO_DB  = "whaleyeah_test"
+CHAT_ID   = -1001
+
+
+def mongo_available() -> bool:
+    try:
+        MongoClient(MONGO_URI, serverSelectionTimeoutMS=500).admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+
+
+def history_doc(mid: int, tokens: list[str]) -> dict:
+    return {
+        "from": 1, "chat": CHAT_ID, "mid": mid, "name": "tester", "text": " ".join(tokens),
+        "date": datetime(2026, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=mid),
+        "tokens": tokens, "tf": [1]*len(tokens), "len": len(tokens),
+    }
+
+
+async def open_backend(kind: str, tmp_path) -> HistoryBackend:
+    init_storage({
+        "backend": kind,
+        "sqlite": {"path": str(tmp_path/"history.sqlite3")},
+        "uri": MONGO_URI,
+        "db_name": MONGO_DB,
+        "IWAKU_GROUP_ID": CHAT_ID,
+    })
+    if kind=="mongo": await mob.database.client.drop_database(MONGO_DB)
+
+    await mob.backend.start()
+    await mob.backend.reconcile()
+    return mob.backend
+
+async def close_backend(backend: HistoryBackend) -> None:
+    if backend.name=="mongo": await mob.database.client.drop_database(MONGO_DB)
+    await backend.stop()
+
+
+@pytest.fixture(params=[
+    "sqlite",
+    pytest.param("mongo", marks=pytest.mark.skipif(not mongo_available(), reason="no mongod at WHALEYEAH_TEST_MONGO_URI")),
+])
+def kind(request) -> str:
+    return request.param
+
+
+def test_incomplete_backend_cannot_be_created():
+    class Incomplete(HistoryBackend):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_insert_search_and_paging(kind, tmp_path):
+    async def run():
+        backend = await open_backend(kind, tmp_path)
+        try:
+            docs = [history_doc(mid, ["鲸鱼", "yeah"] if mid%2 else ["鲸鱼"]) for mid in range(1, 8)]
+            inserted, duplicates, errors = await backend.insert(docs)
+            assert (len(inserted), duplicates, errors) == (7, [], [])
+
+            # re-delivered updates are reported as already stored
+            inserted, duplicates, _ = await backend.insert(docs[:2])
+            assert (inserted, len(duplicates)) == ([], 2)
+            assert await backend.existing(CHAT_ID, [1, 2, 99]) == {1, 2}
+
+            plan = QueryPlan("tokens", ["鲸鱼", "yeah"], [])
+            assert await backend.count(plan, limit=100) == 4
+            assert await backend.count(plan, limit=2) == 3
+
+            # newest first, the next page continues after the keyset position of the last result
+            first = await backend.search(plan, limit=2)
+            assert [v["mid"] for v in first] == [7, 5]
+
+            after = backend.decode_offset(backend.encode_offset(first[-1]))
+            second = await backend.search(plan, limit=2, after=after)
+            assert [v["mid"] for v in second] == [3, 1]
+            assert await backend.search(plan, limit=2, skip=2) == second
+
+            assert await backend.search(QueryPlan("tokens", ["不存在"], []), limit=2) == []
+        finally:
+            await close_backend(backend)
+
+    asyncio.run(run())
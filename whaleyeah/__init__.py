@@ -1,3 +1,7 @@
-from .server import serve_config
-from .database import init_database, mob
-from .iwaku import trim_tokens
\ No newline at end of file
+from .server import serve_config, load_config
+from .database import init_database, reconcile_indexes, mob
+from .storage import init_storage
+from .iwaku import trim_tokens, count_tokens
+from .ingest import write_history
+from .tokenizer import tokenizer
+from .maintenance import run_maintenance
\ No newline at end of file
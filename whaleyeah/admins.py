@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import time
+
+from collections import OrderedDict
+
+from telegram import Bot
+from telegram.ext import CallbackContext
+
+
+logger = logging.getLogger(__name__)
+
+
+class AdminCache:
+    """
+    Shared cache of chat administrator ids.
+
+    Entries expire after `ttl` seconds but are still served while a refresh
+    runs in the background, concurrent lookups of the same chat share one
+    `get_chat_administrators` call, and at most `max_chats` chats are kept.
+    Watched chats are refreshed by a repeating job so lookups rarely reach
+    the Bot API at all.
+    """
+
+    def __init__(self, ttl: float=600, error_ttl: float=30, max_chats: int=256) -> None:
+        self.ttl       = ttl
+        self.error_ttl = error_ttl
+        self.max_chats = max_chats
+
+        self._cache: OrderedDict[int, tuple[frozenset[int], float]] = OrderedDict()
+        self._inflight: dict[int, asyncio.Task] = {}
+        self._watched: set[int] = set()
+
+    def configure(self, config: dict) -> None:
+        self.ttl       = float(config.get("ttl", self.ttl))
+        self.error_ttl = float(config.get("error_ttl", self.error_ttl))
+        self.max_chats = int(config.get("max_chats", self.max_chats))
+
+    def watch(self, chat_ids: list[int]) -> None:
+        self._watched.update(chat_ids)
+
+
+    async def get(self, bot: Bot, chat_id: int) -> frozenset[int]:
+        if chat_id in self._cache:
+            admins, expire = self._cache[chat_id]
+            self._cache.move_to_end(chat_id)
+            if expire<time.monotonic(): self._fetch(bot, chat_id)
+            return admins
+
+        return await asyncio.shield(self._fetch(bot, chat_id))
+
+    async def is_admin(self, bot: Bot, user_id: int, chat_ids: list[int]) -> bool:
+        for chat_id in chat_ids:
+            if user_id in await self.get(bot, chat_id):
+                return True
+        return False
+
+
+    def _fetch(self, bot: Bot, chat_id: int) -> asyncio.Task:
+        if chat_id not in self._inflight:
+            self._inflight[chat_id] = asyncio.create_task(self._load(bot, chat_id), name=f"AdminCache-{chat_id}")
+        return self._inflight[chat_id]
+
+    async def _load(self, bot: Bot, chat_id: int) -> frozenset[int]:
+        try:
+            try:
+                xx = await bot.get_chat_administrators(chat_id=chat_id)
+                admins, ttl = frozenset(it.user.id for it in xx or []), self.ttl
+            except Exception as e:
+                logger.warning(f"failed to get admin list of {chat_id}: {e}")
+                # keep serving a stale list, or cache the failure briefly
+                admins = self._cache[chat_id][0] if chat_id in self._cache else frozenset()
+                ttl = self.error_ttl
+
+            self._cache[chat_id] = (admins, time.monotonic()+ttl)
+            self._cache.move_to_end(chat_id)
+            while len(self._cache)>self.max_chats:
+                self._cache.popitem(last=False)
+        finally:
+            self._inflight.pop(chat_id, None)
+
+        return admins
+
+    async def refresh(self, ctx: CallbackContext) -> None:
+        await asyncio.gather(*[self._fetch(ctx.bot, chat_id) for chat_id in self._watched | set(self._cache)])
+
+
+admin_cache = AdminCache()
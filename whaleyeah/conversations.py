@@ -0,0 +1,375 @@
+import asyncio
+import logging
+import time
+
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from .database import mob
+from .metrics import Counter, Gauge
+
+
+logger = logging.getLogger(__name__)
+
+# rough per object overhead of dicts, lists and models in a conversation
+OBJECT_OVERHEAD = 64
+# tokens billed for an inline image, whatever its size
+IMAGE_TOKENS = 258
+
+
+def estimate_tokens(text: str) -> int:
+    """About 4 ascii characters per token, one per CJK or other character."""
+    ascii = len(text.encode("ascii", errors="ignore"))
+    return (ascii+3)//4 + len(text)-ascii
+
+def measure(value) -> tuple[int, int]:
+    """Estimated (bytes, tokens) of a message, inline images count as their raw size."""
+    if value is None:
+        return 0, 0
+    if isinstance(value, str):
+        return len(value.encode()), estimate_tokens(value)
+    if isinstance(value, (bytes, bytearray)):
+        return len(value), IMAGE_TOKENS
+    if isinstance(value, (int, float, bool)):
+        return 8, 0
+
+    if isinstance(value, dict):
+        items = [v for pair in value.items() for v in pair]
+    elif isinstance(value, (list, tuple)):
+        items = value
+    elif hasattr(value, "__dict__"):
+        # genai contents are pydantic models
+        items = list(vars(value).values())
+    else:
+        return OBJECT_OVERHEAD, 0
+
+    size, tokens = OBJECT_OVERHEAD, 0
+    for item in items:
+        s, t = measure(item)
+        size, tokens = size+s, tokens+t
+    return size, tokens
+
+
+class Turn:
+    """
+    Immutable node of a conversation tree.
+
+    Each turn holds one message and points at the turn before it, so replies
+    to the same bot message branch off a shared prefix and storing a turn
+    costs one node. `bytes` and `tokens` are cumulative over the path, the
+    message list is only built when a request needs it. Only `key` is set
+    later, once the turn is stored as the end of a conversation.
+    """
+
+    __slots__ = ("parent", "message", "depth", "bytes", "tokens", "key")
+
+    def __init__(self, parent: "Turn | None", message) -> None:
+        size, tokens = measure(message)
+        self.parent  = parent
+        self.message = message
+        self.depth   = parent.depth+1 if parent else 1
+        self.bytes   = parent.bytes+size if parent else size
+        self.tokens  = parent.tokens+tokens if parent else tokens
+        self.key: str | None = None
+
+    @staticmethod
+    def extend(turn: "Turn | None", messages: list) -> "Turn | None":
+        for message in messages:
+            turn = Turn(turn, message)
+        return turn
+
+    def messages(self) -> list:
+        messages = [None] * self.depth
+        turn = self
+        while turn:
+            messages[turn.depth-1] = turn.message
+            turn = turn.parent
+        return messages
+
+
+def conversation_key(message) -> str:
+    """Store key of the conversation a bot message ends."""
+    return f"{message.chat_id}<-{message.id}"
+
+
+class ConversationWriter:
+    """
+    Write-behind buffer of persisted conversations.
+
+    Stored conversations are queued as documents and upserted by the storage
+    backend in one batch once `max_batch` are pending or the oldest one has
+    waited `max_delay` seconds. Batches which cannot be written are dropped,
+    the conversations are still kept in memory.
+    """
+
+    def __init__(self, max_batch: int=100, max_delay: float=2.0) -> None:
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self._pending: dict[tuple[str, str], dict] = {}
+        self._inflight: dict[tuple[str, str], dict] = {}
+        self._oldest = 0.0
+
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+        self.written = 0
+        self.dropped = 0
+
+    def configure(self, config: dict) -> None:
+        self.max_batch = int(config.get("max_batch", self.max_batch))
+        self.max_delay = float(config.get("max_delay", self.max_delay))
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    def pending(self, namespace: str, id: str) -> dict | None:
+        """Document of a conversation which is not written yet."""
+        key = (namespace, id)
+        return self._pending.get(key) or self._inflight.get(key)
+
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._task = asyncio.create_task(self._run(), name="ConversationWriter")
+
+    async def stop(self) -> None:
+        if self._task is None: return
+
+        # cancelling would lose a batch in flight, let a running flush finish instead
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+        await self.flush()
+        logger.info(f"conversation writer stopped: {self.written} written, {self.dropped} dropped")
+
+
+    def put(self, doc: dict) -> None:
+        if not self._pending: self._oldest = time.monotonic()
+        self._pending[(doc["ns"], doc["key"])] = doc
+        if self.depth >= self.max_batch: self._wakeup.set()
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._pending: return
+
+            self._inflight, self._pending = self._pending, {}
+            docs = list(self._inflight.values())
+            try:
+                await mob.backend.save_conversations(docs)
+                self.written += len(docs)
+            except Exception as e:
+                self.dropped += len(docs)
+                logger.warning(f"failed to write {len(docs)} conversations: {e}")
+            finally:
+                self._inflight = {}
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._stopping: break
+
+            if self._pending and (self.depth>=self.max_batch or time.monotonic()-self._oldest>=self.max_delay):
+                await self.flush()
+
+
+class ConversationStore:
+    """
+    LRU store of LLM conversations shared by the chat plugins.
+
+    Conversations are the last `Turn` of each bot reply, keyed by plugin
+    namespace and `conversation_key`. An entry is charged the size of its
+    whole path, an upper bound since branches share their prefix, and the
+    least recently used entries are evicted while the store exceeds
+    `max_entries`, `max_bytes` or `max_tokens`, or a namespace exceeds its
+    own `memory_size`. A None budget is unbounded.
+
+    With `persist`, each stored conversation is also written behind to the
+    storage backend as the messages it adds to its parent conversation, and
+    `recall` reloads evicted or pre-restart conversations on demand. They
+    expire `ttl` seconds after they were last continued.
+    """
+
+    def __init__(self, max_entries: int | None=1024, max_bytes: int | None=64<<20, max_tokens: int | None=None) -> None:
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self.max_tokens  = max_tokens
+        self.persist     = False
+        self.ttl         = 7*86400.0
+
+        self._entries: OrderedDict[tuple[str, str], Turn] = OrderedDict()
+        self._limits: dict[str, int] = {}
+        self._counts: dict[str, int] = {}
+        self._codecs: dict[str, tuple] = {} # namespace -> (dump, load)
+
+        self.bytes     = 0
+        self.tokens    = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.reloads   = 0
+
+    def configure(self, config: dict) -> None:
+        self.max_entries = config.get("max_entries", self.max_entries)
+        self.max_bytes   = config.get("max_bytes", self.max_bytes)
+        self.max_tokens  = config.get("max_tokens", self.max_tokens)
+        self.persist     = bool(config.get("persist", self.persist))
+        self.ttl         = float(config.get("ttl", self.ttl))
+        conversation_writer.configure(config)
+
+    def limit(self, namespace: str, max_entries: int) -> None:
+        """Caps the conversations kept by one plugin."""
+        self._limits[namespace] = int(max_entries)
+
+    def codec(self, namespace: str, dump, load) -> None:
+        """Converts the messages of a plugin from and to json-like documents for persistence."""
+        self._codecs[namespace] = (dump, load)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: tuple[str, str]) -> bool:
+        return key in self._entries
+
+
+    def get(self, namespace: str, id: str) -> Turn | None:
+        turn = self._entries.get((namespace, id))
+        if turn is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end((namespace, id))
+        return turn
+
+    async def recall(self, namespace: str, id: str) -> Turn | None:
+        """`get` falling back to the persisted conversation, which is reloaded with its ancestors."""
+        turn = self.get(namespace, id)
+        if turn is not None or not self.persist: return turn
+
+        doc = conversation_writer.pending(namespace, id)
+        if doc is None:
+            try:
+                doc = await mob.backend.load_conversation(namespace, id)
+            except Exception as e:
+                logger.warning(f"failed to load conversation {namespace}:{id}: {e}")
+                return None
+            if doc is None: return None
+
+        parent = None
+        if doc["parent"]:
+            parent = await self.recall(namespace, doc["parent"])
+            # an expired ancestor ends the conversation
+            if parent is None: return None
+
+        load = self._codecs.get(namespace, (None, None))[1]
+        turn = Turn.extend(parent, [load(v) if load else v for v in doc["messages"]])
+        turn.key = id
+        self.put(namespace, id, turn)
+        self.reloads += 1
+        return turn
+
+    def put(self, namespace: str, id: str, turn: Turn) -> None:
+        key = (namespace, id)
+        if key in self._entries: self._remove(key)
+
+        if turn.key is None:
+            if self.persist: conversation_writer.put(self._document(namespace, id, turn))
+            turn.key = id
+
+        self._entries[key] = turn
+        self._counts[namespace] = self._counts.get(namespace, 0) + 1
+        self.bytes  += turn.bytes
+        self.tokens += turn.tokens
+
+        self._evict(namespace)
+
+    def pop(self, namespace: str, id: str) -> Turn | None:
+        key = (namespace, id)
+        return self._remove(key) if key in self._entries else None
+
+
+    def _document(self, namespace: str, id: str, turn: Turn) -> dict:
+        """The messages `turn` adds to its stored parent conversation, and the keys of all of its ancestors."""
+        messages, path = [], []
+        while turn and turn.key is None:
+            messages.append(turn.message)
+            turn = turn.parent
+        parent = turn.key if turn else None
+
+        while turn:
+            if turn.key is not None: path.append(turn.key)
+            turn = turn.parent
+
+        dump = self._codecs.get(namespace, (None, None))[0]
+        return {
+            "ns": namespace,
+            "key": id,
+            "parent": parent,
+            "messages": [dump(v) if dump else v for v in reversed(messages)],
+            "expire": datetime.now(timezone.utc) + timedelta(seconds=self.ttl),
+            "path": path,
+        }
+
+    def _remove(self, key: tuple[str, str]) -> Turn:
+        turn = self._entries.pop(key)
+        self._counts[key[0]] -= 1
+        self.bytes  -= turn.bytes
+        self.tokens -= turn.tokens
+        return turn
+
+    def _evict(self, namespace: str) -> None:
+        limit = self._limits.get(namespace)
+        if limit is not None and self._counts[namespace]>limit:
+            # oldest entry of the namespace, the store is in lru order
+            victim = next(key for key in self._entries if key[0]==namespace)
+            self._evict_one(victim, "namespace")
+
+        while self._entries:
+            if self.max_entries is not None and len(self._entries)>self.max_entries: reason = "entries"
+            elif self.max_bytes is not None and self.bytes>self.max_bytes: reason = "bytes"
+            elif self.max_tokens is not None and self.tokens>self.max_tokens: reason = "tokens"
+            else: break
+            self._evict_one(next(iter(self._entries)), reason)
+
+    def _evict_one(self, key: tuple[str, str], reason: str) -> None:
+        turn = self._remove(key)
+        self.evictions += 1
+        self.evicted_bytes += turn.bytes
+        EVICTIONS.inc(reason)
+        logger.debug(f"evicted conversation {key} of {turn.bytes} bytes ({reason})")
+
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "tokens": self.tokens,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "evicted_bytes": self.evicted_bytes,
+            "reloads": self.reloads,
+            "namespaces": {k: v for (k, v) in self._counts.items() if v},
+        }
+
+
+conversation_writer = ConversationWriter()
+conversation_store  = ConversationStore()
+
+EVICTIONS = Counter("whaleyeah_conversation_evictions_total", "Conversations evicted from the LLM conversation store.", ("reason",))
+Gauge("whaleyeah_conversations", "Conversations kept by the LLM plugins.", lambda: len(conversation_store))
+Gauge("whaleyeah_conversation_bytes", "Estimated size of the kept LLM conversations.", lambda: conversation_store.bytes)
+Gauge("whaleyeah_conversation_tokens", "Estimated tokens of the kept LLM conversations.", lambda: conversation_store.tokens)
+Gauge("whaleyeah_conversation_writer_depth", "Conversations waiting for the write-behind flush.", lambda: conversation_writer.depth)
@@ -1,17 +1,32 @@
 import asyncio
 import logging
+import re
+import time
+
+from datetime import datetime, timezone
+
+from pymongo import IndexModel, ASCENDING, DESCENDING, TEXT
 
 from motor.motor_asyncio import AsyncIOMotorClient
 from motor.motor_asyncio import AsyncIOMotorDatabase, AsyncIOMotorCollection
 
+from .metrics import MongoCommandListener
+
 class MobClass:
     def __init__(self) -> None:
         self.database = None
         self.history  = None
+        self.history_raw = None
         self.tokens   = None
+        self.token_stats = None
+        self.conversations = None
         self.GROUP_ID = -1
 
         self.use_text_search = False
+        self.keep_raw_update = False
+        self.use_postings    = False
+        self.partition_by    = None
+        self.backend  = None
 
     def __setattr__(self, name, value):
         self.__dict__[f"_{name}"] = value
@@ -23,35 +38,202 @@ class MobClass:
     def history(self) -> AsyncIOMotorCollection:
         return self._history
     @property
+    def history_raw(self) -> AsyncIOMotorCollection:
+        return self._history_raw
+    @property
     def tokens(self) -> AsyncIOMotorCollection:
         return self._tokens
     @property
+    def token_stats(self) -> AsyncIOMotorCollection:
+        return self._token_stats
+    @property
+    def conversations(self) -> AsyncIOMotorCollection:
+        return self._conversations
+    @property
     def GROUP_ID(self) -> int:
         return self._GROUP_ID
     @property
     def use_text_search(self) -> bool:
         return self._use_text_search
+    @property
+    def keep_raw_update(self) -> bool:
+        return self._keep_raw_update
+    @property
+    def use_postings(self) -> bool:
+        return self._use_postings
+    @property
+    def partition_by(self) -> str | None:
+        return self._partition_by
+    @property
+    def backend(self):
+        """History storage backend, see storage/."""
+        return self._backend
 
 
 mob = MobClass()
 logger = logging.getLogger(__name__)
 
+# history is split into "history_202610" (by month) or "history_2026q4" (by quarter)
+# collections, the unpartitioned "history" collection stays as the oldest partition
+PARTITION_PATTERN   = re.compile(r"^history_(\d{4})(?:(\d{2})|q([1-4]))$")
+PARTITION_CACHE_TTL = 60
+
+_partitions: tuple[list[str], float] = ([], 0.0)
+_ensured_partitions: set[str] = set()
+_held_partitions: dict[str, asyncio.Event] = {}
+
+
+def partition_name(date: datetime) -> str:
+    if date.tzinfo: date = date.astimezone(timezone.utc)
+    if mob.partition_by=="month":
+        return f"history_{date.year}{date.month:02d}"
+    return f"history_{date.year}q{(date.month-1)//3+1}"
+
+def partition_range(name: str) -> tuple[datetime, datetime] | None:
+    """[start, end) of a partition in naive UTC, as dates are read back from the database."""
+    if not (m := PARTITION_PATTERN.match(name)): return None
+
+    year  = int(m.group(1))
+    month = int(m.group(2)) if m.group(2) else 3*int(m.group(3))-2
+    span  = 1 if m.group(2) else 3
+
+    end = year*12 + month-1 + span
+    return datetime(year, month, 1), datetime(end//12, end%12+1, 1)
+
+
+async def history_partitions(before: datetime | None=None) -> list[AsyncIOMotorCollection]:
+    """
+    Searchable history collections, the newest partition first and the legacy collection last.
+
+    Partitions starting at or after `before` are left out.
+    """
+    global _partitions
+    if not mob.partition_by: return [mob.history]
+
+    names, expire = _partitions
+    if expire<time.monotonic():
+        names = await mob.database.list_collection_names(filter={"name": {"$regex": PARTITION_PATTERN.pattern}})
+        names = sorted(names, key=lambda v: partition_range(v)[0], reverse=True)
+        _partitions = (names, time.monotonic()+PARTITION_CACHE_TTL)
+
+    if before is not None:
+        if before.tzinfo: before = before.astimezone(timezone.utc).replace(tzinfo=None)
+        names = [v for v in names if partition_range(v)[0]<before]
+
+    return [mob.database.get_collection(v) for v in names] + [mob.history]
+
+def forget_partitions() -> None:
+    """Drops the cached partition list, after partitions were created, archived or dropped."""
+    global _partitions
+    _partitions = ([], 0.0)
+
+async def history_for(date: datetime) -> AsyncIOMotorCollection:
+    """The history collection a message sent at `date` is written to, its indexes are built on first use."""
+    if not mob.partition_by: return mob.history
+
+    name = partition_name(date)
+    if name in _held_partitions: await _held_partitions[name].wait()
+
+    collection = mob.database.get_collection(name)
+    if name not in _ensured_partitions:
+        # (chat, mid) must be unique before the first insert
+        await collection.create_indexes(history_indexes())
+        _ensured_partitions.add(name)
+        forget_partitions()
+
+    return collection
+
+async def stored_history_for(date: datetime) -> AsyncIOMotorCollection:
+    """The history collection holding a message sent at `date`, the legacy collection if its partition does not exist."""
+    if not mob.partition_by: return mob.history
+
+    name = partition_name(date)
+    if name in _held_partitions: await _held_partitions[name].wait()
+
+    # partitions created by other processes are not in the cached partition list yet
+    if name not in _ensured_partitions and not await mob.database.list_collection_names(filter={"name": name}):
+        return mob.history
+    return mob.database.get_collection(name)
+
+def hold_partition(name: str) -> None:
+    """Holds back writes of this process to a partition while it is copied into a new collection."""
+    _held_partitions[name] = asyncio.Event()
+
+def release_partition(name: str) -> None:
+    _held_partitions.pop(name).set()
+
+
+def history_indexes() -> list[IndexModel]:
+    """Indexes of the history collection and of each of its partitions."""
+    history = [
+        # (chat, mid) identifies a message, edits and re-delivered updates rely on it
+        IndexModel([("chat", ASCENDING), ("mid", ASCENDING)], unique=True),
+        IndexModel([("chat", ASCENDING), ("date", DESCENDING)]),
+        IndexModel([("tokens", ASCENDING)]),
+    ]
+    # the query planner may pick $text when the text index exists
+    if mob.use_text_search:
+        history.append(IndexModel([("tokens", TEXT)], default_language="none"))
+    return history
+
+def index_spec() -> dict[str, list[IndexModel]]:
+    """Indexes each collection should have, reconciled by `reconcile_indexes`."""
+    return {
+        "history": history_indexes(),
+        "history_raw": [IndexModel([("chat", ASCENDING), ("mid", ASCENDING)], unique=True)],
+        # posting list buckets, see postings.py
+        "tokens": [IndexModel([("t", ASCENDING), ("b", DESCENDING)])],
+        # persisted LLM conversations are removed by the ttl monitor once expired
+        "conversations": [IndexModel([("expire", ASCENDING)], expireAfterSeconds=0)],
+    }
+
+
+async def reconcile_indexes(drop_unused: bool=False) -> None:
+    specs = index_spec()
+    for collection in await history_partitions():
+        specs.setdefault(collection.name, specs["history"])
+
+    for (name, models) in specs.items():
+        collection = mob.database.get_collection(name)
+        existing   = await collection.index_information()
+        expected   = {model.document["name"]: model for model in models}
+
+        for (index_name, model) in expected.items():
+            if index_name in existing: continue
+
+            start_time = time.monotonic()
+            try:
+                await collection.create_indexes([model])
+            except Exception as e:
+                logger.warning(f"failed to create index {name}.{index_name}: {e}")
+            else:
+                logger.info(f"created index {name}.{index_name} in {time.monotonic()-start_time:.1f} s")
+
+        if drop_unused:
+            for index_name in existing:
+                if index_name=="_id_" or index_name in expected: continue
+                await collection.drop_index(index_name)
+                logger.info(f"dropped unused index {name}.{index_name}")
+
+
 def init_database(db_config: dict):
     global mob
 
-    try:
-        logging.getLogger("pymongo").setLevel(logging.WARNING)
-        client = AsyncIOMotorClient(db_config["uri"], io_loop=asyncio.get_event_loop())
-        mob.database = client.get_database(db_config["db_name"])
-        mob.history  = mob.database.get_collection("history")
-        mob.tokens   = mob.database.get_collection("tokens")
-
-        mob.GROUP_ID = db_config["IWAKU_GROUP_ID"]
-        mob.use_text_search = db_config.get("use_text_search", False)
-
-        if mob.use_text_search:
-            asyncio.get_event_loop().run_until_complete(mob.history.create_index([("tokens", "text")], default_language="none", background=True))
-        else:
-            asyncio.get_event_loop().run_until_complete(mob.history.create_index("tokens", background=True))
-    except Exception as e:
-        logger.warning(f"Error: '{e}'")
\ No newline at end of file
+    mob.GROUP_ID = db_config["IWAKU_GROUP_ID"]
+    mob.keep_raw_update = db_config.get("keep_raw_update", False)
+
+    # the embedded backend does not need a mongod at all
+    if db_config.get("backend", "mongo")!="mongo": return
+
+    logging.getLogger("pymongo").setLevel(logging.WARNING)
+    client = AsyncIOMotorClient(db_config["uri"], io_loop=asyncio.get_event_loop(), event_listeners=[MongoCommandListener()])
+    mob.database = client.get_database(db_config["db_name"])
+    mob.history  = mob.database.get_collection("history")
+    mob.history_raw = mob.database.get_collection("history_raw")
+    mob.tokens   = mob.database.get_collection("tokens")
+    mob.token_stats = mob.database.get_collection("token_stats")
+    mob.conversations = mob.database.get_collection("conversations")
+
+    mob.use_text_search = db_config.get("use_text_search", False)
+    mob.use_postings    = db_config.get("use_postings", False)
+    mob.partition_by    = db_config.get("partitions", {}).get("by")
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import urllib.request
+
+import httpx
+
+from .tracing import TracedTransport
+
+try:
+    import h2
+except ImportError:
+    h2 = None
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SETTINGS = {
+    "timeout": 30.0,
+    "connect_timeout": 10.0,
+    "max_connections": 32,
+    "max_keepalive_connections": 16,
+    "keepalive_expiry": 60.0,
+    "http2": False,
+    "proxy": None,
+}
+
+
+class HTTPClients:
+    """
+    Shared httpx clients keyed by upstream host.
+
+    Each upstream gets one client whose connection pool keeps connections
+    alive between requests, so repeated calls skip the TCP and TLS
+    handshakes. Limits and timeouts come from "http.default", overridden per
+    host by "http.upstreams". HTTP/2 requires the h2 package.
+
+    Without a "proxy" setting, HTTP(S)_PROXY, ALL_PROXY and NO_PROXY from the
+    environment apply as they do for a plain httpx client. Headers are passed
+    per request since the client is shared.
+    """
+
+    def __init__(self) -> None:
+        self.default   = dict(DEFAULT_SETTINGS)
+        self.upstreams: dict[str, dict] = {}
+
+        self._clients: dict[str, httpx.AsyncClient] = {}
+
+    def configure(self, config: dict) -> None:
+        self.default.update(config.get("default", {}))
+        self.upstreams.update(config.get("upstreams", {}))
+
+    def settings(self, upstream: str) -> dict:
+        settings = {**self.default, **self.upstreams.get(upstream, {})}
+        if settings["http2"] and h2 is None:
+            logger.warning(f"http2 for {upstream} requires the h2 package, falling back to http/1.1")
+            settings["http2"] = False
+        return settings
+
+    def proxy(self, upstream: str, scheme: str) -> str | None:
+        """Proxy of requests to `upstream`, httpx ignores the environment once a transport is given."""
+        proxy = self.settings(upstream)["proxy"]
+        if proxy: return proxy
+
+        if urllib.request.proxy_bypass(upstream): return None
+        proxies = urllib.request.getproxies()
+        return proxies.get(scheme) or proxies.get("all")
+
+    def get(self, upstream: str) -> httpx.AsyncClient:
+        client = self._clients.get(upstream)
+        if client is None or client.is_closed:
+            settings = self.settings(upstream)
+            limits   = httpx.Limits(
+                max_connections=settings["max_connections"],
+                max_keepalive_connections=settings["max_keepalive_connections"],
+                keepalive_expiry=settings["keepalive_expiry"],
+            )
+            # both schemes share one pool unless they go through different proxies
+            proxies    = {scheme: self.proxy(upstream, scheme) for scheme in ["https", "http"]}
+            transports = {v: TracedTransport(http2=settings["http2"], proxy=v, limits=limits) for v in set(proxies.values())}
+
+            client = self._clients[upstream] = httpx.AsyncClient(
+                transport=transports[proxies["https"]],
+                mounts={"http://": transports[proxies["http"]]},
+                timeout=httpx.Timeout(settings["timeout"], connect=settings["connect_timeout"]),
+            )
+        return client
+
+    def for_url(self, url: str) -> httpx.AsyncClient:
+        return self.get(httpx.URL(url).host)
+
+    async def close_all(self) -> None:
+        clients, self._clients = self._clients, {}
+        results = await asyncio.gather(*[client.aclose() for client in clients.values()], return_exceptions=True)
+        for (upstream, result) in zip(clients, results):
+            if isinstance(result, Exception):
+                logger.warning(f"failed to close http client of {upstream}: {result}")
+
+
+http_clients = HTTPClients()
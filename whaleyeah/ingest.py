@@ -0,0 +1,280 @@
+import asyncio
+import logging
+import time
+
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+
+from . import postings, tokenstats
+from .database import mob, history_for, stored_history_for, partition_name
+from .metrics import Gauge
+
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def _split_raw(docs: list[dict]) -> tuple[list[dict], list[dict]]:
+    """Separates the optional raw update json from history documents."""
+    history_docs, raw_docs = [], []
+
+    for doc in docs:
+        if "json" in doc:
+            raw_docs.append({"chat": doc["chat"], "mid": doc["mid"], "json": doc["json"]})
+            doc = {k: v for (k, v) in doc.items() if k!="json"}
+        history_docs.append(doc)
+
+    return history_docs, raw_docs
+
+
+async def _insert(docs: list[dict]) -> tuple[list[dict], list[dict], list[tuple[dict, str]]]:
+    collection = await history_for(docs[0]["date"])
+    inserted, duplicates, errors = docs, [], []
+
+    try:
+        await collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        failed   = {v["index"]: v for v in e.details.get("writeErrors", [])}
+        inserted = [v for (k, v) in enumerate(docs) if k not in failed]
+
+        for (k, v) in failed.items():
+            # duplicate keys are re-delivered updates which are already stored
+            if v.get("code")==DUPLICATE_KEY_ERROR:
+                duplicates.append(docs[k])
+            else:
+                errors.append((docs[k], v.get("errmsg", "")))
+
+    return inserted, duplicates, errors
+
+async def write_history(docs: list[dict]) -> tuple[list[dict], list[dict], list[tuple[dict, str]]]:
+    """
+    Inserts history documents with one unordered `insert_many` per partition and indexes their tokens.
+
+    Returns the inserted documents, the ones already stored (duplicated
+    (chat, mid) keys) and the rejected ones with their error messages.
+    Errors other than per-document write errors are raised.
+    """
+    history_docs, raw_docs = _split_raw(docs)
+    inserted, duplicates, errors = [], [], []
+
+    groups: dict[str, list[dict]] = {}
+    for doc in history_docs:
+        groups.setdefault(partition_name(doc["date"]) if mob.partition_by else "", []).append(doc)
+
+    for group in groups.values():
+        results = await _insert(group)
+        inserted += results[0]
+        duplicates += results[1]
+        errors += results[2]
+
+    if inserted:
+        try:
+            await tokenstats.record(inserted)
+            if mob.use_postings: await postings.add(inserted)
+        except Exception as e:
+            logger.warning(f"failed to update token index: {e}")
+
+    if raw_docs:
+        try:
+            await mob.history_raw.insert_many(raw_docs, ordered=False)
+        except BulkWriteError:
+            pass
+        except Exception as e:
+            logger.warning(f"failed to write raw updates: {e}")
+
+    return inserted, duplicates, errors
+
+
+async def edit_history(doc: dict) -> dict | None:
+    """Applies an edited message to its stored history document, returns the previous date, tokens and len."""
+    (doc,), raw_docs = _split_raw([doc])
+
+    # the partition follows the send date, which edits keep, older messages may still be in the legacy collection
+    partition   = await stored_history_for(doc["date"])
+    collections = [partition] if partition is mob.history else [partition, mob.history]
+
+    old = None
+    for collection in collections:
+        old = await collection.find_one_and_update(
+            {"chat": doc["chat"], "mid": doc["mid"]},
+            {"$set": {"text": doc["text"], "tokens": doc["tokens"], "tf": doc["tf"], "len": doc["len"], "date": doc["date"]}},
+            projection={"date": 1, "tokens": 1, "len": 1},
+            return_document=ReturnDocument.BEFORE,
+        )
+        if old: break
+    if old:
+        await tokenstats.record_edit(old, doc)
+        if mob.use_postings: await postings.update(old, doc["tokens"])
+    if raw_docs:
+        await mob.history_raw.replace_one({"chat": doc["chat"], "mid": doc["mid"]}, raw_docs[0], upsert=True)
+
+    return old
+
+
+class HistoryWriter:
+    """
+    Write-behind buffer for iwaku history documents.
+
+    Documents are collected in memory and flushed to the storage backend in
+    one batch once `max_batch` documents are pending or the oldest one has
+    waited `max_delay` seconds. Edits to a message that has not been flushed yet
+    are applied to the buffered document directly.
+    """
+
+    def __init__(self, max_batch: int=500, max_delay: float=1.0, max_pending: int=20000) -> None:
+        self.max_batch   = max_batch
+        self.max_delay   = max_delay
+        self.max_pending = max_pending
+
+        self._buffer: list[dict] = []
+        self._keys: dict[tuple, int] = {}
+        self._inflight: set[tuple] = set()
+        self._oldest = 0.0
+
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+        self._flushed = 0
+        self._flush_count = 0
+        self._flush_errors = 0
+        self._flush_time_total = 0.0
+        self._flush_time_last = 0.0
+        self._flush_time_max = 0.0
+
+    def configure(self, config: dict) -> None:
+        self.max_batch   = int(config.get("max_batch", self.max_batch))
+        self.max_delay   = float(config.get("max_delay", self.max_delay))
+        self.max_pending = int(config.get("max_pending", self.max_pending))
+
+    @property
+    def depth(self) -> int:
+        return len(self._buffer)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "flushed": self._flushed,
+            "flush_count": self._flush_count,
+            "flush_errors": self._flush_errors,
+            "flush_ms_last": 1000*self._flush_time_last,
+            "flush_ms_max": 1000*self._flush_time_max,
+            "flush_ms_avg": 1000*self._flush_time_total/self._flush_count if self._flush_count else 0.0,
+        }
+
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._task = asyncio.create_task(self._run(), name="HistoryWriter")
+
+    async def stop(self) -> None:
+        if self._task:
+            # cancelling would lose a batch in flight, let a running flush finish instead
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+        while self._buffer:
+            if not await self.flush():
+                logger.warning(f"dropped {self.depth} history documents on shutdown")
+                break
+
+        logger.info(f"history writer stopped: {self.stats()}")
+
+
+    async def put(self, doc: dict) -> None:
+        if self.depth >= self.max_pending:
+            # backpressure: the database cannot keep up, wait for a flush
+            await self.flush()
+
+        if not self._buffer: self._oldest = time.monotonic()
+
+        self._keys[(doc["chat"], doc["mid"])] = len(self._buffer)
+        self._buffer.append(doc)
+
+        if self.depth >= self.max_batch or self._task is None:
+            self._wakeup.set()
+            if self._task is None: await self.flush()
+
+    async def edit(self, doc: dict) -> None:
+        key = (doc["chat"], doc["mid"])
+
+        if key in self._keys:
+            self._buffer[self._keys[key]] = doc
+            return
+
+        if key in self._inflight:
+            # wait for the running flush so the stored document can be updated
+            async with self._flush_lock: pass
+
+            # a failed flush puts its batch back into the buffer
+            if key in self._keys:
+                self._buffer[self._keys[key]] = doc
+                return
+
+        await mob.backend.edit(doc)
+
+
+    async def flush(self) -> bool:
+        async with self._flush_lock:
+            if not self._buffer: return True
+
+            docs, self._buffer = self._buffer, []
+            self._inflight, self._keys = set(self._keys), {}
+
+            start_time = time.monotonic()
+            success = True
+            try:
+                inserted, _, errors = await mob.backend.insert(docs)
+                if errors:
+                    self._flush_errors += 1
+                    logger.warning(f"failed to write {len(errors)} of {len(docs)} history documents: {errors[0][1]}")
+            except Exception as e:
+                self._flush_errors += 1
+                success = False
+                logger.warning(f"failed to write history: {e}")
+
+                # keep the documents for the next flush unless the buffer overflows
+                if len(docs)+self.depth <= self.max_pending:
+                    self._buffer = docs + self._buffer
+                    self._keys = {(v["chat"], v["mid"]): k for (k, v) in enumerate(self._buffer)}
+                    self._oldest = start_time
+                else:
+                    logger.warning(f"dropped {len(docs)} history documents")
+            finally:
+                self._inflight = set()
+
+            elapsed = time.monotonic() - start_time
+            if success:
+                # duplicates and failed documents are not counted
+                self._flushed += len(inserted)
+                self._flush_count += 1
+                self._flush_time_total += elapsed
+                self._flush_time_last = elapsed
+                self._flush_time_max = max(self._flush_time_max, elapsed)
+
+                logger.debug(f"flushed {len(inserted)} of {len(docs)} history documents in {1000*elapsed:.2f} ms, {self.depth} pending")
+
+            return success
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            if self._stopping or not self._buffer: continue
+            if self.depth>=self.max_batch or time.monotonic()-self._oldest>=self.max_delay:
+                if not await self.flush():
+                    # database is unavailable, do not spin
+                    await asyncio.sleep(self.max_delay)
+
+
+history_writer = HistoryWriter()
+Gauge("whaleyeah_history_writer_depth", "History documents waiting for the write-behind flush.", lambda: history_writer.depth)
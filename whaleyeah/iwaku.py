@@ -5,16 +5,19 @@ import logging
 import math
 import time
 
-import jieba
+from datetime import datetime
 
 from telegram import Update, InlineQueryResultArticle, InputTextMessageContent, ReplyParameters
-from telegram.ext import MessageHandler, InlineQueryHandler, ContextTypes, filters
+from telegram.ext import InlineQueryHandler, ContextTypes
 from telegram.constants import ParseMode
 
 from telegramify_markdown import markdownify
 
+from .admins import admin_cache
+from . import tokenstats
 from .database import mob
-from .megaphone import _megaphone_callback
+from .ingest import history_writer
+from .tokenizer import tokenizer, PRIORITY_INTERACTIVE
 
 
 __LOCATE_COMMAND__ = "/portal"
@@ -22,21 +25,26 @@ __LOCATE_COMMAND__ = "/portal"
 
 SEARCH_PAGE_SIZE = 10
 
+# totals above COUNT_LIMIT are shown as "1000+"
+COUNT_LIMIT      = 1000
+COUNT_CACHE_TTL  = 60
+COUNT_CACHE_SIZE = 256
+
+RELEVANCE_PREFIX = "~"
+RANK_CACHE_TTL   = 60
+RANK_CACHE_SIZE  = 32
+
+# fields read by the inline result builder, "json" only exists in legacy documents
+HISTORY_PROJECTION = {"chat": 1, "mid": 1, "name": 1, "text": 1, "date": 1, "json": 1}
+
 
 logger = logging.getLogger(__name__)
-plugins_from_server = {}
-_iwaku_uid_whitelist = {}
+_count_cache: dict[str, tuple[int, float]] = {}
+_rank_cache: dict[str, tuple[list[dict], float]] = {}
 
-def iwaku_history_handler() -> MessageHandler:
-    jieba.setLogLevel(logger.getEffectiveLevel())
-    return MessageHandler(filters=None, callback=_iwaku_history_callback)
 def iwaku_inline_handler() -> InlineQueryHandler:
+    admin_cache.watch([mob.GROUP_ID])
     return InlineQueryHandler(callback=_iwaku_inline_callback)
-def iwaku_locate_handler() -> MessageHandler:
-    return MessageHandler(filters=filters.COMMAND, callback=_iwaku_locate_callback)
-def iwaku_plugins_copy(p: dict) -> None:
-    global plugins_from_server
-    plugins_from_server = p
 
 
 def trim_tokens(tokens: list[str]) -> list[str]:
@@ -52,8 +60,52 @@ def trim_tokens(tokens: list[str]) -> list[str]:
 
     return results
 
+def count_tokens(tokens: list[str]) -> tuple[list[str], list[int]]:
+    """Like trim_tokens, but also returns how often each kept token occurs."""
+    counter = {}
+
+    for v in tokens:
+        v = v.strip()
+        if len(v.encode())<=1 and (not v.isalpha()): continue
+        counter[v] = counter.get(v, 0) + 1
+
+    return list(counter), list(counter.values())
+
+
+def _history_doc_fields(doc: dict, bot) -> tuple[int, int, str, datetime, str]:
+    """Returns (chat_id, message_id, text, date, sender name) of a history document."""
+    if "name" in doc:
+        return doc["chat"], doc["mid"], doc["text"], doc["date"], doc["name"]
+
+    # legacy document which only carries the full update json
+    message = Update.de_json(json.loads(doc["json"]), bot).effective_message
+    eff_text = message.text if message.text else message.caption
+    return message.chat_id, message.id, eff_text, message.date, message.from_user.full_name
+
+
+def _history_doc(update: Update, text: str, seg: list[str]) -> dict:
+    msg = update.effective_message
+    tokens, tf = count_tokens(seg)
+
+    mob_doc = {
+        "from": msg.from_user.id,
+        "chat": msg.chat_id,
+        "mid": msg.id,
+        "name": msg.from_user.full_name,
+        "text": text,
+        "date": msg.date,
+        "tokens": tokens,
+        "tf": tf, # term frequencies for relevance ranking
+        "len": sum(tf),
+    }
+    if mob.keep_raw_update:
+        mob_doc["json"] = update.to_json() # original json, moved to history_raw on write
+
+    return mob_doc
+
 
 async def _iwaku_history_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Last stage of the router, commands have been dispatched before."""
     if not context: pass
 
     prefix = []
@@ -68,9 +120,6 @@ async def _iwaku_history_callback(update: Update, context: ContextTypes.DEFAULT_
     if msg:
         if msg.text:
             text = msg.text
-            if text.startswith("/"):
-                if await _megaphone_callback(update, context):
-                    return
         else:
             text = msg.caption
             if msg.audio: prefix = ["[音乐]", " "]
@@ -82,51 +131,65 @@ async def _iwaku_history_callback(update: Update, context: ContextTypes.DEFAULT_
             if msg.voice: prefix = ["[语音]", " "]
 
     if not text: return
-    for k, v in plugins_from_server.items():
-        if text.startswith(f"/{k}") and v:
-            await v.callback(update, context)
-            return
-
 
-    seg = prefix + await asyncio.to_thread(jieba.lcut_for_search, text)
+    seg = prefix + await tokenizer.lcut_for_search(text)
 
     text = "".join(prefix) + text
 
-    jmsg = update.to_json()
     logger.debug(text)
-    # logger.info(sys.getsizeof(jmsg)) ~1KB
 
 
     try:
-        mob_doc = {
-            "from": msg.from_user.id,
-            "chat": msg.chat_id,
-            "mid": msg.id,
-            "text": text,
-            "date": msg.date,
-            "json": jmsg, # original json
-            "tokens": trim_tokens(seg),
-        }
+        mob_doc = _history_doc(update, text, seg)
 
         # Unfortunately, a bot cannot get deleted messages.
         if msg==update.edited_message:
-            await mob.history.find_one_and_replace(
-                {"$and": [
-                    {
-                        "from": msg.from_user.id,
-                        "chat": msg.chat_id,
-                        "mid": msg.id,
-                    }
-                ]},
-                mob_doc,
-            )
+            await history_writer.edit(mob_doc)
         else:
-            await mob.history.insert_one(mob_doc)
+            await history_writer.put(mob_doc)
 
     except Exception as e:
         logger.warning(f"failed to write history: {e}")
 
 
+async def _count_history(plan: tokenstats.QueryPlan) -> int:
+    """Counts matches up to COUNT_LIMIT+1, recent results are served from a short-lived cache."""
+    key = json.dumps([plan.mode, plan.tokens], ensure_ascii=False)
+    now = time.monotonic()
+
+    if key in _count_cache:
+        count, expire = _count_cache[key]
+        if expire>now: return count
+        del _count_cache[key]
+
+    count = await mob.backend.count(plan, limit=COUNT_LIMIT)
+
+    _count_cache[key] = (count, now+COUNT_CACHE_TTL)
+    while len(_count_cache)>COUNT_CACHE_SIZE:
+        _count_cache.pop(next(iter(_count_cache)))
+
+    return count
+
+
+async def _rank_history(query_tokens: list[str], plan: tokenstats.QueryPlan) -> list[dict]:
+    """Relevance ranked candidates, kept for a while so that following pages are slices of the same ranking."""
+    key = json.dumps([query_tokens, plan.mode, plan.tokens], ensure_ascii=False)
+    now = time.monotonic()
+
+    if key in _rank_cache:
+        ranked, expire = _rank_cache[key]
+        if expire>now: return ranked
+        del _rank_cache[key]
+
+    ranked = await mob.backend.rank(query_tokens, plan, projection=HISTORY_PROJECTION)
+
+    _rank_cache[key] = (ranked, now+RANK_CACHE_TTL)
+    while len(_rank_cache)>RANK_CACHE_SIZE:
+        _rank_cache.pop(next(iter(_rank_cache)))
+
+    return ranked
+
+
 async def _iwaku_inline_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # {"$and": [{"chat": msg.chat_id, "from": msg.from_user.id}, {"tokens": a}, {"tokens": b}, ...]}
     if not context: pass
@@ -135,6 +198,15 @@ async def _iwaku_inline_callback(update: Update, context: ContextTypes.DEFAULT_T
     query = update.inline_query.query
     if not query: return
 
+    # "~keyword" ranks results by relevance instead of date
+    by_relevance = query.startswith(RELEVANCE_PREFIX)
+    if by_relevance: query = query.removeprefix(RELEVANCE_PREFIX)
+
+    # Telegram requests the next page with the next_offset of the previous answer,
+    # "keyword N" is still accepted to jump to page N directly.
+    offset = update.inline_query.offset
+    after  = mob.backend.decode_offset(offset) if offset and not by_relevance else None
+
     query = query.split(" ")
     try:
         page  = int(query[-1])
@@ -144,116 +216,112 @@ async def _iwaku_inline_callback(update: Update, context: ContextTypes.DEFAULT_T
         query = " ".join(query)
 
     query        = query.strip()
-    query_tokens = await asyncio.to_thread(jieba.lcut_for_search, query)
+    query_tokens = await tokenizer.lcut_for_search(query, PRIORITY_INTERACTIVE)
     query_tokens = trim_tokens(query_tokens)
 
     if query_tokens:
         # check priviledge
-        global _iwaku_uid_whitelist
-        if update.inline_query.from_user.id not in _iwaku_uid_whitelist:
-            try:
-                # update.chat_member
-                xx = await update.get_bot().get_chat_administrators(chat_id=mob.GROUP_ID)
-                if xx is None:
-                    _iwaku_uid_whitelist[update.inline_query.from_user.id] = False
-                    return
-                xx = [it.user.id for it in xx]
-                if update.inline_query.from_user.id not in xx:
-                    _iwaku_uid_whitelist[update.inline_query.from_user.id] = False
-                    return
-                _iwaku_uid_whitelist[update.inline_query.from_user.id] = True
-            except Exception as e:
-                logger.warning(f"failed to check priviledge: {e}")
-                _iwaku_uid_whitelist[update.inline_query.from_user.id] = False
-                return
-        elif not _iwaku_uid_whitelist[update.inline_query.from_user.id]: return
-
-
-
-        filter = {"$text": {"$search": " ".join(query_tokens)}} if mob.use_text_search else {"tokens": {"$all": query_tokens}}
-
-        cursor = mob.history.find(filter)
-        cursor = cursor.sort("date", -1)
-
-        count = await mob.history.count_documents(filter)
-        # docs  = await cursor.to_list(length=page*SEARCH_PAGE_SIZE)
-        # docs  = await cursor.to_list(length=None)
-        # count = len(cursor)
-
-        query_elapsed = time.time() - query_start_time
-        logger.info(f"query for \"{query}\" in {1000*query_elapsed:.2f} ms")
-
-
-        results = [
-            InlineQueryResultArticle(
-                id='info',
-                title='Page {} of {} (Find {} records in {:.0f}ms).'.format(page, math.ceil(count / SEARCH_PAGE_SIZE), count, query_elapsed*1000),
-                # title='Total:{}. Page {} of ?'.format(count, page),
-                input_message_content=InputTextMessageContent('/help')
-            )
-        ]
+        if not await admin_cache.is_admin(update.get_bot(), update.inline_query.from_user.id, [mob.GROUP_ID]): return
+
+
+        plan = await mob.backend.plan(query_tokens)
+        logger.debug(plan)
+
+        skip = 0 if after else SEARCH_PAGE_SIZE*(page-1)
+        if by_relevance:
+            if offset.isdigit(): skip = int(offset)
+
+            if plan.mode=="empty":
+                ranked, count = [], None if offset else 0
+            elif offset:
+                ranked, count = await _rank_history(query_tokens, plan), None
+            else:
+                ranked, count = await asyncio.gather(_rank_history(query_tokens, plan), _count_history(plan))
+
+            docs = ranked[skip:skip+SEARCH_PAGE_SIZE]
+            next_offset = f"{skip+SEARCH_PAGE_SIZE}" if len(ranked)>skip+SEARCH_PAGE_SIZE else ""
+
+        elif plan.mode=="empty":
+            docs, count = [], None if after else 0
+            next_offset = ""
+        else:
+            fetch = mob.backend.search(plan, limit=SEARCH_PAGE_SIZE, skip=skip, after=after, projection=HISTORY_PROJECTION)
 
-        if page!=1: cursor = cursor.skip(SEARCH_PAGE_SIZE*(page-1))
-        for _ in range(SEARCH_PAGE_SIZE*(page-1), min(SEARCH_PAGE_SIZE*page+1, count)):
-            doc = await cursor.next()
+            if after:
+                docs, count = await fetch, None
+            else:
+                # the header needs a total, count concurrently with the page fetch
+                docs, count = await asyncio.gather(fetch, _count_history(plan))
+            next_offset = mob.backend.encode_offset(docs[-1]) if len(docs)==SEARCH_PAGE_SIZE else ""
 
-            doc_update = update.de_json(json.loads(doc["json"]), update.get_bot())
-            message    = doc_update.effective_message
-            eff_text   = message.text if message.text else message.caption
-            # logger.debug(doc_update)
+        results = []
+        if count is not None:
+            query_elapsed = time.time() - query_start_time
+            logger.info(f"query for \"{query}\" in {1000*query_elapsed:.2f} ms")
+
+            if count>COUNT_LIMIT:
+                count_text, pages_text = f"{COUNT_LIMIT}+", f"{math.ceil(COUNT_LIMIT / SEARCH_PAGE_SIZE)}+"
+            else:
+                count_text, pages_text = f"{count}", f"{math.ceil(count / SEARCH_PAGE_SIZE)}"
+
+            results.append(
+                InlineQueryResultArticle(
+                    id='info',
+                    title='Page {} of {} (Find {} records in {:.0f}ms).'.format(page, pages_text, count_text, query_elapsed*1000),
+                    # title='Total:{}. Page {} of ?'.format(count, page),
+                    input_message_content=InputTextMessageContent('/help')
+                )
+            )
+
+        for doc in docs:
+            chat_id, message_id, eff_text, date, full_name = _history_doc_fields(doc, update.get_bot())
             results.append(
                 InlineQueryResultArticle(
-                    id=message['id'],
+                    id=f"{chat_id}:{message_id}",
                     title='{}'.format(eff_text[:100]),
-                    description=message['date'].strftime("%Y-%m-%d").ljust(40) + message.from_user.full_name,
+                    description=date.strftime("%Y-%m-%d").ljust(40) + full_name,
                     # input_message_content=InputTextMessageContent(
                     #     '{}<a href="{}">「From {}」</a>'.format(html.escape(eff_text), message['link'], message.from_user.name),parse_mode='html'
                     #     ) if
                     # message['link'] != '' or message['id'] < 0 else InputTextMessageContent(
                     #     '/locate {}'.format(message['id']))
-                    input_message_content=InputTextMessageContent('/portal {} {}'.format(message.chat_id, message.id)) if message.id>0 else InputTextMessageContent(
+                    input_message_content=InputTextMessageContent('{} {} {}'.format(__LOCATE_COMMAND__, chat_id, message_id)) if message_id>0 else InputTextMessageContent(
                         # '{}<a href="{}">「From {}」</a>'.format(html.escape(eff_text), message['link'], message.from_user.name),parse_mode='html'
-                        '{}<a>「From {}」</a>'.format(html.escape(eff_text), message.from_user.full_name),parse_mode='html'
+                        '{}<a>「From {}」</a>'.format(html.escape(eff_text), full_name),parse_mode='html'
                     ),
                 )
             )
 
-        await update.inline_query.answer(results)
+        await update.inline_query.answer(results, next_offset=next_offset)
 
 
-async def _iwaku_locate_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-
+async def _iwaku_locate(update: Update, args: list[str]) -> None:
+    """Replaces a "/portal chat_id message_id" sent through the inline results with a reply to the original message."""
     msg = update.effective_message
     if not msg.via_bot: return
-    if not context: pass
+    if len(args)<2: return
+    logger.debug(args)
 
-    commands = msg.text.strip().split(" ")
-    logger.debug(commands)
-
-    if commands[0].startswith(__LOCATE_COMMAND__):
-        bot = update.get_bot()
-        # await bot.forward_message(chat_id=msg.chat_id, from_chat_id=commands[1], message_id=commands[2])
-
-        to_chat = str(msg.chat_id)
-
-        if to_chat!=str(mob.GROUP_ID):
-            if str(mob.GROUP_ID).endswith(to_chat):
-                to_chat = str(mob.GROUP_ID)
-        if str(mob.GROUP_ID).endswith(commands[1]):
-            commands[1] = str(mob.GROUP_ID)
-
-        try:
-            await asyncio.gather(
-                update.message.delete(),
-                bot.send_message(
-                    chat_id=msg.chat_id,
-                    text=markdownify(f"^ (by [{msg.from_user.full_name}](tg://user?id={msg.from_user.id}))"),
-                    parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_parameters=ReplyParameters(chat_id=commands[1], message_id=commands[2])
-                ),
-            )
-        except:
-            pass
+    bot = update.get_bot()
+    # await bot.forward_message(chat_id=msg.chat_id, from_chat_id=args[0], message_id=args[1])
 
-    else:
-        await _megaphone_callback(update, context)
\ No newline at end of file
+    to_chat, from_chat = str(msg.chat_id), args[0]
+
+    if to_chat!=str(mob.GROUP_ID):
+        if str(mob.GROUP_ID).endswith(to_chat):
+            to_chat = str(mob.GROUP_ID)
+    if str(mob.GROUP_ID).endswith(from_chat):
+        from_chat = str(mob.GROUP_ID)
+
+    try:
+        await asyncio.gather(
+            update.message.delete(),
+            bot.send_message(
+                chat_id=msg.chat_id,
+                text=markdownify(f"^ (by [{msg.from_user.full_name}](tg://user?id={msg.from_user.id}))"),
+                parse_mode=ParseMode.MARKDOWN_V2,
+                reply_parameters=ReplyParameters(chat_id=from_chat, message_id=args[1])
+            ),
+        )
+    except:
+        pass
\ No newline at end of file
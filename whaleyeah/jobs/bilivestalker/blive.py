@@ -1,24 +1,22 @@
 import asyncio
 import logging
-import httpx
 
 from telegram import Update
 from telegram.ext import MessageHandler, CallbackContext
 from telegram.constants import ParseMode
 
+from whaleyeah.httpclients import http_clients
+
 
 logger = logging.getLogger(__name__)
-client = httpx.AsyncClient(
-    headers={
-        "accept": "application/json, text/plain, */*",
-        "accept-language": "zh-CN,zh;q=0.9,en;q=0.8,en-GB;q=0.7,en-US;q=0.6",
-        "cache-control": "no-cache",
-        "origin": "https://live.bilibili.com",
-        "pragma": "no-cache",
-        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36 Edg/124.0.0.0",
-    },
-    timeout=5,
-)
+HEADERS = {
+    "accept": "application/json, text/plain, */*",
+    "accept-language": "zh-CN,zh;q=0.9,en;q=0.8,en-GB;q=0.7,en-US;q=0.6",
+    "cache-control": "no-cache",
+    "origin": "https://live.bilibili.com",
+    "pragma": "no-cache",
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36 Edg/124.0.0.0",
+}
 
 # usernames = {}
 live_info = {}
@@ -53,7 +51,8 @@ async def callback(ctx: CallbackContext):
 
 async def _check_live(room_id: int) -> bool:
     # resp = (await client.get(f"https://api.live.bilibili.com/xlive/web-room/v2/index/getRoomPlayInfo?room_id={room_id}&protocol=0,1&format=0,1,2&codec=0,1,2&qn=0&platform=web&ptype=8&dolby=5&panorama=1")).json()
-    resp = (await client.get(f"https://api.live.bilibili.com/room/v1/Room/get_info?room_id={room_id}")).json()
+    client = http_clients.get("api.live.bilibili.com")
+    resp = (await client.get(f"https://api.live.bilibili.com/room/v1/Room/get_info?room_id={room_id}", headers=HEADERS, timeout=5)).json()
     logger.debug(resp)
 
     if resp["code"]!=0 or not("data" in resp and "live_status" in resp["data"]):
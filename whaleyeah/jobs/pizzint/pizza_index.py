@@ -1,6 +1,5 @@
 import asyncio
 import logging
-import httpx
 
 from datetime import datetime
 from zoneinfo import ZoneInfo
@@ -10,23 +9,22 @@ from telegram.ext import MessageHandler, CallbackContext
 from telegram.constants import ParseMode
 from telegramify_markdown import markdownify
 
+from whaleyeah.httpclients import http_clients
+
 
 logger = logging.getLogger(__name__)
-client = httpx.AsyncClient(
-    headers={
-        "accept": "application/json, text/plain, */*",
-        "cache-control": "no-cache",
-        "pragma": "no-cache",
-        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36 Edg/124.0.0.0",
-    },
-    timeout=5,
-)
+HEADERS = {
+    "accept": "application/json, text/plain, */*",
+    "cache-control": "no-cache",
+    "pragma": "no-cache",
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36 Edg/124.0.0.0",
+}
 
 pizzint_endpoint = "https://www.pizzint.watch/api/dashboard-data"
 
 
 async def _get_pizza_index() -> tuple[int, dict, bool]:
-    resp = (await client.get(pizzint_endpoint)).json()
+    resp = (await http_clients.for_url(pizzint_endpoint).get(pizzint_endpoint, headers=HEADERS, timeout=5)).json()
     success = resp.get("success", False)
     defcon_level = resp.get("defcon_level", -1)
 
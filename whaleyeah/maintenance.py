@@ -0,0 +1,170 @@
+import asyncio
+import json
+import logging
+import time
+
+from datetime import datetime, timezone
+from functools import partial
+from os import PathLike
+
+from pymongo import ReplaceOne, UpdateOne
+from telegram import Update
+
+from . import postings, tokenstats
+from .database import init_database, mob, reconcile_indexes, history_partitions
+from .partitions import partition_policy
+from .server import load_config
+
+
+logger = logging.getLogger(__name__)
+
+MIGRATE_BATCH_SIZE = 1000
+
+
+async def migrate_compact_history() -> None:
+    """Converts legacy history documents carrying the full update json into the compact schema."""
+    count = 0
+    for collection in await history_partitions():
+        count += await _migrate_compact(collection)
+    logger.info(f"migrated {count} records into the compact schema")
+
+async def _migrate_compact(collection) -> int:
+    cursor = collection.find({"json": {"$exists": True}}, projection={"chat": 1, "mid": 1, "json": 1})
+
+    count = 0
+    lastt = 0
+    ops, raw_docs = [], []
+
+    async def write_batch():
+        # upserts let an interrupted migration rerun over the raw updates it already copied
+        if raw_docs: await mob.history_raw.bulk_write(raw_docs, ordered=False)
+        if ops: await collection.bulk_write(ops, ordered=False)
+        ops.clear()
+        raw_docs.clear()
+
+    async for doc in cursor:
+        fields = {}
+        try:
+            message = Update.de_json(json.loads(doc["json"]), None).effective_message
+            fields["name"] = message.from_user.full_name
+        except Exception as e:
+            logger.warning(f"failed to decode history {doc['_id']}: {e}")
+            fields["name"] = ""
+
+        if mob.keep_raw_update:
+            raw_docs.append(ReplaceOne(
+                {"chat": doc["chat"], "mid": doc["mid"]},
+                {"chat": doc["chat"], "mid": doc["mid"], "json": doc["json"]},
+                upsert=True,
+            ))
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": fields, "$unset": {"json": ""}}))
+
+        count += 1
+        if len(ops)>=MIGRATE_BATCH_SIZE: await write_batch()
+
+        currt = time.time()
+        if currt-lastt>1:
+            logger.info(f"{collection.name}: migrated {count:8d} records...")
+            lastt = currt
+
+    await write_batch()
+    return count
+
+
+async def dedupe_history() -> None:
+    """Removes duplicated (chat, mid) history documents, which block the unique index, keeping the newest."""
+    count = 0
+    for collection in await history_partitions():
+        cursor = collection.aggregate([
+            {"$group": {"_id": {"chat": "$chat", "mid": "$mid"}, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+        ], allowDiskUse=True)
+
+        async for group in cursor:
+            victims = sorted(group["ids"])[:-1]
+            await collection.delete_many({"_id": {"$in": victims}})
+            count += len(victims)
+
+    logger.info(f"removed {count} duplicated history records")
+
+
+async def rebuild_postings() -> None:
+    """Rebuilds the token posting lists from the history collection."""
+    await mob.tokens.drop()
+    await reconcile_indexes()
+
+    count = 0
+    lastt = 0
+
+    # oldest partition first, postings are appended in insertion order
+    for collection in reversed(await history_partitions()):
+        cursor = collection.find({}, projection={"date": 1, "tokens": 1}).sort("_id", 1)
+        batch  = []
+
+        async for doc in cursor:
+            batch.append(doc)
+            count += 1
+
+            if len(batch)>=MIGRATE_BATCH_SIZE:
+                await postings.add(batch)
+                batch = []
+
+            currt = time.time()
+            if currt-lastt>1:
+                logger.info(f"indexed {count:8d} records...")
+                lastt = currt
+
+        if batch: await postings.add(batch)
+    logger.info(f"rebuilt postings of {count} records")
+
+
+async def rebuild_token_stats() -> None:
+    """Recounts per-token document frequencies from the history collection."""
+    first, *others = await history_partitions()
+    union = [{"$unionWith": {"coll": collection.name}} for collection in others]
+
+    cursor = first.aggregate(union + [
+        {"$project": {"tokens": 1}},
+        {"$unwind": "$tokens"},
+        {"$group": {"_id": "$tokens", "df": {"$sum": 1}}},
+        {"$out": mob.token_stats.name},
+    ], allowDiskUse=True)
+    async for _ in cursor: pass
+
+    totals = await first.aggregate(union + [
+        {"$group": {"_id": None, "df": {"$sum": 1}, "len": {"$sum": {"$ifNull": ["$len", {"$size": {"$ifNull": ["$tokens", []]}}]}}}},
+    ], allowDiskUse=True).to_list(length=1)
+    totals = totals[0] if totals else {"df": 0, "len": 0}
+    total  = totals["df"]
+
+    # from now on the planner trusts the statistics
+    await mob.token_stats.replace_one(
+        {"_id": tokenstats.TOTAL_KEY},
+        {"df": total, "len": totals["len"], tokenstats.REBUILT_FIELD: datetime.now(timezone.utc)},
+        upsert=True,
+    )
+    logger.info(f"rebuilt token statistics of {total} records")
+
+
+MAINTENANCE_TASKS = {
+    "migrate_compact": migrate_compact_history,
+    "dedupe_history": dedupe_history,
+    "ensure_indexes": reconcile_indexes,
+    "drop_unused_indexes": partial(reconcile_indexes, drop_unused=True),
+    "rebuild_postings": rebuild_postings,
+    "rebuild_token_stats": rebuild_token_stats,
+    "apply_partition_policy": partition_policy.apply,
+}
+
+def run_maintenance(config: PathLike, tasks: list[str]) -> None:
+    config = load_config(config)
+    if config["database"].get("backend", "mongo")!="mongo":
+        raise ValueError("maintenance tasks only apply to the mongo storage backend")
+
+    init_database(config["database"])
+    partition_policy.configure(config["database"].get("partitions", {}))
+
+    loop = asyncio.get_event_loop()
+    for task in tasks:
+        logger.info(f"Running maintenance task => {task}...")
+        loop.run_until_complete(MAINTENANCE_TASKS[task]())
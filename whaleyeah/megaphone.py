@@ -2,27 +2,14 @@ import asyncio
 import logging
 
 from telegram import Update
-from telegram.ext import MessageHandler, ContextTypes, filters
 from telegram.constants import ParseMode
 
 logger = logging.getLogger(__name__)
 
 
-def megaphone_handler() -> MessageHandler:
-    return MessageHandler(filters=filters.COMMAND, callback=_megaphone_callback)
-
-
-async def _megaphone_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-
-    msg = update.effective_message
-    if msg.via_bot: return False
-    if not msg.text: return False
-    if not context: pass
-
-    commands = msg.text.strip().split(" ", maxsplit=1)
-    if not commands[0].startswith("/"): return False
-    commands[0] = commands[0][1:]
-    if commands[0].isascii(): return False
+async def megaphone(update: Update, action: str, rest: str) -> bool:
+    """Announces "/action rest" on behalf of the sender, ascii commands are left to bots."""
+    if action.isascii(): return False
 
 
     S_text = f"<a href=\"tg://user?id={update.effective_sender.id}\">{update.effective_sender.full_name}</a>"
@@ -35,15 +22,14 @@ async def _megaphone_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     else:
         O_text = "自己"
 
-    if len(commands)<2:
-        commands = commands + [""]*(2-len(commands))
+    if not rest:
         if O_text=="自己": O_text=""
 
     await asyncio.gather(
         update.effective_message.delete(),
         update.get_bot().send_message(
             chat_id=update.effective_chat.id,
-            text=f"{S_text} {commands[0]} {O_text} {commands[1]}".strip(),
+            text=f"{S_text} {action} {O_text} {rest}".strip(),
             parse_mode=ParseMode.HTML,
         )
     )
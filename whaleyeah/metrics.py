@@ -0,0 +1,251 @@
+import functools
+import logging
+import threading
+import time
+
+from pymongo import monitoring
+from telegram.request import HTTPXRequest
+from tornado.web import Application, RequestHandler
+
+from .tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry: list = []
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str="") -> str:
+    pairs = [f'{k}="{str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")}"' for (k, v) in zip(names, values)]
+    if extra: pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...]=()) -> None:
+        self.name   = name
+        self.help   = help
+        self.labels = labels
+
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, value: float=1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for (labels, value) in self._values.items():
+                lines.append(f"{self.name}{_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Gauge:
+    """Value read from a callback at scrape time."""
+
+    def __init__(self, name: str, help: str, callback) -> None:
+        self.name     = name
+        self.help     = help
+        self.callback = callback
+        _registry.append(self)
+
+    def render(self) -> list[str]:
+        try:
+            value = self.callback()
+        except Exception as e:
+            logger.warning(f"failed to read gauge {self.name}: {e}")
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...]=(), buckets: tuple[float, ...]=DEFAULT_BUCKETS) -> None:
+        self.name    = name
+        self.help    = help
+        self.labels  = labels
+        self.buckets = buckets
+
+        self._values: dict[tuple, list] = {} # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, *labels) -> None:
+        with self._lock:
+            counts = self._values.setdefault(labels, [0]*len(self.buckets) + [0.0, 0])
+            for (k, bound) in enumerate(self.buckets):
+                if value<=bound: counts[k] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def time(self, *labels) -> "_Timer":
+        return _Timer(self, labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for (labels, counts) in self._values.items():
+                for (bound, n) in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_labels(self.labels, labels, f'le=\"{bound}\"')} {n}")
+                lines.append(f"{self.name}_bucket{_labels(self.labels, labels, 'le=\"+Inf\"')} {counts[-1]}")
+                lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {counts[-2]}")
+                lines.append(f"{self.name}_count{_labels(self.labels, labels)} {counts[-1]}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: tuple) -> None:
+        self.histogram = histogram
+        self.labels    = labels
+
+    def __enter__(self) -> "_Timer":
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.perf_counter()-self.start_time, *self.labels)
+
+
+def render() -> str:
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+# the update throughput of a handler is the rate of its _count
+HANDLER_SECONDS = Histogram("whaleyeah_handler_seconds", "Time spent in update handler callbacks.", ("handler",))
+HANDLER_ERRORS  = Counter("whaleyeah_handler_errors_total", "Exceptions raised by update handler callbacks.", ("handler",))
+
+MONGO_SECONDS = Histogram("whaleyeah_mongo_command_seconds", "MongoDB command latency.", ("command",))
+MONGO_ERRORS  = Counter("whaleyeah_mongo_command_errors_total", "Failed MongoDB commands.", ("command",))
+
+BOT_API_SECONDS = Histogram("whaleyeah_bot_api_seconds", "Telegram Bot API request latency.", ("method",))
+BOT_API_ERRORS  = Counter("whaleyeah_bot_api_errors_total", "Failed Telegram Bot API requests.", ("method",))
+
+LLM_FIRST_TOKEN_SECONDS = Histogram("whaleyeah_llm_first_token_seconds", "Time to the first streamed LLM output.", ("provider", "model"))
+LLM_SECONDS = Histogram("whaleyeah_llm_seconds", "Total LLM request time.", ("provider", "model", "status"))
+
+JOB_SECONDS = Histogram("whaleyeah_job_seconds", "Job run durations.", ("job",))
+JOB_ERRORS  = Counter("whaleyeah_job_errors_total", "Exceptions raised by jobs.", ("job",))
+
+
+def instrument_callback(callback, name: str):
+    """Wraps an update callback with latency and error metrics."""
+    @functools.wraps(callback)
+    async def timed(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter()-start_time, name)
+
+    return timed
+
+def instrument_job(callback, name: str):
+    @functools.wraps(callback)
+    async def timed(context):
+        start_time = time.perf_counter()
+        try:
+            return await callback(context)
+        except Exception:
+            JOB_ERRORS.inc(name)
+            raise
+        finally:
+            JOB_SECONDS.observe(time.perf_counter()-start_time, name)
+
+    return timed
+
+
+class LLMTimer:
+    """Times one LLM request, `first_token` marks the first streamed output."""
+
+    def __init__(self, provider: str, model: str) -> None:
+        self.provider = provider
+        self.model    = model
+        self.first_token_time: float | None = None
+
+    def __enter__(self) -> "LLMTimer":
+        self.span = span(f"llm.{self.provider}", model=self.model).__enter__()
+        self.start_time = time.perf_counter()
+        return self
+
+    def first_token(self) -> None:
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter() - self.start_time
+            self.span.set(first_token_ms=round(1000*self.first_token_time, 3))
+            LLM_FIRST_TOKEN_SECONDS.observe(self.first_token_time, self.provider, self.model)
+
+    def __exit__(self, exc_type, *exc) -> None:
+        LLM_SECONDS.observe(time.perf_counter()-self.start_time, self.provider, self.model, "error" if exc_type else "ok")
+        self.span.__exit__(exc_type, *exc)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Called from driver threads, the metrics are locked."""
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        MONGO_SECONDS.observe(event.duration_micros/1e6, event.command_name)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        MONGO_SECONDS.observe(event.duration_micros/1e6, event.command_name)
+        MONGO_ERRORS.inc(event.command_name)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """Bot API requests with latency and error metrics per method."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> tuple[int, bytes]:
+        api_method = url.rsplit("/", maxsplit=1)[-1]
+        start_time = time.perf_counter()
+        try:
+            with span(f"bot.{api_method}"):
+                code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            BOT_API_ERRORS.inc(api_method)
+            raise
+        finally:
+            BOT_API_SECONDS.observe(time.perf_counter()-start_time, api_method)
+
+        if code>=400: BOT_API_ERRORS.inc(api_method)
+        return code, payload
+
+
+class _MetricsHandler(RequestHandler):
+    def get(self) -> None:
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(render())
+
+
+class MetricsServer:
+    """Serves /metrics in the prometheus text format on a local port."""
+
+    def __init__(self) -> None:
+        self.listen = None
+        self._server = None
+
+    def configure(self, config: dict) -> None:
+        self.listen = config.get("listen", self.listen)
+
+    def start(self) -> None:
+        if not self.listen or self._server: return
+
+        host, port = self.listen.rsplit(":", maxsplit=1)
+        self._server = Application([("/metrics", _MetricsHandler)]).listen(int(port), address=host)
+        logger.info(f"metrics are served on http://{self.listen}/metrics")
+
+    async def stop(self) -> None:
+        if self._server:
+            self._server.stop()
+            await self._server.close_all_connections()
+            self._server = None
+
+
+metrics_server = MetricsServer()
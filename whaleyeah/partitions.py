@@ -0,0 +1,192 @@
+import logging
+import time
+
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorCollection
+from telegram.ext import CallbackContext
+
+from . import tokenstats
+from .database import mob, history_partitions, history_indexes, forget_partitions, hold_partition, release_partition, partition_name, partition_range
+
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_PREFIX = "archive_"
+COPY_BATCH_SIZE = 1000
+
+
+def keyset_filter(after: tuple[datetime, ObjectId]) -> dict:
+    date, oid = after
+    return {"$or": [{"date": {"$lt": date}}, {"date": date, "_id": {"$lt": oid}}]}
+
+
+async def search(filter: dict, limit: int, skip: int=0, after: tuple[datetime, ObjectId] | None=None, projection: dict | None=None) -> list[dict]:
+    """
+    Newest-first history documents matching `filter`.
+
+    Partitions are walked newest first and the walk stops as soon as
+    `skip+limit` matches are found, so recent pages only touch the newest
+    partitions. `after` is the (date, _id) keyset position of the previous page.
+    """
+    if after: filter = {"$and": [filter, keyset_filter(after)]}
+
+    docs = []
+    for collection in await history_partitions(before=after[0] if after else None):
+        cursor = collection.find(filter, projection=projection)
+        cursor = cursor.sort([("date", -1), ("_id", -1)]).limit(skip+limit-len(docs))
+        docs  += await cursor.to_list(length=None)
+        if len(docs)>=skip+limit: break
+
+    return docs[skip:skip+limit]
+
+async def count(filter: dict, limit: int) -> int:
+    """Counts matches across partitions, newest first, stopping once more than `limit` are found."""
+    total = 0
+    for collection in await history_partitions():
+        total += await collection.count_documents(filter, limit=limit+1-total)
+        if total>limit: break
+    return total
+
+async def fetch(postings: list[list], projection: dict | None=None) -> dict[ObjectId, dict]:
+    """Looks up history documents by their (date, _id) postings."""
+    groups: dict[str, list[ObjectId]] = {}
+    for (date, oid) in postings:
+        groups.setdefault(partition_name(date) if mob.partition_by else mob.history.name, []).append(oid)
+
+    docs = {}
+    for (name, ids) in groups.items():
+        async for doc in mob.database.get_collection(name).find({"_id": {"$in": ids}}, projection=projection):
+            docs[doc["_id"]] = doc
+
+    # messages stored before partitioning was enabled
+    missing = [oid for (_, oid) in postings if oid not in docs]
+    if missing and mob.partition_by:
+        async for doc in mob.history.find({"_id": {"$in": missing}}, projection=projection):
+            docs[doc["_id"]] = doc
+
+    return docs
+
+async def existing_mids(chat_id: int, mids: list[int]) -> set[int]:
+    """Message ids of `chat_id` which are stored in any partition."""
+    found = set()
+    for collection in await history_partitions():
+        found.update(await collection.distinct("mid", {"chat": chat_id, "mid": {"$in": mids}}))
+    return found
+
+
+class PartitionPolicy:
+    """
+    Retention policy of old history partitions.
+
+    Ages are counted in partitions, the current one has age 0. Once a
+    partition reaches `compress_after` it is rewritten with zstd block
+    compression, at `archive_after` it is renamed out of the search path
+    with its secondary indexes dropped, and at `expire_after` it is dropped.
+    Archived and expired messages are removed from token statistics and
+    posting lists. The legacy history collection is never touched.
+
+    Inserts and edits of this process wait while a partition is compressed,
+    writes of a bot running alongside `--apply-partition-policy` are not held.
+    """
+
+    def __init__(self) -> None:
+        self.compress_after: int | None = None
+        self.archive_after: int | None  = None
+        self.expire_after: int | None   = None
+
+    def configure(self, config: dict) -> None:
+        self.compress_after = config.get("compress_after", self.compress_after)
+        self.archive_after  = config.get("archive_after", self.archive_after)
+        self.expire_after   = config.get("expire_after", self.expire_after)
+
+        # the current partition still receives writes
+        for age in [self.compress_after, self.archive_after, self.expire_after]:
+            if age is not None and age<1:
+                raise ValueError(f"partition policy ages must be at least 1, got {age}")
+
+    @property
+    def enabled(self) -> bool:
+        return bool(mob.partition_by) and any(v is not None for v in [self.compress_after, self.archive_after, self.expire_after])
+
+
+    async def apply(self) -> None:
+        current = partition_range(partition_name(datetime.now(timezone.utc)))[0]
+        span    = 1 if mob.partition_by=="month" else 3
+
+        for collection in await history_partitions():
+            if collection.name==mob.history.name: continue
+
+            start = partition_range(collection.name)[0]
+            age   = ((current.year-start.year)*12 + current.month-start.month) // span
+
+            try:
+                if self.expire_after is not None and age>=self.expire_after:
+                    await self.expire(collection)
+                elif self.archive_after is not None and age>=self.archive_after:
+                    await self.archive(collection)
+                elif self.compress_after is not None and age>=self.compress_after:
+                    await self.compress(collection)
+            except Exception as e:
+                logger.warning(f"failed to apply partition policy to {collection.name}: {e}")
+
+        forget_partitions()
+
+    async def job(self, ctx: CallbackContext) -> None:
+        await self.apply()
+
+
+    async def compress(self, collection: AsyncIOMotorCollection) -> None:
+        options = await collection.options()
+        if "zstd" in options.get("storageEngine", {}).get("wiredTiger", {}).get("configString", ""): return
+
+        start_time = time.monotonic()
+        target = mob.database.get_collection(f"{collection.name}_zstd")
+        await target.drop()
+        await mob.database.create_collection(target.name, storageEngine={"wiredTiger": {"configString": "block_compressor=zstd"}})
+
+        # writes made during the copy would be lost by the rename
+        hold_partition(collection.name)
+        try:
+            batch = []
+            async for doc in collection.find({}).sort("_id", 1):
+                batch.append(doc)
+                if len(batch)>=COPY_BATCH_SIZE:
+                    await target.insert_many(batch, ordered=False)
+                    batch = []
+            if batch: await target.insert_many(batch, ordered=False)
+
+            await target.create_indexes(history_indexes())
+            await target.rename(collection.name, dropTarget=True)
+        finally:
+            release_partition(collection.name)
+        logger.info(f"compressed partition {collection.name} in {time.monotonic()-start_time:.1f} s")
+
+    async def archive(self, collection: AsyncIOMotorCollection) -> None:
+        await self._forget(collection)
+        await collection.drop_indexes()
+        await collection.rename(f"{ARCHIVE_PREFIX}{collection.name}")
+        logger.info(f"archived partition {collection.name}")
+
+    async def expire(self, collection: AsyncIOMotorCollection) -> None:
+        await self._forget(collection)
+        await collection.drop()
+        logger.info(f"expired partition {collection.name}")
+
+    async def _forget(self, collection: AsyncIOMotorCollection) -> None:
+        """Removes the messages of a partition from token statistics and posting lists."""
+        batch = []
+        async for doc in collection.find({}, projection={"tokens": 1, "len": 1}):
+            batch.append(doc)
+            if len(batch)>=COPY_BATCH_SIZE:
+                await tokenstats.record(batch, sign=-1)
+                batch = []
+        if batch: await tokenstats.record(batch, sign=-1)
+
+        # posting buckets are monthly and never span partitions
+        start, end = partition_range(collection.name)
+        await mob.tokens.delete_many({"b": {"$gte": start.year*100+start.month, "$lt": end.year*100+end.month}})
+
+
+partition_policy = PartitionPolicy()
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import time
+import uuid
+
+from telegram import Message
+from telegramify_markdown import markdownify
+
+from whaleyeah.httpclients import http_clients
+
+
+logger = logging.getLogger(__name__)
+
+
+def remove_credentials(content: str, credentials: list[str]) -> str:
+    for credential in credentials:
+        content = content.replace(credential, "*"*len(credential))
+    return content
+
+def without_images(message: dict) -> dict:
+    """
+    Persisted form of an OpenAI message, image parts are replaced by a text placeholder.
+
+    Their urls are Telegram file links, which contain the bot token and expire within an hour.
+    """
+    if not isinstance(message, dict) or not isinstance(message.get("content"), list): return message
+
+    content = []
+    for part in message["content"]:
+        if part.get("type")=="image_url": part = {"type": "text", "text": "[image]"}
+        elif part.get("type")=="input_image": part = {"type": "input_text", "text": "[image]"}
+        content.append(part)
+    return {**message, "content": content}
+
+
+class DraftStreamer:
+    """
+    Streams the partial output of an LLM into a message draft.
+
+    `update` sends at most one draft every `interval` seconds as MarkdownV2,
+    with an unclosed code block closed, falling back to plain text. With a
+    `typing_interval`, the typing action is refreshed along the drafts.
+    """
+
+    def __init__(self, reply_target: Message, draft_id: int, interval: float=0.5, typing_interval: float | None=None) -> None:
+        self.reply_target    = reply_target
+        self.bot             = reply_target.get_bot()
+        self.draft_id        = draft_id
+        self.thread_id       = getattr(reply_target, "message_thread_id", None)
+        self.interval        = interval
+        self.typing_interval = typing_interval
+
+        self._last_draft_time  = 0.0
+        self._last_typing_time = time.time()
+
+    async def update(self, text: str) -> None:
+        current_time = time.time()
+        if current_time - self._last_draft_time < self.interval: return
+        self._last_draft_time = current_time
+
+        if self.typing_interval and current_time - self._last_typing_time > self.typing_interval:
+            self._last_typing_time = current_time
+            asyncio.create_task(self.reply_target.reply_chat_action("typing"))
+
+        text = text.strip()
+        if not text: return
+
+        if text.count("```") % 2 != 0:
+            text += "\n```"
+
+        try:
+            md_text = markdownify(text)
+            await self.send(md_text or text, parse_mode="MarkdownV2")
+        except Exception:
+            try:
+                await self.send(text)
+            except Exception as e:
+                # Ignore specific Telegram API errors that are normal for some chat types or high freq updates
+                if not any(err in str(e) for err in ("Textdraft_peer_invalid", "Random_id_invalid")):
+                    logger.warning(f"failed to send draft: {e}")
+
+    async def send(self, text: str, parse_mode: str | None=None) -> None:
+        await self.bot.send_message_draft(
+            chat_id=self.reply_target.chat_id,
+            draft_id=self.draft_id,
+            text=text,
+            parse_mode=parse_mode,
+            message_thread_id=self.thread_id,
+        )
+
+    async def clear(self) -> None:
+        try:
+            await self.send("")
+        except Exception:
+            pass
+
+
+async def xgg_pb_link(text: str, title: str=str(uuid.uuid4())) -> str:
+    if len(title) > 40: title = title[:36] + "..."
+    text = f"# {title}\n" + text
+
+    resp = await http_clients.get("shz.al").post(
+        url   = "https://shz.al/",
+        files = {
+            "c": text,
+            "e": "3d",
+            "p": "true",
+        },
+        timeout = 10.0,
+    )
+
+    resp.raise_for_status()
+
+    resp = resp.json()
+    url  = resp["manageUrl"]
+    path = url.split("shz.al/")[-1]
+
+    return f"https://shz.al/a/{path}"
+
+
+async def tg_typing_manager(
+    long_task_coroutine,
+    periodic_task_func,
+    interval_seconds: int,
+    long_task_name: str = "ManagedLongTask",
+    poller_name: str = "PeriodicPoller"
+):
+
+    long_task = asyncio.create_task(long_task_coroutine, name=long_task_name)
+
+    long_task_final_result = None
+    long_task_exception = None
+    poller_task_exception = None
+
+    async def _poller():
+        try:
+            while not long_task.done():
+                await asyncio.sleep(interval_seconds)
+
+                if not long_task.done():
+                    await periodic_task_func()
+                else:
+                    break
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            nonlocal poller_task_exception
+            poller_task_exception = e
+
+    poller_task = asyncio.create_task(_poller(), name=poller_name)
+
+    try:
+        long_task_final_result = await long_task
+    except asyncio.CancelledError:
+        long_task_exception = asyncio.CancelledError() # 记录下来
+    except Exception as e:
+        long_task_exception = e # 记录下来
+
+
+    if not poller_task.done():
+        try:
+            await poller_task
+        except asyncio.CancelledError:
+            pass
+
+    if poller_task.done() and not poller_task.cancelled() and poller_task.exception() and not poller_task_exception:
+        poller_task_exception = poller_task.exception()
+
+    if long_task_exception:
+        raise long_task_exception
+
+    if poller_task_exception:
+        raise poller_task_exception
+
+    return long_task_final_result
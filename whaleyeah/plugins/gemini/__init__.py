@@ -1 +1,8 @@
-from .gemini_bot import get_handler
\ No newline at end of file
+from importlib import import_module
+
+# imported with the config, the handler module and google-genai only on the first command
+COMMAND = "gemini"
+MODULE  = ".gemini_bot"
+
+def get_handler(config: dict):
+    return import_module(MODULE, __name__).get_handler(config)
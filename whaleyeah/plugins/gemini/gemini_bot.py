@@ -1,9 +1,5 @@
 import logging
 import mimetypes
-import time
-
-import asyncio
-import httpx
 
 from telegram import Update
 from telegram.ext import ContextTypes, CommandHandler
@@ -15,17 +11,21 @@ from telegramify_markdown import markdownify
 from humanfriendly import format_size, parse_size
 from inflection import camelize
 
-from whaleyeah.plugins.openai_compatible import xgg_pb_link, remove_credentials
+from whaleyeah.admins import admin_cache
+from whaleyeah.conversations import Turn, conversation_key, conversation_store
+from whaleyeah.metrics import LLMTimer
+from whaleyeah.httpclients import http_clients
+from whaleyeah.tracing import span
+from whaleyeah.plugins.common import DraftStreamer, xgg_pb_link, remove_credentials
 
 
 logger = logging.getLogger(__name__)
 
 
 async def get_url_bytes(url: str, timeout: float=10.0) -> bytes:
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, follow_redirects=True, timeout=timeout)
-        response.raise_for_status()
-        return response.content
+    response = await http_clients.for_url(url).get(url, follow_redirects=True, timeout=timeout)
+    response.raise_for_status()
+    return response.content
 
 
 class GeminiBot:
@@ -34,11 +34,11 @@ class GeminiBot:
         self.model   = config.get("model", "gemini-2.5-flash-preview-09-2025")
         self.command = config.get("command", "gemini")
 
-        self.memory    = {}
-        self.mem_queue: list[None|str] = [None] * int(config.get("memory_size", 10))
+        conversation_store.limit(self.command, int(config.get("memory_size", 10)))
+        conversation_store.codec(self.command, lambda v: v.model_dump(mode="json", exclude_none=True), genai_types.Content.model_validate)
 
         self.whitelist_chat_ids: list[int] = config.get("whitelist_chat", [])
-        self.whitelist_cache: dict[int, bool] = {}
+        admin_cache.watch(self.whitelist_chat_ids)
 
         self.max_attach_size = parse_size(config.get("max_attachment_size", "10MiB"))
 
@@ -68,13 +68,11 @@ class GeminiBot:
         )
 
 
-    def remember(self, id: str, contents: list) -> None:
-        if id not in self.memory:
-            if victim_id:=self.mem_queue.pop(0):
-                self.memory.pop(victim_id, None)
-            self.mem_queue.append(id)
+    def remember(self, id: str, turn: Turn) -> None:
+        conversation_store.put(self.command, id, turn)
 
-        self.memory[id] = contents
+    async def recall(self, id: str) -> Turn | None:
+        return await conversation_store.recall(self.command, id)
 
 
     def get_callback(self) -> CommandHandler:
@@ -102,27 +100,10 @@ class GeminiBot:
 
             sender = update.effective_user
             if not sender: return
-            if sender.id in gemini.whitelist_cache:
-                if not gemini.whitelist_cache[sender.id]:
-                    return
-            else:
-                flag = False
-                try:
-                    for gid in gemini.whitelist_chat_ids:
-                        if not flag:
-                            xx = await update.get_bot().get_chat_administrators(chat_id=gid)
-                            if xx:
-                                xx = [it.user.id for it in xx]
-                                if sender.id in xx:
-                                    flag = True
-                                    break
-                except Exception as e:
-                    logger.warning(f"failed to get admin list: {e}")
-
-                gemini.whitelist_cache[sender.id] = flag
-                if not flag: return
+            if not await admin_cache.is_admin(update.get_bot(), sender.id, gemini.whitelist_chat_ids): return
 
 
+            history        = None
             contents       = []
             reply_target   = msg
             memory_id      = ""
@@ -131,7 +112,7 @@ class GeminiBot:
 
             if msg.reply_to_message:
                 reply_target = msg.reply_to_message
-                memory_id    = f"msg {reply_target.id} in chat {reply_target.chat_id}"
+                memory_id    = conversation_key(reply_target)
 
                 try:
                     if not reply_target.from_user.is_bot: # type: ignore
@@ -140,8 +121,7 @@ class GeminiBot:
                 except:
                     return
 
-                if memory_id in gemini.memory:
-                    contents.extend(gemini.memory[memory_id])
+                history = await gemini.recall(memory_id)
 
 
             if msg.caption:
@@ -213,94 +193,49 @@ class GeminiBot:
 
 
             if contents:
+                turn = Turn.extend(history, contents)
                 logger.debug(contents)
 
                 await reply_target.reply_chat_action("typing")
 
                 bot = update.get_bot()
-                chat_id = reply_target.chat_id
-                draft_id = update.update_id
-                thread_id = getattr(reply_target, "message_thread_id", None)
+                drafts = DraftStreamer(reply_target, draft_id=update.update_id, typing_interval=4.5)
 
                 msg = None
                 resp_text: str = ""
                 resp_image: genai_types.Image | None = None
-                last_draft_time = 0
-                last_typing_time = time.time()
 
                 try:
-                    stream = await gemini.client.aio.models.generate_content_stream(
-                        model=gemini.model,
-                        contents=contents,
-                        config=gemini.generate_config,
-                    )
-
-                    async for chunk in stream:
-                        if not chunk.candidates:
-                            continue
-
-                        for part in chunk.candidates[0].content.parts:
-                            if part.inline_data is not None:
-                                resp_image = part.as_image()
-                            for part_attr_name in ["text", "executable_code", "code_execution_result"]:
-                                part_attr_value = getattr(part, part_attr_name, None)
-                                if part_attr_value is not None:
-                                    if part_attr_name == "text":
-                                        resp_text += f"{part_attr_value}"
-                                    else:
-                                        resp_text += f"\n{part_attr_value}\n"
-
-                        current_time = time.time()
-
-                        if current_time - last_draft_time >= 0.5:
-                            last_draft_time = current_time
-
-                            if current_time - last_typing_time > 4.5:
-                                last_typing_time = current_time
-                                asyncio.create_task(reply_target.reply_chat_action("typing"))
-
-                            temp_text = resp_text.strip()
-                            if not temp_text:
+                    with LLMTimer("gemini", gemini.model) as timer:
+                        stream = await gemini.client.aio.models.generate_content_stream(
+                            model=gemini.model,
+                            contents=turn.messages(),
+                            config=gemini.generate_config,
+                        )
+
+                        async for chunk in stream:
+                            if not chunk.candidates:
                                 continue
+                            timer.first_token()
 
-                            if temp_text.count("```") % 2 != 0:
-                                temp_text += "\n```"
+                            for part in chunk.candidates[0].content.parts:
+                                if part.inline_data is not None:
+                                    resp_image = part.as_image()
+                                for part_attr_name in ["text", "executable_code", "code_execution_result"]:
+                                    part_attr_value = getattr(part, part_attr_name, None)
+                                    if part_attr_value is not None:
+                                        if part_attr_name == "text":
+                                            resp_text += f"{part_attr_value}"
+                                        else:
+                                            resp_text += f"\n{part_attr_value}\n"
 
-                            try:
-                                md_text = markdownify(temp_text)
-                                if not md_text:
-                                    md_text = temp_text
-
-                                await bot.send_message_draft(
-                                    chat_id=chat_id,
-                                    draft_id=draft_id,
-                                    text=md_text,
-                                    parse_mode="MarkdownV2",
-                                    message_thread_id=thread_id
-                                )
-                            except Exception:
-                                try:
-                                    await bot.send_message_draft(
-                                        chat_id=chat_id,
-                                        draft_id=draft_id,
-                                        text=temp_text,
-                                        message_thread_id=thread_id
-                                    )
-                                except Exception as e:
-                                    # Ignore specific Telegram API errors that are normal for some chat types or high freq updates
-                                    if not any(err in str(e) for err in ("Textdraft_peer_invalid", "Random_id_invalid")):
-                                        logger.warning(f"failed to send draft: {e}")
+                            await drafts.update(resp_text)
 
                 except Exception as e:
                     error_str = remove_credentials(f"{e}", bot.token.split(":"))
                     resp_text += f"\n\n❌ 生成内容时出错:\n{error_str}"
                     try:
-                        await bot.send_message_draft(
-                            chat_id=chat_id,
-                            draft_id=draft_id,
-                            text=resp_text,
-                            message_thread_id=thread_id
-                        )
+                        await drafts.send(resp_text)
                     except Exception:
                         pass
 
@@ -309,7 +244,8 @@ class GeminiBot:
                     if resp_text:
                         # Covert to markdown, if failed or too long, send a pastebin link instead.
                         try:
-                            markdown_resp = markdownify(resp_text)
+                            with span("markdownify"):
+                                markdown_resp = markdownify(resp_text)
                         except Exception as e:
                             logger.error(f"failed to markdownify: {e}")
                             markdown_resp = resp_text + " " * max(5000 - len(resp_text), 100)
@@ -326,15 +262,7 @@ class GeminiBot:
                                 msg = await reply_target.reply_text(resp_text)
 
                         # Clear draft
-                        try:
-                            await bot.send_message_draft(
-                                chat_id=chat_id,
-                                draft_id=draft_id,
-                                text="",
-                                message_thread_id=thread_id
-                            )
-                        except Exception:
-                            pass
+                        await drafts.clear()
 
                     # If there's an image, send it as well.
                     if resp_image:
@@ -343,8 +271,7 @@ class GeminiBot:
 
                     # If reply successful, remember the conversation.
                     if msg and resp_text:
-                        contents.append(genai_types.ModelContent(resp_text))
-                        gemini.remember(f"msg {msg.id} in chat {msg.chat_id}", contents=contents)
+                        gemini.remember(conversation_key(msg), Turn(turn, genai_types.ModelContent(resp_text)))
 
                 except Exception as e:
                     logger.error(e)
@@ -1 +1,8 @@
-from .openaibot import get_handler
\ No newline at end of file
+from importlib import import_module
+
+# imported with the config, the handler module and the openai sdk only on the first command
+COMMAND = "openai"
+MODULE  = ".openaibot"
+
+def get_handler(config: dict):
+    return import_module(MODULE, __name__).get_handler(config)
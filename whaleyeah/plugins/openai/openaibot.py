@@ -7,10 +7,15 @@ import mimetypes
 from telegram import Update
 from telegram.ext import ContextTypes, CommandHandler
 
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, BadRequestError
 from telegramify_markdown import markdownify
 
-from whaleyeah.plugins.openai_compatible import xgg_pb_link, tg_typing_manager
+from whaleyeah.admins import admin_cache
+from whaleyeah.conversations import Turn, conversation_key, conversation_store
+from whaleyeah.httpclients import http_clients
+from whaleyeah.metrics import LLMTimer
+from whaleyeah.tracing import span
+from whaleyeah.plugins.common import DraftStreamer, xgg_pb_link, tg_typing_manager, without_images
 
 
 logger = logging.getLogger(__name__)
@@ -22,18 +27,22 @@ class OpenAIBot:
     def __init__(self, config: dict) -> None:
         self._API_KEY   = config["api_key"]
         self._MODEL     = config["model"]
-        self._mem_queue = [None] * config["memory_size"]
-        self._memory    = {}
         self._wlchatids = config["whitelist_chat"]
-        self._whitelist = {}
+        admin_cache.watch(self._wlchatids)
         self._create_params = config.get("create_params", {})
+        self._client = AsyncOpenAI(api_key=self._API_KEY, http_client=http_clients.get("api.openai.com"))
 
         self._use_responses_api = self._MODEL.lower().startswith("gpt-5")
+        # streaming newest models requires a verified organization
+        self._stream_responses  = config.get("stream_responses", True)
 
         if "command" in config:
             global __COMMAND__
             __COMMAND__ = config["command"]
 
+        conversation_store.limit(__COMMAND__, config["memory_size"])
+        conversation_store.codec(__COMMAND__, without_images, None)
+
     @property
     def model(self) -> str:
         return self._MODEL
@@ -41,23 +50,14 @@ class OpenAIBot:
     def create_params(self) -> dict:
         return self._create_params
     @property
-    def whitelist(self) -> dict:
-        return self._whitelist
-    @property
     def whitelist_chat_ids(self) -> list:
         return self._wlchatids
     @property
     def use_responses_api(self) -> bool:
         return self._use_responses_api
 
-    def remember(self, messages: list, id: str) -> None:
-        if id in self._memory:
-            self._memory[id] = messages
-        else:
-            victim = self._mem_queue.pop(0)
-            if victim: self._memory.__delitem__(victim)
-            self._mem_queue.append(id)
-            self._memory[id] = messages
+    def remember(self, turn: Turn, id: str) -> None:
+        conversation_store.put(__COMMAND__, id, turn)
 
     async def python_exec(self, input: str) -> str:
         lines = input.strip().splitlines()
@@ -81,38 +81,64 @@ class OpenAIBot:
 
         return output
 
-    async def request(self, message: dict, id: str="") -> tuple[str, list]:
-        client = AsyncOpenAI(api_key=self._API_KEY)
+    async def request(self, message: dict, id: str="", drafts: DraftStreamer | None=None) -> tuple[str, Turn]:
+        client = self._client
 
-        messages = self._memory[id] if id in self._memory else []
-        messages.append(message)
+        turn     = Turn(await conversation_store.recall(__COMMAND__, id) if id else None, message)
+        messages = turn.messages()
 
 
         if not self.use_responses_api:
-            stream = await client.chat.completions.create(
-                messages=messages,
-                model=self.model,
-                stream=True,
-            )
-
             output_text = ""
-            async for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    output_text += chunk.choices[0].delta.content
-
-            messages.append({
+            with LLMTimer("openai", self.model) as timer:
+                stream = await client.chat.completions.create(
+                    messages=messages,
+                    model=self.model,
+                    stream=True,
+                )
+
+                async for chunk in stream:
+                    if chunk.choices[0].delta.content:
+                        timer.first_token()
+                        output_text += chunk.choices[0].delta.content
+                        if drafts: await drafts.update(output_text)
+
+            turn = Turn(turn, {
                 "role": "assistant",
                 "content": output_text,
             })
         else:
-            # streaming newest models requires verification
-            resp = await client.responses.create(
-                input=messages,
-                model=self.model,
-                **self.create_params,
-            )
-            output_text = resp.output_text
-            messages.append({
+            output_text = ""
+            with LLMTimer("openai", self.model) as timer:
+                if self._stream_responses:
+                    try:
+                        stream = await client.responses.create(
+                            input=messages,
+                            model=self.model,
+                            stream=True,
+                            **self.create_params,
+                        )
+                    except BadRequestError as e:
+                        if e.param!="stream": raise
+                        logger.warning(f"failed to stream {self.model}, falling back to non-streaming responses: {e}")
+                        self._stream_responses = False
+
+                if self._stream_responses:
+                    async for event in stream:
+                        if event.type=="response.output_text.delta":
+                            timer.first_token()
+                            output_text += event.delta
+                            if drafts: await drafts.update(output_text)
+                else:
+                    resp = await client.responses.create(
+                        input=messages,
+                        model=self.model,
+                        **self.create_params,
+                    )
+                    timer.first_token()
+                    output_text = resp.output_text
+
+            turn = Turn(turn, {
                 "role": "assistant",
                 "content": output_text,
             })
@@ -144,7 +170,7 @@ class OpenAIBot:
 
 
 
-        return output_text, messages
+        return output_text, turn
 
 
 oai: OpenAIBot = None
@@ -170,25 +196,7 @@ async def openai_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     sender = update.effective_user
     if not sender: return
-    if sender.id in oai.whitelist:
-        if not oai.whitelist[sender.id]:
-            return
-    else:
-        flag = False
-        try:
-            for gid in oai.whitelist_chat_ids:
-                if not flag:
-                    xx = await update.get_bot().get_chat_administrators(chat_id=gid)
-                    if xx:
-                        xx = [it.user.id for it in xx]
-                        if sender.id in xx:
-                            flag = True
-                            break
-        except Exception as e:
-            logger.warning(f"failed to get admin list: {e}")
-
-        oai.whitelist[sender.id] = flag
-        if not flag: return
+    if not await admin_cache.is_admin(update.get_bot(), sender.id, oai.whitelist_chat_ids): return
 
 
     memory_id    = ""
@@ -198,7 +206,7 @@ async def openai_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     if msg.reply_to_message:
         reply_target = msg.reply_to_message
-        memory_id    = f"{reply_target.chat_id}<-{reply_target.id}"
+        memory_id    = conversation_key(reply_target)
 
         try:
             if not reply_target.from_user.is_bot:
@@ -267,25 +275,32 @@ async def openai_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
         await reply_typing_wrapper()
 
+        drafts = DraftStreamer(reply_target, draft_id=update.update_id)
+
         try:
-            # resp, messages = await oai.request(message, memory_id)
-            resp, messages = await tg_typing_manager(
-                oai.request(message, memory_id),
+            # resp, turn = await oai.request(message, memory_id)
+            resp, turn = await tg_typing_manager(
+                oai.request(message, memory_id, drafts),
                 reply_typing_wrapper,
                 interval_seconds = 5,
             )
 
-            if len(markdown_resp := markdownify(resp)) > 4000:
+            with span("markdownify"):
+                markdown_resp = markdownify(resp)
+            if len(markdown_resp) > 4000:
                 pb_url = await xgg_pb_link(resp, effective_text)
                 logger.info(f"too long response from openai, upload to pastebin: {pb_url}")
                 msg = await reply_target.reply_text(pb_url)
             else:
                 msg = await reply_target.reply_markdown_v2(markdown_resp)
 
+            await drafts.clear()
+
             if msg:
-                oai.remember(messages, f"{msg.chat_id}<-{msg.id}")
+                oai.remember(turn, conversation_key(msg))
         except Exception as e:
             logger.error(e)
+            await drafts.clear()
             error_str = f"{e}"
             for token_part in update.get_bot().token.split(":"):
                 error_str = error_str.replace(token_part, "*"*len(token_part))
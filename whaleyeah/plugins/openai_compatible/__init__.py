@@ -1,2 +1,10 @@
-from .openaibot_compatible import get_handler
-from .openaibot_compatible import xgg_pb_link, tg_typing_manager, remove_credentials
\ No newline at end of file
+from importlib import import_module
+
+from ..common import xgg_pb_link, tg_typing_manager, remove_credentials
+
+# imported with the config, the handler module and the openai sdk only on the first command
+COMMAND = None # required in the plugin config
+MODULE  = ".openaibot_compatible"
+
+def get_handler(config: dict):
+    return import_module(MODULE, __name__).get_handler(config)
@@ -1,9 +1,5 @@
 import logging
 import mimetypes
-import uuid
-
-import asyncio
-import httpx
 
 from telegram import Update
 from telegram.ext import ContextTypes, CommandHandler
@@ -11,6 +7,13 @@ from telegram.ext import ContextTypes, CommandHandler
 from openai import AsyncOpenAI
 from telegramify_markdown import markdownify
 
+from whaleyeah.admins import admin_cache
+from whaleyeah.conversations import Turn, conversation_key, conversation_store
+from whaleyeah.httpclients import http_clients
+from whaleyeah.metrics import LLMTimer
+from whaleyeah.tracing import span
+from whaleyeah.plugins.common import DraftStreamer, xgg_pb_link, tg_typing_manager, remove_credentials, without_images
+
 logger = logging.getLogger(__name__)
 
 oai_comp_dict = dict()
@@ -19,40 +22,29 @@ class OpenAICompBot:
     def __init__(self, config: dict) -> None:
         self._API_KEY   = config["api_key"]
         self._MODEL     = config["model"]
-        self._mem_queue = [None] * config["memory_size"]
-        self._memory    = {}
         self._wlchatids = config["whitelist_chat"]
-        self._whitelist = {}
+        admin_cache.watch(self._wlchatids)
         self._endpoint  = config["endpoint"]
         self._command   = config["command"]
+        conversation_store.limit(self._command, config["memory_size"])
+        conversation_store.codec(self._command, without_images, None)
+        self._client    = AsyncOpenAI(api_key=self._API_KEY, base_url=self._endpoint, http_client=http_clients.for_url(self._endpoint))
 
     @property
     def model(self) -> str:
         return self._MODEL
     @property
-    def whitelist(self) -> dict:
-        return self._whitelist
-    @property
     def whitelist_chat_ids(self) -> list:
         return self._wlchatids
 
-    def remember(self, messages: list, id: str) -> None:
-        if id in self._memory:
-            self._memory[id] = messages
-        else:
-            victim = self._mem_queue.pop(0)
-            if victim: self._memory.__delitem__(victim)
-            self._mem_queue.append(id)
-            self._memory[id] = messages
+    def remember(self, turn: Turn, id: str) -> None:
+        conversation_store.put(self._command, id, turn)
 
-    async def request(self, message: dict, id: str="") -> str:
-        client = AsyncOpenAI(
-            api_key=self._API_KEY,
-            base_url=self._endpoint
-        )
+    async def request(self, message: dict, id: str="", drafts: DraftStreamer | None=None) -> tuple[str, Turn]:
+        client = self._client
 
-        messages = self._memory[id] if id in self._memory else []
-        messages.append(message)
+        turn     = Turn(await conversation_store.recall(self._command, id) if id else None, message)
+        messages = turn.messages()
 
         resp = ""
         trial_count = 0
@@ -67,18 +59,21 @@ class OpenAICompBot:
                 logger.warning(f"/{self._command} get empty response, retry ({trial_count}/3)")
 
             try:
-                stream = await client.chat.completions.create(
-                    messages=messages,
-                    model=self._MODEL,
-                    stream=True,
-                )
-                async for chunk in stream:
-                    if chunk.choices[0].delta.content:
-                        if (not resp) and (chunk.choices[0].delta.content.startswith("<think>")): think_flag = True
-                        if think_flag:
-                            if "</think>" in chunk.choices[0].delta.content: think_flag = False
-                        else:
-                            resp += chunk.choices[0].delta.content
+                with LLMTimer(self._command, self._MODEL) as timer:
+                    stream = await client.chat.completions.create(
+                        messages=messages,
+                        model=self._MODEL,
+                        stream=True,
+                    )
+                    async for chunk in stream:
+                        if chunk.choices[0].delta.content:
+                            timer.first_token()
+                            if (not resp) and (chunk.choices[0].delta.content.startswith("<think>")): think_flag = True
+                            if think_flag:
+                                if "</think>" in chunk.choices[0].delta.content: think_flag = False
+                            else:
+                                resp += chunk.choices[0].delta.content
+                                if drafts: await drafts.update(resp)
             except Exception as e:
                 if resp: resp += f"\nError: {e}"
             finally:
@@ -87,12 +82,12 @@ class OpenAICompBot:
 
         if not resp: resp = "API未返回错误信息，但回复为空。"
 
-        messages.append({
+        turn = Turn(turn, {
             "role": "assistant",
             "content": resp.strip(),
         })
 
-        return resp, messages
+        return resp, turn
 
 
 oai = None
@@ -108,92 +103,6 @@ def get_handler(config: dict) -> CommandHandler:
         callback=openai_callback,
     )
 
-def remove_credentials(content: str, credentials: list[str]) -> str:
-    for credential in credentials:
-        content = content.replace(credential, "*"*len(credential))
-    return content
-
-
-async def xgg_pb_link(text: str, title: str=str(uuid.uuid4())) -> str:
-    if len(title) > 40: title = title[:36] + "..."
-    text = f"# {title}\n" + text
-
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        resp = await client.post(
-            url   = "https://shz.al/",
-            files = {
-                "c": text,
-                "e": "3d",
-                "p": "true",
-            },
-        )
-
-        resp.raise_for_status()
-
-        resp = resp.json()
-        url  = resp["manageUrl"]
-        path = url.split("shz.al/")[-1]
-
-    return f"https://shz.al/a/{path}"
-
-
-async def tg_typing_manager(
-    long_task_coroutine,
-    periodic_task_func,
-    interval_seconds: int,
-    long_task_name: str = "ManagedLongTask",
-    poller_name: str = "PeriodicPoller"
-):
-
-    long_task = asyncio.create_task(long_task_coroutine, name=long_task_name)
-
-    long_task_final_result = None
-    long_task_exception = None
-    poller_task_exception = None
-
-    async def _poller():
-        try:
-            while not long_task.done():
-                await asyncio.sleep(interval_seconds)
-
-                if not long_task.done():
-                    await periodic_task_func()
-                else:
-                    break
-        except asyncio.CancelledError:
-            pass
-        except Exception as e:
-            nonlocal poller_task_exception
-            poller_task_exception = e
-
-    poller_task = asyncio.create_task(_poller(), name=poller_name)
-
-    try:
-        long_task_final_result = await long_task
-    except asyncio.CancelledError:
-        long_task_exception = asyncio.CancelledError() # 记录下来
-    except Exception as e:
-        long_task_exception = e # 记录下来
-
-
-    if not poller_task.done():
-        try:
-            await poller_task
-        except asyncio.CancelledError:
-            pass
-
-    if poller_task.done() and not poller_task.cancelled() and poller_task.exception() and not poller_task_exception:
-        poller_task_exception = poller_task.exception()
-
-    if long_task_exception:
-        raise long_task_exception
-
-    if poller_task_exception:
-        raise poller_task_exception
-
-    return long_task_final_result
-
-
 
 async def openai_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # logger.debug(f"openai!! {update}")
@@ -215,25 +124,7 @@ async def openai_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     sender = update.effective_user
     if not sender: return
-    if sender.id in oai.whitelist:
-        if not oai.whitelist[sender.id]:
-            return
-    else:
-        flag = False
-        try:
-            for gid in oai.whitelist_chat_ids:
-                if not flag:
-                    xx = await update.get_bot().get_chat_administrators(chat_id=gid)
-                    if xx:
-                        xx = [it.user.id for it in xx]
-                        if sender.id in xx:
-                            flag = True
-                            break
-        except Exception as e:
-            logger.warning(f"failed to get admin list: {e}")
-
-        oai.whitelist[sender.id] = flag
-        if not flag: return
+    if not await admin_cache.is_admin(update.get_bot(), sender.id, oai.whitelist_chat_ids): return
 
 
     memory_id    = ""
@@ -243,7 +134,7 @@ async def openai_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     if msg.reply_to_message:
         reply_target = msg.reply_to_message
-        memory_id    = f"{reply_target.chat_id}<-{reply_target.id}"
+        memory_id    = conversation_key(reply_target)
 
         try:
             if not reply_target.from_user.is_bot:
@@ -314,26 +205,33 @@ async def openai_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
         await reply_typing_wrapper()
 
+        drafts = DraftStreamer(reply_target, draft_id=update.update_id)
+
         try:
-            # resp, messages = await oai.request(message, memory_id)
-            resp, messages = await tg_typing_manager(
-                oai.request(message, memory_id),
+            # resp, turn = await oai.request(message, memory_id)
+            resp, turn = await tg_typing_manager(
+                oai.request(message, memory_id, drafts),
                 reply_typing_wrapper,
                 interval_seconds = 5,
             )
 
             resp = remove_credentials(resp, update.get_bot().token.split(":"));
-            if len(markdown_resp := markdownify(resp)) > 4000:
+            with span("markdownify"):
+                markdown_resp = markdownify(resp)
+            if len(markdown_resp) > 4000:
                 pb_url = await xgg_pb_link(resp, effective_text)
                 logger.info(f"too long response from {command}, upload to pastebin: {pb_url}")
                 msg = await reply_target.reply_text(pb_url)
             else:
                 msg = await reply_target.reply_markdown_v2(markdown_resp)
 
+            await drafts.clear()
+
             if msg:
-                oai.remember(messages, f"{msg.chat_id}<-{msg.id}")
+                oai.remember(turn, conversation_key(msg))
         except Exception as e:
             logger.error(e)
+            await drafts.clear()
             error_str = remove_credentials(f"{e}", update.get_bot().token.split(":"))
             await reply_target.reply_text(error_str)
 
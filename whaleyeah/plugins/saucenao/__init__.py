@@ -1 +1,8 @@
-from .saucenao import get_handler
\ No newline at end of file
+from importlib import import_module
+
+# imported with the config, the handler module only on the first command
+COMMAND = "saucenao"
+MODULE  = ".saucenao"
+
+def get_handler(config: dict):
+    return import_module(MODULE, __name__).get_handler(config)
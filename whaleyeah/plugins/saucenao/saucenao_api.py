@@ -1,7 +1,8 @@
 from typing import Optional, BinaryIO
 
 import enum
-import httpx
+
+from whaleyeah.httpclients import http_clients
 
 
 _TIMEOUT_ = 5
@@ -245,8 +246,7 @@ class SauceNao:
         return await self._search(params)
 
     async def _search(self, params, files=None):
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(self.SAUCENAO_URL, params=params, files=files, timeout=_TIMEOUT_)
+        resp = await http_clients.for_url(self.SAUCENAO_URL).post(self.SAUCENAO_URL, params=params, files=files, timeout=_TIMEOUT_)
         status_code = resp.status_code
 
         if status_code == 200:
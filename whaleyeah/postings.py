@@ -0,0 +1,115 @@
+import logging
+
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from . import partitions
+from .database import mob
+
+
+logger = logging.getLogger(__name__)
+
+# postings of a token are grouped by month, a bucket document holds at most BUCKET_SIZE of them
+BUCKET_SIZE = 1024
+
+
+def bucket_of(date: datetime) -> int:
+    return date.year*100 + date.month
+
+def _naive_utc(date: datetime) -> datetime:
+    return date.astimezone(timezone.utc).replace(tzinfo=None) if date.tzinfo else date
+
+
+async def add(docs: list[dict]) -> None:
+    """Appends (date, _id) of freshly inserted history documents to the posting list of each token."""
+    ops = [
+        UpdateOne(
+            {"t": token, "b": bucket_of(doc["date"]), "n": {"$lt": BUCKET_SIZE}},
+            {"$push": {"p": [doc["date"], doc["_id"]]}, "$inc": {"n": 1}},
+            upsert=True,
+        )
+        for doc in docs for token in doc["tokens"]
+    ]
+    if ops: await mob.tokens.bulk_write(ops, ordered=False)
+
+async def update(old: dict, new_tokens: list[str]) -> None:
+    """Moves the postings of an edited history document, `old` carries its previous _id, date and tokens."""
+    posting = [old["date"], old["_id"]]
+    bucket  = bucket_of(old["date"])
+
+    ops = [
+        UpdateOne({"t": token, "b": bucket, "p": posting}, {"$pull": {"p": posting}, "$inc": {"n": -1}})
+        for token in set(old.get("tokens", [])) - set(new_tokens)
+    ]
+    ops += [
+        UpdateOne(
+            {"t": token, "b": bucket, "n": {"$lt": BUCKET_SIZE}},
+            {"$push": {"p": posting}, "$inc": {"n": 1}},
+            upsert=True,
+        )
+        for token in set(new_tokens) - set(old.get("tokens", []))
+    ]
+    if ops: await mob.tokens.bulk_write(ops, ordered=False)
+
+
+async def posting_sizes(tokens: list[str]) -> dict[str, int]:
+    cursor = mob.tokens.aggregate([
+        {"$match": {"t": {"$in": tokens}}},
+        {"$group": {"_id": "$t", "n": {"$sum": "$n"}}},
+    ])
+    return {v["_id"]: v["n"] async for v in cursor}
+
+
+async def _bucket_postings(token: str, bucket: int, candidates: list[ObjectId] | None=None) -> list[list]:
+    pipeline = [{"$match": {"t": token, "b": bucket}}]
+    if candidates is not None:
+        # intersect on the server, only matching postings are sent back
+        pipeline.append({"$project": {"p": {"$filter": {
+            "input": "$p",
+            "cond": {"$in": [{"$arrayElemAt": ["$$this", 1]}, candidates]},
+        }}}})
+    pipeline.append({"$unwind": "$p"})
+    pipeline.append({"$replaceRoot": {"newRoot": {"p": "$p"}}})
+
+    return [v["p"] async for v in mob.tokens.aggregate(pipeline)]
+
+
+async def search(tokens: list[str], limit: int, skip: int=0, after: tuple[datetime, ObjectId] | None=None, projection: dict | None=None) -> list[dict]:
+    """
+    Newest-first history documents containing all `tokens`.
+
+    Posting lists are intersected bucket by bucket starting with the rarest
+    token, and the walk stops as soon as `skip+limit` matches are found.
+    `after` is the (date, _id) keyset position of the previous page.
+    """
+    sizes = await posting_sizes(tokens)
+    if len(sizes)<len(set(tokens)): return []
+
+    tokens = sorted(set(tokens), key=lambda v: sizes[v])
+    after  = (_naive_utc(after[0]), after[1]) if after else None
+
+    bucket_filter = {"t": tokens[0]}
+    if after: bucket_filter["b"] = {"$lte": bucket_of(after[0])}
+    buckets = await mob.tokens.distinct("b", bucket_filter)
+
+    matches = []
+    for bucket in sorted(buckets, reverse=True):
+        postings = await _bucket_postings(tokens[0], bucket)
+        if after:
+            postings = [v for v in postings if (_naive_utc(v[0]), v[1])<after]
+
+        for token in tokens[1:]:
+            if not postings: break
+            postings = await _bucket_postings(token, bucket, [v[1] for v in postings])
+
+        postings.sort(key=lambda v: (v[0], v[1]), reverse=True)
+        matches += postings
+        if len(matches)>=skip+limit: break
+
+    page = matches[skip:skip+limit]
+    if not page: return []
+
+    docs = await partitions.fetch(page, projection=projection)
+    return [docs[v[1]] for v in page if v[1] in docs]
@@ -0,0 +1,87 @@
+import math
+import time
+
+from datetime import datetime, timezone
+
+import numpy as np
+
+from .database import history_partitions
+
+
+BM25_K1 = 1.2
+BM25_B  = 0.75
+
+# the BM25 score of a message decays to RECENCY_FLOOR of its value as it ages
+RECENCY_HALF_LIFE = 30*24*3600
+RECENCY_FLOOR     = 0.5
+
+# newest matches which get ranked, older ones are not considered
+RELEVANCE_CANDIDATES = 2000
+
+
+async def candidates(filter: dict, query_tokens: list[str], projection: dict) -> list[dict]:
+    """Newest matches of `filter` with the term frequency of each query token ("qtf") and their length ("dl")."""
+    project = {k: v for (k, v) in projection.items() if v}
+    project["qtf"] = {"$map": {
+        "input": query_tokens,
+        "as": "q",
+        "in": {"$let": {
+            "vars": {"k": {"$indexOfArray": [{"$ifNull": ["$tokens", []]}, "$$q"]}},
+            # documents without stored frequencies count every token once
+            "in": {"$cond": [{"$lt": ["$$k", 0]}, 0, {"$ifNull": [{"$arrayElemAt": ["$tf", "$$k"]}, 1]}]},
+        }},
+    }}
+    project["dl"] = {"$ifNull": ["$len", {"$size": {"$ifNull": ["$tokens", []]}}]}
+
+    docs = []
+    for collection in await history_partitions():
+        cursor = collection.aggregate([
+            {"$match": filter},
+            {"$sort": {"date": -1, "_id": -1}},
+            {"$limit": RELEVANCE_CANDIDATES-len(docs)},
+            {"$project": project},
+        ])
+        docs += [doc async for doc in cursor]
+        if len(docs)>=RELEVANCE_CANDIDATES: break
+
+    return docs
+
+
+def rank(docs: list[dict], freq: list[int], total: int, total_len: int, now: float | None=None) -> list[dict]:
+    """
+    Sorts candidates by BM25 times a recency decay, best first.
+
+    `freq` holds the document frequency of each query token in the order of
+    "qtf", `total` and `total_len` the number of documents and their summed
+    length. Without trusted statistics (`total` 0) every token gets the same
+    idf and the candidates stand in for the average length.
+    """
+    if not docs: return []
+
+    tf = np.array([doc["qtf"] for doc in docs], dtype=np.float64)
+    dl = np.array([doc["dl"] or 1 for doc in docs], dtype=np.float64)
+    ts = np.array([_timestamp(doc["date"]) for doc in docs], dtype=np.float64)
+
+    if total>0:
+        df    = np.array(freq, dtype=np.float64)
+        idf   = np.log1p((total - df + 0.5) / (df + 0.5))
+        avgdl = total_len/total if total_len>0 else dl.mean()
+    else:
+        idf, avgdl = np.ones(tf.shape[1]), dl.mean()
+
+    norm = BM25_K1 * (1 - BM25_B + BM25_B*dl/avgdl)
+    bm25 = (idf * tf * (BM25_K1+1) / (tf + norm[:, None])).sum(axis=1)
+
+    # stable on ties, candidates are newest first
+    order = np.argsort(-(bm25*recency(ts, now)), kind="stable")
+    return [docs[k] for k in order]
+
+
+def recency(ts: np.ndarray, now: float | None=None) -> np.ndarray:
+    """Decay factors of messages sent at unix times `ts`, from 1 for new ones down to RECENCY_FLOOR."""
+    age = np.maximum((now or time.time()) - ts, 0)
+    return RECENCY_FLOOR + (1-RECENCY_FLOOR) * np.exp(-math.log(2) * age / RECENCY_HALF_LIFE)
+
+
+def _timestamp(date: datetime) -> float:
+    return (date if date.tzinfo else date.replace(tzinfo=timezone.utc)).timestamp()
@@ -0,0 +1,98 @@
+import logging
+import re
+
+from telegram import Update
+from telegram.ext import CommandHandler, ContextTypes, MessageHandler
+
+from .iwaku import _iwaku_history_callback, _iwaku_locate, __LOCATE_COMMAND__
+from .megaphone import megaphone
+
+
+logger = logging.getLogger(__name__)
+
+# names which telegram marks as bot commands
+BOT_COMMAND = re.compile(r"[A-Za-z0-9_]{1,32}")
+
+
+class Command:
+    """"/name@bot rest" at the start of a message text or caption."""
+
+    def __init__(self, name: str, bot: str, rest: str) -> None:
+        self.name = name
+        self.bot  = bot
+        self.rest = rest
+        self.args = rest.split()
+
+def parse_command(text: str | None) -> Command | None:
+    if not text or text[0]!="/": return None
+
+    parts = text.strip().split(maxsplit=1)
+    name, _, bot = parts[0][1:].partition("@")
+    if not name: return None
+
+    return Command(name, bot, parts[1] if len(parts)>1 else "")
+
+
+class Router:
+    """
+    Single handler of all message updates.
+
+    Each message is parsed once and dispatched in one pass: commands of
+    plugins are looked up by name and run if their CommandHandler accepts
+    the update or the command starts a caption, otherwise the megaphone,
+    the portal and the history stages are tried in this order.
+    """
+
+    def __init__(self) -> None:
+        self.commands: dict[str, CommandHandler] = {}
+
+        self.megaphone = megaphone
+        self.portal    = _iwaku_locate
+        self.history   = _iwaku_history_callback
+
+    def add_command(self, handler: CommandHandler) -> None:
+        for command in handler.commands:
+            if command in self.commands:
+                logger.warning(f"/{command} is registered more than once, the last handler wins")
+            self.commands[command] = handler
+
+    def handler(self) -> MessageHandler:
+        return MessageHandler(filters=None, callback=self.dispatch)
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        msg = update.effective_message
+        if not msg: return
+
+        command = parse_command(msg.text or msg.caption)
+        if command:
+            # commands addressed to other bots are theirs
+            if command.bot and command.bot.lower()!=context.bot.username.lower(): return
+
+            handler = self.commands.get(command.name.lower())
+            if handler and not msg.text:
+                # CommandHandler only matches texts, the chat plugins also take a prompt in a photo caption
+                context.args = command.args
+                await handler.callback(update, context)
+                return
+
+            # the handler applies its own filters and sets context.args
+            check = handler.check_update(update) if handler else None
+            if check:
+                await handler.handle_update(update, context.application, check, context)
+                return
+
+            relayed = msg.via_bot or msg.forward_origin or (update.effective_user and update.effective_user.is_bot)
+            if msg.text and not relayed:
+                if await self.megaphone(update, command.name, command.rest): return
+
+            if command.name==__LOCATE_COMMAND__[1:]:
+                await self.portal(update, command.args)
+                return
+
+            # unknown bot commands are not kept in the history
+            if msg.text and BOT_COMMAND.fullmatch(command.name): return
+
+        await self.history(update, context)
+
+
+router = Router()
@@ -1,5 +1,10 @@
+import asyncio
+import datetime
 import logging
 import json
+import time
+
+import jieba
 
 from os import PathLike
 from importlib import import_module
@@ -10,11 +15,46 @@ from telegram.ext import CommandHandler
 from telegramify_markdown import markdownify
 from telegramify_markdown.config import get_runtime_config
 
-from .iwaku import iwaku_history_handler, iwaku_inline_handler, iwaku_locate_handler, iwaku_plugins_copy
-from .database import init_database
+from .iwaku import iwaku_inline_handler
+from .admins import admin_cache
+from .conversations import conversation_store, conversation_writer
+from .database import mob
+from .httpclients import http_clients
+from .ingest import history_writer
+from .metrics import InstrumentedRequest, instrument_callback, instrument_job, metrics_server
+from .partitions import partition_policy
+from .router import router
+from .storage import init_storage
+from .tokenizer import tokenizer
+from .tracing import tracer
 
 
 plugins_dict = {}
+_background_tasks: set[asyncio.Task] = set()
+
+
+class StartupReport:
+    """Durations of the startup phases, logged once the bot is about to accept updates."""
+
+    def __init__(self) -> None:
+        self.start()
+
+    def start(self) -> None:
+        self.phases: list[tuple[str, float]] = []
+        self._last = time.perf_counter()
+
+    def phase(self, name: str) -> None:
+        now = time.perf_counter()
+        self.phases.append((name, now-self._last))
+        self._last = now
+
+    def log(self) -> None:
+        total  = sum(v for (_, v) in self.phases)
+        phases = ", ".join(f"{k} {1000*v:.0f}ms" for (k, v) in self.phases)
+        logging.getLogger(__name__).info(f"ready after {1000*total:.0f}ms ({phases})")
+
+startup_report = StartupReport()
+
 
 async def hello_world(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_markdown(
@@ -28,7 +68,71 @@ async def _helper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
     )
 
-def serve_config(config: PathLike) -> None:
+def _spawn(coro, name: str) -> asyncio.Task:
+    task = asyncio.create_task(coro, name=name)
+    _background_tasks.add(task)
+
+    def _done(task: asyncio.Task) -> None:
+        _background_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.getLogger(__name__).warning(f"{task.get_name()} failed: {task.exception()}")
+
+    task.add_done_callback(_done)
+    return task
+
+def _instrument(callback, name: str):
+    return instrument_callback(tracer.trace_callback(callback, name), name)
+
+def _instrument_handler(handler, name: str):
+    handler.callback = _instrument(handler.callback, name)
+    return handler
+
+def _lazy_command(plugin, pconf: dict, command: str) -> CommandHandler:
+    """Registers the command of `plugin` now, its handler module and SDK are imported on the first use."""
+    handler = None
+    lock    = asyncio.Lock()
+
+    # the plugin watches its chats on the first command, admin lists are refreshed from startup on
+    admin_cache.watch(pconf.get("whitelist_chat", []))
+
+    async def lazy_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        nonlocal handler
+        async with lock:
+            if handler is None:
+                start_time = time.perf_counter()
+                await asyncio.to_thread(import_module, plugin.MODULE, plugin.__name__)
+                handler = plugin.get_handler(pconf)
+                logging.getLogger(__name__).info(f"loaded /{command} in {time.perf_counter()-start_time:.2f}s")
+        await handler.callback(update, context)
+
+    return CommandHandler(command, lazy_callback)
+
+async def _post_init(app: Application) -> None:
+    startup_report.phase("application")
+    await mob.backend.start()
+    startup_report.phase("storage")
+    tokenizer.start()
+    history_writer.start()
+    if conversation_store.persist: conversation_writer.start()
+    metrics_server.start()
+
+    # loads the dictionary while the first updates arrive, they wait for it in the tokenizer queue
+    _spawn(tokenizer.warm(), name="WarmTokenizer")
+    # index builds on a large history may take a while, do not hold back updates
+    _spawn(mob.backend.reconcile(), name="ReconcileStorage")
+
+    startup_report.phase("services")
+    startup_report.log()
+
+async def _post_shutdown(app: Application) -> None:
+    await metrics_server.stop()
+    await history_writer.stop()
+    await conversation_writer.stop()
+    await mob.backend.stop()
+    await tokenizer.stop()
+    await http_clients.close_all()
+
+def load_config(config: PathLike) -> dict:
     with open(config, "r", encoding="utf-8") as f:
         config: dict = json.load(f)
 
@@ -39,6 +143,13 @@ def serve_config(config: PathLike) -> None:
         datefmt="%Y-%m-%d %H:%M:%S",
     )
     logging.getLogger("httpx").setLevel(logging.WARNING)
+    jieba.setLogLevel(logging.getLogger(__name__).getEffectiveLevel())
+
+    return config
+
+def serve_config(config: PathLike) -> None:
+    startup_report.start()
+    config = load_config(config)
     logger = logging.getLogger(__name__)
 
 
@@ -55,18 +166,30 @@ def serve_config(config: PathLike) -> None:
     md_render_config.markdown_symbol.heading_level_4 = md_config.get("heading_level_4", md_config.get("head_level_4", md_render_config.markdown_symbol.heading_level_4))
 
 
-    init_database(config["database"])
+    init_storage(config["database"])
+    history_writer.configure(config["database"].get("write_behind", {}))
+    partition_policy.configure(config["database"].get("partitions", {}))
+    tokenizer.configure(config.get("tokenizer", {}))
+    admin_cache.configure(config.get("admin_cache", {}))
+    conversation_store.configure(config.get("conversations", {}))
+    http_clients.configure(config.get("http", {}))
+    metrics_server.configure(config.get("metrics", {}))
+    tracer.configure(config.get("tracing", {}))
+    startup_report.phase("config")
 
     app = (
         Application.
         builder().
         token(config["token"]).
         concurrent_updates(True).
+        request(InstrumentedRequest(connection_pool_size=256)).
+        post_init(_post_init).
+        post_shutdown(_post_shutdown).
         build()
     )
 
-    app.add_handler(CommandHandler("start", hello_world))
-    app.add_handler(CommandHandler("help", _helper))
+    router.add_command(_instrument_handler(CommandHandler("start", hello_world), "start"))
+    router.add_command(_instrument_handler(CommandHandler("help", _helper), "help"))
 
     global plugins_dict
     plugins = config["plugins"]
@@ -80,21 +203,37 @@ def serve_config(config: PathLike) -> None:
 
             logger.info(f"Dynamically load plugin => {pname}...")
             plugin  = import_module(f"{__package__}.plugins.{pname}")
-            handler = getattr(plugin, "get_handler")(pconf)
+            if hasattr(plugin, "COMMAND"):
+                command = pconf.get("command", plugin.COMMAND)
+                if not command: raise KeyError("command")
+                handler = _lazy_command(plugin, pconf, command)
+            else:
+                handler = getattr(plugin, "get_handler")(pconf)
 
             # logger.info(f"Added handler '{handler}'.")
-            app.add_handler(handler)
+            if isinstance(handler, CommandHandler):
+                router.add_command(_instrument_handler(handler, name))
+            else:
+                app.add_handler(_instrument_handler(handler, name))
         except Exception as e:
             logger.warning(f"Error: '{e}'")
         else:
             plugins_dict[name] = handler
 
-    app.add_handler(iwaku_inline_handler())
-    app.add_handler(iwaku_locate_handler())
-    app.add_handler(iwaku_history_handler())
-    iwaku_plugins_copy(plugins_dict)
+    app.add_handler(_instrument_handler(iwaku_inline_handler(), "iwaku_inline"))
+
+    router.megaphone = _instrument(router.megaphone, "megaphone")
+    router.portal    = _instrument(router.portal, "iwaku_locate")
+    router.history   = _instrument(router.history, "iwaku_history")
+    app.add_handler(_instrument_handler(router.handler(), "router"))
 
     plugins_dict["iwaku"] = None
+    startup_report.phase("plugins")
+
+    # keep admin lists of whitelisted chats warm
+    app.job_queue.run_repeating(callback=instrument_job(admin_cache.refresh, "AdminCache"), interval=admin_cache.ttl/2, first=0, name="AdminCache")
+    if partition_policy.enabled:
+        app.job_queue.run_daily(callback=instrument_job(partition_policy.job, "PartitionPolicy"), time=datetime.time(hour=4, tzinfo=datetime.timezone.utc), name="PartitionPolicy")
 
 
     for (jname, jconf) in config["jobs"].items():
@@ -113,13 +252,14 @@ def serve_config(config: PathLike) -> None:
             handler = getattr(plugin, "get_handler")(jconf["settings"])
 
             app.job_queue.__getattribute__(f"run_{jconf["type"]}")(
-                callback=handler,
+                callback=instrument_job(handler, kwargs.get("name", jname)),
                 **kwargs,
             )
         except Exception as e:
             logger.warning(f"Error: '{e}'")
 
     # job_task = asyncio.create_task(app.job_queue.start())
+    startup_report.phase("jobs")
 
 
     if "webhook" in config:
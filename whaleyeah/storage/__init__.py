@@ -0,0 +1,20 @@
+from .base import HistoryBackend
+from .mongo import MongoBackend
+from .sqlite import SQLiteBackend
+from ..database import init_database, mob
+
+
+def init_storage(db_config: dict) -> HistoryBackend:
+    """Initializes the database settings and the history backend selected by `backend` ("mongo" or "sqlite")."""
+    init_database(db_config)
+
+    backend = db_config.get("backend", "mongo")
+    if backend=="mongo":
+        mob.backend = MongoBackend()
+    elif backend=="sqlite":
+        sqlite_config = db_config.get("sqlite", {})
+        mob.backend = SQLiteBackend(sqlite_config.get("path", "whaleyeah.sqlite3"), cache_mb=sqlite_config.get("cache_mb", 64))
+    else:
+        raise ValueError(f"unknown storage backend: {backend}")
+
+    return mob.backend
@@ -0,0 +1,88 @@
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+
+from ..tokenstats import QueryPlan
+
+
+class HistoryBackend(ABC):
+    """
+    Storage of iwaku history documents.
+
+    History documents carry from, chat, mid, name, text, date, tokens, tf and
+    len, plus the raw update json when keep_raw_update is set. Search results
+    carry at least _id, chat, mid, name, text and date. Results are paged
+    newest first with an opaque keyset position, see `encode_offset`.
+    Backends missing one of the abstract methods cannot be created.
+    """
+
+    name = "base"
+
+    async def start(self) -> None:
+        """Prepares the storage, it must be usable once this returns."""
+
+    async def reconcile(self) -> None:
+        """Slow housekeeping such as index builds, may run in the background."""
+
+    async def stop(self) -> None:
+        pass
+
+
+    @abstractmethod
+    async def insert(self, docs: list[dict]) -> tuple[list[dict], list[dict], list[tuple[dict, str]]]:
+        """Stores new history documents, returns the inserted ones, the ones already stored and the rejected ones with their errors."""
+
+    @abstractmethod
+    async def edit(self, doc: dict) -> dict | None:
+        """Replaces text and tokens of a stored message, returns the previous date, tokens and len if it was stored."""
+
+    @abstractmethod
+    async def existing(self, chat_id: int, mids: list[int]) -> set[int]:
+        """Message ids of `chat_id` which are already stored."""
+
+
+    async def plan(self, tokens: list[str]) -> QueryPlan:
+        return QueryPlan("tokens", tokens, [])
+
+    @abstractmethod
+    async def search(self, plan: QueryPlan, limit: int, skip: int=0, after: tuple | None=None, projection: dict | None=None) -> list[dict]:
+        """Newest first matches of `plan`, `after` is the decoded keyset position of the previous page."""
+
+    @abstractmethod
+    async def count(self, plan: QueryPlan, limit: int) -> int:
+        """Counts matches of `plan`, stopping once more than `limit` are found."""
+
+    @abstractmethod
+    async def rank(self, query_tokens: list[str], plan: QueryPlan, projection: dict | None=None) -> list[dict]:
+        """Matches of `plan` ordered by relevance, best first."""
+
+
+    @abstractmethod
+    async def save_conversations(self, docs: list[dict]) -> None:
+        """
+        Upserts persisted LLM conversations by (ns, key), see conversations.py.
+
+        Documents carry ns, key, parent, messages and expire. The expiry of
+        the conversations keyed by `path` in the same namespace is extended
+        to theirs, since reloading a conversation needs all of its ancestors.
+        """
+
+    @abstractmethod
+    async def load_conversation(self, namespace: str, key: str) -> dict | None:
+        """Persisted conversation with its parent key and messages, None once expired."""
+
+
+    @abstractmethod
+    def parse_id(self, value: str):
+        """Document id from its string form in a keyset offset, ValueError if malformed."""
+
+    def encode_offset(self, doc: dict) -> str:
+        """Keyset position (date, _id) of the last result, used as inline query next_offset."""
+        date = doc["date"] if doc["date"].tzinfo else doc["date"].replace(tzinfo=timezone.utc)
+        return f"{int(date.timestamp()*1000)}.{doc['_id']}"
+
+    def decode_offset(self, offset: str) -> tuple[datetime, object] | None:
+        try:
+            date, oid = offset.split(".", maxsplit=1)
+            return datetime.fromtimestamp(int(date)/1000, tz=timezone.utc), self.parse_id(oid)
+        except ValueError:
+            return None
@@ -0,0 +1,99 @@
+import asyncio
+
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReplaceOne, UpdateMany
+
+from .base import HistoryBackend
+from .. import partitions, postings, relevance, tokenstats
+from ..database import history_partitions, mob, reconcile_indexes
+from ..ingest import write_history, edit_history
+from ..tokenstats import QueryPlan
+from ..tracing import traced
+
+
+class MongoBackend(HistoryBackend):
+    """History in MongoDB, optionally partitioned, with posting lists, token statistics and BM25 ranking."""
+
+    name = "mongo"
+
+    async def start(self) -> None:
+        # token statistics of a new history are complete from its first message on
+        for collection in await history_partitions():
+            if await collection.estimated_document_count(): return
+        await tokenstats.mark_complete()
+
+    async def reconcile(self) -> None:
+        await reconcile_indexes()
+
+
+    @traced("mongo.insert")
+    async def insert(self, docs: list[dict]) -> tuple[list[dict], list[dict], list[tuple[dict, str]]]:
+        return await write_history(docs)
+
+    @traced("mongo.edit")
+    async def edit(self, doc: dict) -> dict | None:
+        return await edit_history(doc)
+
+    @traced("mongo.existing")
+    async def existing(self, chat_id: int, mids: list[int]) -> set[int]:
+        return await partitions.existing_mids(chat_id, mids)
+
+
+    @traced("mongo.plan")
+    async def plan(self, tokens: list[str]) -> QueryPlan:
+        return await tokenstats.plan(tokens)
+
+    @traced("mongo.search")
+    async def search(self, plan: QueryPlan, limit: int, skip: int=0, after: tuple | None=None, projection: dict | None=None) -> list[dict]:
+        if plan.mode=="empty": return []
+        if plan.mode=="postings":
+            return await postings.search(plan.tokens, limit=limit, skip=skip, after=after, projection=projection)
+        return await partitions.search(plan.filter, limit=limit, skip=skip, after=after, projection=projection)
+
+    @traced("mongo.count")
+    async def count(self, plan: QueryPlan, limit: int) -> int:
+        if plan.mode=="empty": return 0
+        return await partitions.count(plan.filter, limit=limit)
+
+    @traced("mongo.rank")
+    async def rank(self, query_tokens: list[str], plan: QueryPlan, projection: dict | None=None) -> list[dict]:
+        if plan.mode=="empty": return []
+
+        docs, (freq, total), total_len = await asyncio.gather(
+            relevance.candidates(plan.filter, query_tokens, projection or {}),
+            tokenstats.document_frequencies(query_tokens),
+            tokenstats.total_length(),
+        )
+        return relevance.rank(docs, [freq[v] for v in query_tokens], total, total_len)
+
+
+    @traced("mongo.save_conversations")
+    async def save_conversations(self, docs: list[dict]) -> None:
+        requests = []
+        for doc in docs:
+            requests.append(ReplaceOne(
+                {"_id": f"{doc['ns']}:{doc['key']}"},
+                {k: v for (k, v) in doc.items() if k!="path"},
+                upsert=True,
+            ))
+            if doc["path"]:
+                requests.append(UpdateMany(
+                    {"_id": {"$in": [f"{doc['ns']}:{v}" for v in doc["path"]]}},
+                    {"$max": {"expire": doc["expire"]}},
+                ))
+        await mob.conversations.bulk_write(requests, ordered=False)
+
+    @traced("mongo.load_conversation")
+    async def load_conversation(self, namespace: str, key: str) -> dict | None:
+        # the ttl monitor only runs once a minute
+        return await mob.conversations.find_one({"_id": f"{namespace}:{key}", "expire": {"$gt": datetime.now(timezone.utc)}})
+
+
+    def parse_id(self, value: str) -> ObjectId:
+        try:
+            return ObjectId(value)
+        except InvalidId as e:
+            raise ValueError(e)
@@ -0,0 +1,303 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+from .base import HistoryBackend
+from .. import relevance
+from ..database import mob
+from ..tokenstats import QueryPlan
+from ..tracing import traced
+
+
+logger = logging.getLogger(__name__)
+
+# jieba tokens are stored hex encoded, so that the fts5 "ascii" tokenizer keeps each of them
+# whole and a query token only matches the exact same token, as {"tokens": {"$all": ...}} does
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id     INTEGER PRIMARY KEY,
+    chat   INTEGER NOT NULL,
+    mid    INTEGER NOT NULL,
+    sender INTEGER,
+    name   TEXT NOT NULL DEFAULT '',
+    text   TEXT NOT NULL,
+    date   INTEGER NOT NULL, -- unix time in ms
+    terms  TEXT NOT NULL,    -- hex encoded tokens, each repeated by its frequency
+    json   TEXT,
+    UNIQUE (chat, mid)
+);
+CREATE INDEX IF NOT EXISTS history_date ON history (date DESC, id DESC);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(terms, content='history', content_rowid='id', tokenize='ascii');
+
+CREATE TRIGGER IF NOT EXISTS history_ai AFTER INSERT ON history BEGIN
+    INSERT INTO history_fts (rowid, terms) VALUES (new.id, new.terms);
+END;
+CREATE TRIGGER IF NOT EXISTS history_ad AFTER DELETE ON history BEGIN
+    INSERT INTO history_fts (history_fts, rowid, terms) VALUES ('delete', old.id, old.terms);
+END;
+CREATE TRIGGER IF NOT EXISTS history_au AFTER UPDATE OF terms ON history BEGIN
+    INSERT INTO history_fts (history_fts, rowid, terms) VALUES ('delete', old.id, old.terms);
+    INSERT INTO history_fts (rowid, terms) VALUES (new.id, new.terms);
+END;
+
+CREATE TABLE IF NOT EXISTS conversations (
+    ns       TEXT NOT NULL,
+    key      TEXT NOT NULL,
+    parent   TEXT,
+    messages TEXT NOT NULL,    -- json
+    expire   INTEGER NOT NULL, -- unix time in ms
+    PRIMARY KEY (ns, key)
+);
+CREATE INDEX IF NOT EXISTS conversations_expire ON conversations (expire);
+"""
+
+RESULT_COLUMNS = "h.id, h.sender, h.chat, h.mid, h.name, h.text, h.date"
+
+
+def encode_terms(tokens: list[str], tf: list[int] | None=None) -> str:
+    return " ".join(token.encode().hex() for (token, n) in zip(tokens, tf or [1]*len(tokens)) for _ in range(n))
+
+def decode_terms(terms: str) -> list[str]:
+    return list(dict.fromkeys(bytes.fromhex(v).decode() for v in terms.split()))
+
+def match_expr(tokens: list[str]) -> str:
+    # space separated phrases are implicitly AND-ed
+    return " ".join(f"\"{token.encode().hex()}\"" for token in tokens)
+
+def to_ms(date: datetime) -> int:
+    if not date.tzinfo: date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp()*1000)
+
+def from_ms(ms: int) -> datetime:
+    # naive UTC, the same as dates read back from MongoDB
+    return datetime.fromtimestamp(ms/1000, tz=timezone.utc).replace(tzinfo=None)
+
+def result_doc(row: tuple) -> dict:
+    return {"_id": row[0], "from": row[1], "chat": row[2], "mid": row[3], "name": row[4], "text": row[5], "date": from_ms(row[6])}
+
+
+class SQLiteBackend(HistoryBackend):
+    """
+    History in an embedded SQLite database with an FTS5 index over the jieba tokens.
+
+    The database runs in WAL mode so searches never wait for writes. All
+    writes go through one dedicated thread with its own connection, reads
+    run on the default executor with one read-only connection per thread.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str="whaleyeah.sqlite3", cache_mb: int=64, busy_timeout: float=5.0) -> None:
+        self.path = path
+        self.cache_mb = cache_mb
+        self.busy_timeout = busy_timeout
+
+        self._writer: ThreadPoolExecutor | None = None
+        self._write_conn: sqlite3.Connection | None = None
+        self._local = threading.local()
+        self._read_conns: list[sqlite3.Connection] = []
+
+    def _connect(self, readonly: bool) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{1024*self.cache_mb}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if readonly: conn.execute("PRAGMA query_only=1")
+        return conn
+
+
+    async def start(self) -> None:
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="SQLiteWriter")
+        await self._write(self._create_schema)
+        logger.info(f"sqlite history at {self.path}")
+
+    async def stop(self) -> None:
+        if self._writer:
+            await self._write(self._close_writer)
+            self._writer.shutdown()
+            self._writer = None
+
+        for conn in self._read_conns: conn.close()
+        self._read_conns = []
+        self._local = threading.local()
+
+    async def reconcile(self) -> None:
+        await self._write(lambda: self._write_conn.execute("PRAGMA optimize"))
+
+
+    async def _write(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._writer, fn, *args)
+
+    async def _read(self, sql: str, params: tuple) -> list[tuple]:
+        return await asyncio.to_thread(self._query, sql, params)
+
+    def _query(self, sql: str, params: tuple) -> list[tuple]:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect(readonly=True)
+            self._read_conns.append(conn)
+        return conn.execute(sql, params).fetchall()
+
+    def _create_schema(self) -> None:
+        self._write_conn = self._connect(readonly=False)
+        self._write_conn.executescript(SCHEMA)
+
+    def _close_writer(self) -> None:
+        self._write_conn.execute("PRAGMA optimize")
+        self._write_conn.close()
+        self._write_conn = None
+
+
+    @traced("sqlite.insert")
+    async def insert(self, docs: list[dict]) -> tuple[list[dict], list[dict], list[tuple[dict, str]]]:
+        return await self._write(self._insert, docs)
+
+    def _insert(self, docs: list[dict]) -> tuple[list[dict], list[dict], list[tuple[dict, str]]]:
+        inserted, duplicates, errors = [], [], []
+        conn = self._write_conn
+
+        conn.execute("BEGIN")
+        try:
+            for doc in docs:
+                try:
+                    cursor = conn.execute(
+                        "INSERT INTO history (chat, mid, sender, name, text, date, terms, json) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (chat, mid) DO NOTHING",
+                        (
+                            doc["chat"], doc["mid"], doc.get("from"), doc.get("name", ""), doc["text"], to_ms(doc["date"]),
+                            encode_terms(doc["tokens"], doc.get("tf")), doc.get("json") if mob.keep_raw_update else None,
+                        ),
+                    )
+                except (sqlite3.IntegrityError, KeyError) as e:
+                    errors.append((doc, str(e)))
+                    continue
+
+                # re-delivered updates which are already stored are not inserted
+                (inserted if cursor.rowcount==1 else duplicates).append(doc)
+
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        return inserted, duplicates, errors
+
+    @traced("sqlite.edit")
+    async def edit(self, doc: dict) -> dict | None:
+        return await self._write(self._edit, doc)
+
+    def _edit(self, doc: dict) -> dict | None:
+        conn = self._write_conn
+
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute("SELECT date, terms FROM history WHERE chat=? AND mid=?", (doc["chat"], doc["mid"])).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE history SET text=?, terms=?, date=?, json=coalesce(?, json) WHERE chat=? AND mid=?",
+                    (
+                        doc["text"], encode_terms(doc["tokens"], doc.get("tf")), to_ms(doc["date"]),
+                        doc.get("json") if mob.keep_raw_update else None, doc["chat"], doc["mid"],
+                    ),
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        if not row: return None
+        return {"date": from_ms(row[0]), "tokens": decode_terms(row[1]), "len": len(row[1].split())}
+
+    @traced("sqlite.existing")
+    async def existing(self, chat_id: int, mids: list[int]) -> set[int]:
+        rows = await self._read(f"SELECT mid FROM history WHERE chat=? AND mid IN ({', '.join('?'*len(mids))})", (chat_id, *mids))
+        return {v[0] for v in rows}
+
+
+    @traced("sqlite.search")
+    async def search(self, plan: QueryPlan, limit: int, skip: int=0, after: tuple | None=None, projection: dict | None=None) -> list[dict]:
+        sql    = f"SELECT {RESULT_COLUMNS} FROM history_fts JOIN history h ON h.id=history_fts.rowid WHERE history_fts MATCH ?"
+        params = [match_expr(plan.tokens)]
+        if after:
+            date, oid = to_ms(after[0]), after[1]
+            sql += " AND (h.date<? OR (h.date=? AND h.id<?))"
+            params += [date, date, oid]
+        sql += " ORDER BY h.date DESC, h.id DESC LIMIT ? OFFSET ?"
+        params += [limit, skip]
+
+        return [result_doc(row) for row in await self._read(sql, tuple(params))]
+
+    @traced("sqlite.count")
+    async def count(self, plan: QueryPlan, limit: int) -> int:
+        rows = await self._read(
+            "SELECT count(*) FROM (SELECT 1 FROM history_fts WHERE history_fts MATCH ? LIMIT ?)",
+            (match_expr(plan.tokens), limit+1),
+        )
+        return rows[0][0]
+
+    @traced("sqlite.rank")
+    async def rank(self, query_tokens: list[str], plan: QueryPlan, projection: dict | None=None) -> list[dict]:
+        """Best BM25 matches of fts5, re-weighted by the same recency decay as the MongoDB ranking."""
+        rows = await self._read(
+            f"SELECT {RESULT_COLUMNS}, bm25(history_fts) FROM history_fts JOIN history h ON h.id=history_fts.rowid "
+            "WHERE history_fts MATCH ? ORDER BY bm25(history_fts) LIMIT ?",
+            (match_expr(plan.tokens), relevance.RELEVANCE_CANDIDATES),
+        )
+        if not rows: return []
+
+        # fts5 scores are negative, lower is better
+        score = -np.array([row[7] for row in rows], dtype=np.float64)
+        ts    = np.array([row[6]/1000 for row in rows], dtype=np.float64)
+
+        order = np.argsort(-(score*relevance.recency(ts)), kind="stable")
+        return [result_doc(rows[k]) for k in order]
+
+
+    @traced("sqlite.save_conversations")
+    async def save_conversations(self, docs: list[dict]) -> None:
+        await self._write(self._save_conversations, docs)
+
+    def _save_conversations(self, docs: list[dict]) -> None:
+        conn = self._write_conn
+
+        conn.execute("BEGIN")
+        try:
+            for doc in docs:
+                expire = to_ms(doc["expire"])
+                conn.execute(
+                    "INSERT OR REPLACE INTO conversations (ns, key, parent, messages, expire) VALUES (?, ?, ?, ?, ?)",
+                    (doc["ns"], doc["key"], doc["parent"], json.dumps(doc["messages"], ensure_ascii=False), expire),
+                )
+                if doc["path"]:
+                    conn.execute(
+                        f"UPDATE conversations SET expire=max(expire, ?) WHERE ns=? AND key IN ({', '.join('?'*len(doc['path']))})",
+                        (expire, doc["ns"], *doc["path"]),
+                    )
+            # there is no ttl monitor, expired conversations go with the next batch
+            conn.execute("DELETE FROM conversations WHERE expire<?", (to_ms(datetime.now(timezone.utc)),))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    @traced("sqlite.load_conversation")
+    async def load_conversation(self, namespace: str, key: str) -> dict | None:
+        rows = await self._read(
+            "SELECT parent, messages, expire FROM conversations WHERE ns=? AND key=? AND expire>?",
+            (namespace, key, to_ms(datetime.now(timezone.utc))),
+        )
+        if not rows: return None
+        return {"ns": namespace, "key": key, "parent": rows[0][0], "messages": json.loads(rows[0][1]), "expire": from_ms(rows[0][2])}
+
+
+    def parse_id(self, value: str) -> int:
+        return int(value)
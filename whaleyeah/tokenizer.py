@@ -0,0 +1,152 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import jieba
+
+from .tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK        = 1
+
+
+def _worker_init(log_level: int, cache_file: str | None) -> None:
+    jieba.setLogLevel(log_level)
+    if cache_file: jieba.dt.cache_file = cache_file
+    jieba.initialize()
+
+def _warm() -> bool:
+    return jieba.dt.initialized
+
+def _lcut_for_search_batch(texts: list[str]) -> list[list[str]]:
+    return [jieba.lcut_for_search(text) for text in texts]
+
+
+class Tokenizer:
+    """
+    jieba tokenization offloaded to a process pool.
+
+    Each worker process loads the dictionary once. Requests are dispatched by
+    priority, so inline queries overtake queued ingestion work, and pending
+    bulk requests are coalesced into batches of up to `max_batch` texts.
+    With `workers` set to 0 tokenization runs in a thread of this process.
+
+    jieba keeps its prefix dictionary in `cache_file`, which should be on a
+    persistent volume so that restarts do not rebuild it.
+    """
+
+    def __init__(self, workers: int=1, max_batch: int=64, cache_file: str | None=None) -> None:
+        self.workers    = workers
+        self.max_batch  = max_batch
+        self.cache_file = cache_file
+
+        self._pool: ProcessPoolExecutor | None = None
+        self._queue: asyncio.PriorityQueue | None = None
+        self._dispatchers: list[asyncio.Task] = []
+        self._seq = itertools.count()
+
+    def configure(self, config: dict) -> None:
+        self.workers    = int(config.get("workers", self.workers))
+        self.max_batch  = int(config.get("max_batch", self.max_batch))
+        self.cache_file = config.get("cache_file", self.cache_file)
+        if self.cache_file: jieba.dt.cache_file = self.cache_file
+
+
+    def start_pool(self) -> None:
+        if self._pool is None and self.workers>0:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_worker_init,
+                initargs=(logger.getEffectiveLevel(), self.cache_file),
+            )
+            logger.info(f"started {self.workers} tokenizer worker(s)")
+
+    def start(self) -> None:
+        self.start_pool()
+        if self._pool and not self._dispatchers:
+            self._queue = asyncio.PriorityQueue()
+            self._dispatchers = [
+                asyncio.create_task(self._dispatch(), name=f"TokenizerDispatcher-{k}")
+                for k in range(self.workers)
+            ]
+
+    async def stop(self) -> None:
+        for task in self._dispatchers: task.cancel()
+        await asyncio.gather(*self._dispatchers, return_exceptions=True)
+        self._dispatchers = []
+        self._queue = None
+
+        if self._pool:
+            pool, self._pool = self._pool, None
+            await asyncio.to_thread(pool.shutdown, wait=True, cancel_futures=True)
+
+
+    async def warm(self) -> None:
+        """Spawns the workers and loads the dictionary before the first message needs it."""
+        start_time = time.perf_counter()
+        if self._pool is None:
+            await asyncio.to_thread(jieba.initialize)
+        else:
+            # one job per worker, the pool spawns a process for each job queued while all are busy
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*[loop.run_in_executor(self._pool, _warm) for _ in range(self.workers)])
+        logger.info(f"jieba dictionary loaded in {time.perf_counter()-start_time:.2f}s")
+
+
+    async def lcut_for_search(self, text: str, priority: int=PRIORITY_BULK) -> list[str]:
+        return (await self.lcut_for_search_many([text], priority))[0]
+
+    async def lcut_for_search_many(self, texts: list[str], priority: int=PRIORITY_BULK) -> list[list[str]]:
+        if not texts: return []
+        with span("tokenize", texts=len(texts)):
+            if self._queue is None:
+                return await asyncio.to_thread(_lcut_for_search_batch, texts)
+
+            future = asyncio.get_running_loop().create_future()
+            self._queue.put_nowait((priority, next(self._seq), texts, future))
+            return await future
+
+    def map(self, texts: list[str], chunksize: int=256) -> list[list[str]]:
+        """Blocking batch tokenization for scripts running outside the event loop."""
+        if self._pool is None:
+            return _lcut_for_search_batch(texts)
+
+        batches = [texts[k:k+chunksize] for k in range(0, len(texts), chunksize)]
+        return [seg for batch in self._pool.map(_lcut_for_search_batch, batches) for seg in batch]
+
+
+    async def _dispatch(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            jobs = [await self._queue.get()]
+            size = len(jobs[0][2])
+
+            # coalesce queued bulk requests, interactive ones are always dequeued first
+            while jobs[0][0]==PRIORITY_BULK and size<self.max_batch and not self._queue.empty():
+                jobs.append(self._queue.get_nowait())
+                size += len(jobs[-1][2])
+
+            texts = [text for job in jobs for text in job[2]]
+            try:
+                segs = await loop.run_in_executor(self._pool, _lcut_for_search_batch, texts)
+            except Exception as e:
+                for job in jobs:
+                    if not job[3].done(): job[3].set_exception(e)
+                continue
+
+            offset = 0
+            for (_, _, job_texts, future) in jobs:
+                if not future.done(): future.set_result(segs[offset:offset+len(job_texts)])
+                offset += len(job_texts)
+
+
+tokenizer = Tokenizer()
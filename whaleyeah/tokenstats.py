@@ -0,0 +1,142 @@
+import logging
+import time
+
+from collections import Counter
+from datetime import datetime, timezone
+
+from pymongo import UpdateOne
+
+from .database import mob
+
+
+logger = logging.getLogger(__name__)
+
+# the collection size is kept under the empty token, which trim_tokens never emits
+TOTAL_KEY = ""
+# set on the total by rebuild_token_stats, incremental counts alone miss older history
+REBUILT_FIELD = "rebuilt"
+
+# tokens found in more than STOPWORD_RATIO of all documents are dropped from queries,
+# once the history holds at least STOPWORD_MIN_DOCS documents
+STOPWORD_RATIO    = 0.05
+STOPWORD_MIN_DOCS = 10000
+
+# the posting lists only pay off when even the rarest token is this common
+POSTINGS_MIN_DF = 2000
+
+STATS_CACHE_TTL  = 300
+STATS_CACHE_SIZE = 4096
+
+_stats_cache: dict[str, tuple[dict, float]] = {}
+
+
+async def mark_complete() -> None:
+    """Marks the statistics of an empty history as complete, incremental counts then cover all of it."""
+    await mob.token_stats.replace_one({"_id": TOTAL_KEY}, {"df": 0, "len": 0, REBUILT_FIELD: datetime.now(timezone.utc)}, upsert=True)
+
+async def record(docs: list[dict], sign: int=1) -> None:
+    """Counts inserted (or with sign=-1, removed) history documents into the per-token document frequencies."""
+    counter = Counter(token for doc in docs for token in doc["tokens"])
+    if not counter: return
+
+    length = sum(doc.get("len", len(doc["tokens"])) for doc in docs)
+
+    ops = [UpdateOne({"_id": token}, {"$inc": {"df": sign*n}}, upsert=True) for (token, n) in counter.items()]
+    ops.append(UpdateOne({"_id": TOTAL_KEY}, {"$inc": {"df": sign*len(docs), "len": sign*length}}, upsert=True))
+    await mob.token_stats.bulk_write(ops, ordered=False)
+
+async def record_edit(old: dict, new: dict) -> None:
+    old_tokens, new_tokens = old.get("tokens", []), new["tokens"]
+
+    ops  = [UpdateOne({"_id": token}, {"$inc": {"df": -1}}) for token in set(old_tokens) - set(new_tokens)]
+    ops += [UpdateOne({"_id": token}, {"$inc": {"df": 1}}, upsert=True) for token in set(new_tokens) - set(old_tokens)]
+    ops.append(UpdateOne({"_id": TOTAL_KEY}, {"$inc": {"len": new.get("len", len(new_tokens)) - old.get("len", len(old_tokens))}}))
+    await mob.token_stats.bulk_write(ops, ordered=False)
+
+
+async def _lookup(keys: set[str]) -> dict[str, dict]:
+    now   = time.monotonic()
+    stats = {}
+
+    for key in keys:
+        if key in _stats_cache and _stats_cache[key][1]>now:
+            stats[key] = _stats_cache[key][0]
+
+    missing = list(keys - set(stats))
+    if missing:
+        found = {v["_id"]: v async for v in mob.token_stats.find({"_id": {"$in": missing}})}
+        for key in missing:
+            stats[key] = found.get(key, {})
+            # unknown tokens may be in the write-behind buffer, look them up again next time
+            if stats[key].get("df", 0)>0:
+                _stats_cache[key] = (stats[key], now+STATS_CACHE_TTL)
+
+        while len(_stats_cache)>STATS_CACHE_SIZE:
+            _stats_cache.pop(next(iter(_stats_cache)))
+
+    return stats
+
+def trusted(totals: dict) -> bool:
+    """Whether the statistics cover the whole history, incremental counts alone miss what was stored before them."""
+    return bool(totals.get(REBUILT_FIELD)) and totals.get("df", 0)>0
+
+async def document_frequencies(tokens: list[str]) -> tuple[dict[str, int], int]:
+    """
+    Returns the document frequency of each token and the number of documents, both slightly stale.
+
+    The number of documents is 0 while the statistics are not trusted.
+    """
+    stats  = await _lookup(set(tokens) | {TOTAL_KEY})
+    totals = stats.pop(TOTAL_KEY)
+    return {k: v.get("df", 0) for (k, v) in stats.items()}, totals["df"] if trusted(totals) else 0
+
+async def total_length() -> int:
+    """Returns the summed token count of all documents."""
+    return (await _lookup({TOTAL_KEY}))[TOTAL_KEY].get("len", 0)
+
+
+class QueryPlan:
+    def __init__(self, mode: str, tokens: list[str], dropped: list[str]) -> None:
+        self.mode    = mode # "tokens", "postings", "text" or "empty"
+        self.tokens  = tokens
+        self.dropped = dropped
+
+    @property
+    def filter(self) -> dict:
+        if self.mode=="text":
+            return {"$text": {"$search": " ".join(self.tokens)}}
+        return {"tokens": {"$all": self.tokens}}
+
+    def __repr__(self) -> str:
+        return f"<QueryPlan(mode={self.mode}, tokens={self.tokens}, dropped={self.dropped})>"
+
+
+async def plan(tokens: list[str]) -> QueryPlan:
+    """
+    Orders query tokens by selectivity, drops ultra-common ones and picks the search path.
+
+    Statistics are only trusted once `rebuild_token_stats` has counted the
+    existing history, until then the static configuration decides, as it
+    did before statistics were collected.
+    """
+    freq, total = await document_frequencies(tokens)
+
+    if total<=0:
+        if mob.use_text_search: return QueryPlan("text", tokens, [])
+        return QueryPlan("postings" if mob.use_postings else "tokens", tokens, [])
+
+    # a token missing from trusted statistics is in no stored message
+    if any(freq[v]<=0 for v in tokens):
+        # the intersection is empty, fall back to $text which matches any of the tokens
+        if mob.use_text_search: return QueryPlan("text", tokens, [])
+        return QueryPlan("empty", tokens, [])
+
+    ordered = sorted(tokens, key=lambda v: freq[v])
+    dropped = []
+    if total>=STOPWORD_MIN_DOCS:
+        dropped = [v for v in ordered[1:] if freq[v]/total>STOPWORD_RATIO]
+        ordered = [v for v in ordered if v not in dropped]
+
+    if mob.use_postings and freq[ordered[0]]>=POSTINGS_MIN_DF:
+        return QueryPlan("postings", ordered, dropped)
+    return QueryPlan("tokens", ordered, dropped)
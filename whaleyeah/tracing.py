@@ -0,0 +1,191 @@
+import functools
+import json
+import logging
+import random
+import time
+
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+import httpx
+
+
+logger = logging.getLogger(__name__)
+
+MAX_SPANS = 256
+
+# (trace, index of the innermost open span), child tasks inherit it with their context
+_current: ContextVar[tuple["Trace", int] | None] = ContextVar("whaleyeah_trace", default=None)
+
+
+class Trace:
+    """Spans of one update, the root span has index 0."""
+
+    def __init__(self, name: str, update) -> None:
+        self.update  = update
+        self.origin  = time.perf_counter()
+        self.spans   = [[name, -1, 0.0, None, {}]] # name, parent, start, duration, attrs
+        self.dropped = 0
+        self.error: str | None = None
+
+    def open(self, name: str, parent: int, attrs: dict) -> int:
+        if len(self.spans)>=MAX_SPANS:
+            self.dropped += 1
+            return -1
+        self.spans.append([name, parent, time.perf_counter()-self.origin, None, attrs])
+        return len(self.spans)-1
+
+    def close(self, index: int) -> None:
+        if index>=0: self.spans[index][3] = time.perf_counter() - self.origin - self.spans[index][2]
+
+    @property
+    def duration(self) -> float:
+        return self.spans[0][3] or 0.0
+
+    def record(self) -> dict:
+        update = self.update
+        chat = getattr(update, "effective_chat", None)
+        user = getattr(update, "effective_user", None)
+        return {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "handler": self.spans[0][0],
+            "update_id": getattr(update, "update_id", None),
+            "chat": chat.id if chat else None,
+            "user": user.id if user else None,
+            "ms": round(1000*self.duration, 3),
+            "error": self.error,
+            "spans": [
+                {
+                    "name": name, "parent": parent, "start_ms": round(1000*start, 3),
+                    "ms": None if duration is None else round(1000*duration, 3), **attrs,
+                }
+                for (name, parent, start, duration, attrs) in self.spans[1:]
+            ],
+            "dropped_spans": self.dropped,
+        }
+
+
+class _Span:
+    def __init__(self, trace: Trace, parent: int, name: str, attrs: dict) -> None:
+        self.trace  = trace
+        self.parent = parent
+        self.name   = name
+        self.attrs  = attrs
+
+    def __enter__(self) -> "_Span":
+        self.index = self.trace.open(self.name, self.parent, self.attrs)
+        self._token = _current.set((self.trace, self.index if self.index>=0 else self.parent))
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+        _current.reset(self._token)
+        if exc_type: self.attrs["error"] = exc_type.__name__
+        self.trace.close(self.index)
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+class _NoSpan:
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+    def set(self, **attrs) -> None:
+        pass
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name: str, **attrs) -> _Span | _NoSpan:
+    """Child span of the current update, a no-op outside of sampled updates."""
+    current = _current.get()
+    if current is None: return _NO_SPAN
+    return _Span(current[0], current[1], name, attrs)
+
+def traced(name: str):
+    """Decorates a coroutine function with a span."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TracedTransport(httpx.AsyncHTTPTransport):
+    """httpx transport adding a span per request, the span ends once the response headers arrived."""
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        with span(f"http.{request.method}", host=request.url.host) as s:
+            response = await super().handle_async_request(request)
+            s.set(status=response.status_code)
+            return response
+
+
+class Tracer:
+    """
+    Samples updates and writes the span breakdown of slow ones as JSONL.
+
+    Each sampled update gets a root span named after its handler, child spans
+    come from `span` and `traced` in the tokenizer, the storage backends, the
+    Bot API request and httpx transports.
+    """
+
+    def __init__(self) -> None:
+        self.sample_rate = 0.0
+        self.slow_ms     = 2000.0
+        self.log: str | None = None
+
+    def configure(self, config: dict) -> None:
+        self.sample_rate = float(config.get("sample_rate", 1.0 if config else self.sample_rate))
+        self.slow_ms     = float(config.get("slow_ms", self.slow_ms))
+        self.log         = config.get("log", self.log)
+
+    def sampled(self) -> bool:
+        return self.sample_rate>=1.0 or random.random()<self.sample_rate
+
+    def submit(self, trace: Trace) -> None:
+        if 1000*trace.duration < self.slow_ms: return
+
+        line = json.dumps(trace.record(), ensure_ascii=False)
+        if not self.log:
+            logger.warning(f"slow update: {line}")
+            return
+
+        try:
+            with open(self.log, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            logger.warning(f"failed to write slow update log: {e}")
+
+    def trace_callback(self, callback, name: str):
+        """Wraps an update callback in the root span of sampled updates, the update is its first argument."""
+        @functools.wraps(callback)
+        async def traced_callback(update, *args, **kwargs):
+            # stages dispatched by the router become child spans
+            if _current.get() is not None:
+                with span(name):
+                    return await callback(update, *args, **kwargs)
+
+            if not self.sample_rate or not self.sampled():
+                return await callback(update, *args, **kwargs)
+
+            trace = Trace(name, update)
+            token = _current.set((trace, 0))
+            try:
+                return await callback(update, *args, **kwargs)
+            except Exception as e:
+                trace.error = repr(e)
+                raise
+            finally:
+                _current.reset(token)
+                trace.close(0)
+                self.submit(trace)
+
+        return traced_callback
+
+
+tracer = Tracer()